@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+# Controller side provisioning of a machine in one task.
+#
+# tasks/provision.yml provisions a host with four module tasks (images,
+# preseed, machine parameters and PXE provision), each one a new Python
+# interpreter importing requests, opening its connections and looking up the
+# catalogs again. This action plugin does the same steps within the
+# controller's worker process: one session, one image and one preseed
+# listing, and no module transfer or interpreter start at all.
+#
+# It reuses the role's module_utils, which are only on the import path of
+# modules, so their directory is added to ansible.module_utils here.
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import os
+import time
+
+import ansible.module_utils
+from ansible.plugins.action import ActionBase
+
+_MODULE_UTILS = os.path.join(os.path.dirname(os.path.dirname(
+                             os.path.abspath(__file__))), 'module_utils')
+if _MODULE_UTILS not in ansible.module_utils.__path__:
+    ansible.module_utils.__path__.append(_MODULE_UTILS)
+
+from ansible.module_utils.mr_provisioner import (ProvisionerError,
+                                                 client_argument_spec,
+                                                 get_client)
+from ansible.module_utils.mr_provisioner_admission import (admission_argument_spec,
+                                                           admission_from_params)
+from ansible.module_utils.mr_provisioner_cache import store
+from ansible.module_utils.mr_provisioner_catalog import (catalog_argument_spec,
+                                                         image_catalog,
+                                                         preseed_catalog)
+from ansible.module_utils.mr_provisioner_machine import (artifact_fingerprint,
+                                                         boot_lease,
+                                                         get_machine_by_name,
+                                                         job_handle,
+                                                         machine_parameter_changes,
+                                                         machine_provision,
+                                                         preseed_digest,
+                                                         preseed_record,
+                                                         provision_fingerprint,
+                                                         record_jobs,
+                                                         record_provision,
+                                                         update_machine_parameters)
+from ansible.module_utils.mr_provisioner_preseed import PreseedUploader
+from ansible.module_utils.mr_provisioner_upload import (upload_argument_spec,
+                                                        upload_images)
+
+DEFAULT_WORKERS = 2
+
+ARGUMENT_SPEC = dict(
+    url=dict(type='str', required=True),
+    token=dict(type='str', required=True, no_log=True),
+    machine_name=dict(type='str', required=True),
+    arch=dict(type='str', required=True),
+    subarch=dict(type='str', required=True),
+    kernel_description=dict(type='str', required=True),
+    kernel_path=dict(type='str', required=False),
+    kernel_options=dict(type='str', required=False),
+    initrd_description=dict(type='str', required=True),
+    initrd_path=dict(type='str', required=False),
+    public=dict(type='bool', required=False, default=False),
+    known_good=dict(type='bool', required=False, default=False),
+    preseed_name=dict(type='str', required=True),
+    preseed_path=dict(type='str', required=False, default=''),
+    preseed_description=dict(type='str', required=False, default=''),
+    preseed_type=dict(type='str', required=False, default='preseed'),
+    preseed_public=dict(type='bool', required=False, default=False),
+    preseed_known_good=dict(type='bool', required=False, default=False),
+    workers=dict(type='int', required=False, default=DEFAULT_WORKERS),
+    fingerprint=dict(type='bool', required=False, default=False),
+)
+ARGUMENT_SPEC.update(upload_argument_spec())
+ARGUMENT_SPEC.update(client_argument_spec())
+ARGUMENT_SPEC.update(catalog_argument_spec())
+ARGUMENT_SPEC.update(admission_argument_spec())
+
+
+class ActionModule(ActionBase):
+    """ Upload the kernel, initrd and preseed of a machine and provision
+        it, as tasks/provision.yml does with four modules """
+    TRANSFERS_FILES = False
+    _VALID_ARGS = frozenset(ARGUMENT_SPEC)
+
+    def run(self, tmp=None, task_vars=None):
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp
+
+        params = self.validate_argument_spec(ARGUMENT_SPEC)[1]
+        result['changed'] = False
+        if self._play_context.check_mode:
+            result['skipped'] = True
+            result['msg'] = 'check mode not supported'
+            return result
+
+        start = time.time()
+        client = get_client(params['url'], params['token'],
+                            pool_size=max(params['pool_size'],
+                                          params['workers']),
+                            connect_timeout=params['connect_timeout'],
+                            read_timeout=params['read_timeout'],
+                            trace_file=params['trace_file'],
+                            retries=params['retries'],
+                            retry_interval=params['retry_interval'],
+                            retry_deadline=params['retry_deadline'])
+        client.trace_name = 'mr_provisioner'
+        try:
+            self._provision(client, params, result)
+        except ProvisionerError as e:
+            result['failed'] = True
+            result['msg'] = str(e)
+        result['timings'] = client.timings()
+        result['timings']['elapsed'] = round(time.time() - start, 3)
+        return result
+
+    def _provision(self, client, params, result):
+        warnings = []
+        # The hosts of a play all upload the same images and preseed: the
+        # first one to get here uploads them, the others find them
+        with store('action_uploads', params['cache_dir']).lock():
+            kernel, initrd = self._images(client, params, result, warnings)
+            preseed = self._preseed(client, params, result)
+        if warnings:
+            result['warnings'] = warnings
+
+        machine = get_machine_by_name(client, params['machine_name'])
+        result['machine'] = machine
+        parameters = dict(initrd_id=initrd['id'], kernel_id=kernel['id'],
+                          kernel_opts=params['kernel_options'],
+                          preseed_id=preseed['id'], subarch=params['subarch'])
+
+        # As mr_provisioner_machine_provision does
+        preseed = preseed_record(preseed)
+        if params['fingerprint']:
+            preseed['sha256'] = preseed_digest(client, preseed)
+        fingerprint = artifact_fingerprint(kernel, initrd, preseed,
+                                           params['kernel_options'],
+                                           params['subarch'])
+        result['fingerprint'] = fingerprint
+        if params['fingerprint']:
+            changes = machine_parameter_changes(machine, **parameters)
+            changes.pop('netboot_enabled', None)
+            if not changes and provision_fingerprint(
+                    client, machine['id'], params['cache_dir']) == fingerprint:
+                result['parameters_changed'] = []
+                result['provision_skipped'] = True
+                return
+
+        machine_state, changed = update_machine_parameters(client, machine,
+                                                           **parameters)
+        result['machine_state'] = machine_state
+        result['parameters_changed'] = changed
+        admission = admission_from_params(client, params)
+        if admission:
+            result['admission_wait'] = admission.acquire(machine['id'])
+        try:
+            lease = boot_lease(client, machine['id'], params['interface_name'])
+            result['machine_provision'] = machine_provision(
+                client, machine_id=machine['id'])
+        except ProvisionerError:
+            if admission:
+                admission.release(machine['id'])
+            raise
+        result['job'] = job_handle(machine, lease)
+        record_jobs(client, [result['job']], params['cache_dir'])
+        result['provision_skipped'] = False
+        result['changed'] = True
+        if params['fingerprint']:
+            record_provision(client, machine['id'], fingerprint,
+                             params['cache_dir'])
+
+    def _images(self, client, params, result, warnings):
+        """ Kernel and initrd records, uploading those given a path """
+        images = [dict(description=params[prefix + '_description'],
+                       type=image_type, arch=params['arch'],
+                       path=params[prefix + '_path'],
+                       known_good=params['known_good'],
+                       public=params['public'])
+                  for image_type, prefix in [('Kernel', 'kernel'),
+                                             ('Initrd', 'initrd')]]
+        uploads = upload_images(client, [i for i in images if i['path']],
+                                params, warnings.append)
+        failed = [u for u in uploads if 'error' in u]
+        if failed:
+            raise ProvisionerError('Failed to upload {}'.format('; '.join(
+                                   '{}: {}'.format(u['description'], u['error'])
+                                   for u in failed)))
+        result['images'] = uploads
+        result['changed'] = any(u['changed'] for u in uploads)
+
+        found = dict((u['type'], u['json']) for u in uploads)
+        for image in images:
+            if image['type'] in found:
+                continue
+            catalog = image_catalog(client, params['catalog_ttl'],
+                                    params['cache_dir'])
+            if not catalog.find(image['type'], image['arch'],
+                                image['description']):
+                catalog = image_catalog(client, 0, params['cache_dir'])
+            found[image['type']] = catalog.get(image['type'], image['arch'],
+                                               image['description'])
+        return found['Kernel'], found['Initrd']
+
+    def _preseed(self, client, params, result):
+        """ The preseed record, uploaded first when given a path """
+        # Revalidated: a stale listing would have an existing preseed
+        # created again
+        catalog = preseed_catalog(client, 0, params['cache_dir'])
+        uploader = PreseedUploader(params['url'], params['token'],
+                                   params['preseed_path'],
+                                   params['preseed_name'],
+                                   params['preseed_type'],
+                                   params['preseed_description'],
+                                   params['preseed_known_good'],
+                                   params['preseed_public'], client=client,
+                                   cache_dir=params['cache_dir'],
+                                   catalog=catalog)
+        preseed = uploader.upload_preseed()
+        if 'error' in preseed:
+            raise ProvisionerError(preseed['error'])
+        result['preseed'] = dict(json=preseed, changed=uploader.changed,
+                                 content_changed=uploader.content_changed,
+                                 sha256=uploader.sha256)
+        result['changed'] = result['changed'] or uploader.changed
+        return preseed
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+# Inventory of the machines of a Mr. Provisioner instance.
+#
+# Rather than resolving lease IPs at play time (tasks/add_host.yml runs
+# mr_provisioner_get_ip and add_host), the inventory lists the machines in
+# one request, fetches their interfaces concurrently and sets each host's
+# ansible_host to its lease_ipv4. Leases are cached on disk for lease_ttl
+# seconds, so that most runs cost a single API request.
+#
+# Inventory is parsed before any role is loaded: point inventory_plugins
+# (ansible.cfg) or $ANSIBLE_INVENTORY_PLUGINS at this directory, and name the
+# source file *.mr_provisioner.yml:
+#
+#   plugin: mr_provisioner
+#   url: http://192.168.0.3:5000/
+#   token: DEADBEEF
+#
+# As for the action plugin, the role's module_utils are added to
+# ansible.module_utils so that the modules' code can be reused here.
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+DOCUMENTATION = '''
+name: mr_provisioner
+plugin_type: inventory
+short_description: Machines of a Mr. Provisioner instance, with their lease IPs
+description:
+    - Adds the machines of a Mr. Provisioner instance as hosts named after
+      the machines, with ansible_host set to the lease IPv4 of one of their
+      interfaces.
+    - Lease IPs are cached on disk for lease_ttl seconds.
+    - Unless show_all is set, the machine ids are cached on disk, so that
+      the modules given the same url and token do not look the machines up
+      by name again.
+    - Hosts get mr_provisioner_machine_name, mr_provisioner_machine_id and
+      mr_provisioner_machine (the machine record) as variables.
+    - Uses a YAML configuration file whose name ends with mr_provisioner.yml
+      or mr_provisioner.yaml.
+extends_documentation_fragment:
+    - constructed
+options:
+    plugin:
+        description: Marks the file as a source for this plugin.
+        required: true
+        choices: ['mr_provisioner']
+    url:
+        description: url to provisioner instance in the form of
+            http://192.168.0.3:5000/. May be a template.
+        required: true
+        env:
+            - name: MR_PROVISIONER_URL
+    token:
+        description: Mr. Provisioner auth token. May be a template, e.g. a
+            lookup.
+        required: true
+        env:
+            - name: MR_PROVISIONER_TOKEN
+    interface_name:
+        description: Interface whose lease IP is used as ansible_host.
+        default: eth1
+    machines:
+        description: Only add these machines. Default all of them.
+        type: list
+        default: []
+    show_all:
+        description: List all machines rather than those assigned to the
+            token's user.
+        type: bool
+        default: false
+    group:
+        description: Group every machine is added to.
+        default: mr_provisioner
+    lease_ttl:
+        description: Seconds a lease IP is cached before the machine's
+            interfaces are fetched again. Machines without a lease are
+            always fetched again.
+        type: int
+        default: 300
+    workers:
+        description: Number of machines whose interfaces are fetched
+            concurrently.
+        type: int
+        default: 10
+    connect_timeout:
+        description: Seconds to wait for a connection.
+        type: float
+        default: 10
+    read_timeout:
+        description: Seconds to wait for a response.
+        type: float
+        default: 300
+    cache_dir:
+        description: Directory of the lease and machine id caches.
+        type: path
+        env:
+            - name: MR_PROVISIONER_CACHE_DIR
+'''
+
+EXAMPLES = '''
+# lab.mr_provisioner.yml
+plugin: mr_provisioner
+url: http://192.168.0.3:5000/
+token: "{{ lookup('env', 'MR_PROVISIONER_TOKEN') }}"
+interface_name: eth1
+lease_ttl: 600
+keyed_groups:
+    - key: mr_provisioner_machine.arch
+      prefix: arch
+'''
+
+import os
+
+import ansible.module_utils
+from ansible.errors import AnsibleParserError
+from ansible.plugins.inventory import BaseInventoryPlugin, Constructable
+
+_MODULE_UTILS = os.path.join(os.path.dirname(os.path.dirname(
+                             os.path.abspath(__file__))), 'module_utils')
+if _MODULE_UTILS not in ansible.module_utils.__path__:
+    ansible.module_utils.__path__.append(_MODULE_UTILS)
+
+from ansible.module_utils.mr_provisioner import ProvisionerError, get_client
+from ansible.module_utils.mr_provisioner_machine import (lease_ips,
+                                                         list_machines,
+                                                         remember_machines)
+
+
+class InventoryModule(BaseInventoryPlugin, Constructable):
+
+    NAME = 'mr_provisioner'
+
+    def verify_file(self, path):
+        return (super(InventoryModule, self).verify_file(path) and
+                path.endswith(('mr_provisioner.yml', 'mr_provisioner.yaml')))
+
+    def _templated(self, option):
+        """ The value of option, templated when it is a template, e.g. a
+            lookup of the token """
+        value = self.get_option(option)
+        if self.templar.is_template(value):
+            value = self.templar.template(value)
+        return value
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path, cache)
+        self._read_config_data(path)
+
+        workers = self.get_option('workers')
+        client = get_client(self._templated('url'), self._templated('token'),
+                            pool_size=workers,
+                            connect_timeout=self.get_option('connect_timeout'),
+                            read_timeout=self.get_option('read_timeout'))
+        client.trace_name = 'inventory'
+        try:
+            machines = list_machines(client, self.get_option('show_all'))
+        except ProvisionerError as e:
+            raise AnsibleParserError(str(e))
+        if not self.get_option('show_all'):
+            # The machines assigned to the token's user: the modules need not
+            # look them up by name again
+            remember_machines(client, machines, self.get_option('cache_dir'))
+        wanted = self.get_option('machines')
+        if wanted:
+            machines = [m for m in machines if m['name'] in wanted]
+
+        ips, errors = lease_ips(client, [m['id'] for m in machines],
+                                self.get_option('interface_name'),
+                                self.get_option('lease_ttl'),
+                                self.get_option('cache_dir'), workers)
+        for machine_id, error in sorted(errors.items()):
+            self.display.warning('Could not fetch the interfaces of machine '
+                                 '{}: {}'.format(machine_id, error))
+
+        group = self.inventory.add_group(self.get_option('group'))
+        strict = self.get_option('strict')
+        for machine in machines:
+            host = self.inventory.add_host(machine['name'], group=group)
+            hostvars = dict(mr_provisioner_machine_name=machine['name'],
+                            mr_provisioner_machine_id=machine['id'],
+                            mr_provisioner_machine=machine)
+            if ips.get(machine['id']):
+                hostvars['ansible_host'] = ips[machine['id']]
+            for name, value in hostvars.items():
+                self.inventory.set_variable(host, name, value)
+            self._set_composite_vars(self.get_option('compose'), hostvars,
+                                     host, strict=strict)
+            self._add_host_to_composed_groups(self.get_option('groups'),
+                                              hostvars, host, strict=strict)
+            self._add_host_to_keyed_groups(self.get_option('keyed_groups'),
+                                           hostvars, host, strict=strict)
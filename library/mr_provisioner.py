@@ -0,0 +1,204 @@
+#!/usr/bin/python
+
+# This is a documentation stub: the mr_provisioner task is carried out by
+# action_plugins/mr_provisioner.py on the controller.
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: mr-provisioner
+
+short_description: Upload a machine's images and preseed and provision it,
+    in one controller side task.
+
+description:
+    Implemented:
+        - Upload the kernel and initrd (as mr_provisioner_image does) when
+          their paths are given, concurrently
+        - Upload the preseed (as mr_provisioner_preseed does) when its path
+          is given
+        - Set machine's initrd, kernel, preseed and provision it (as
+          mr_provisioner_machine_provision does, PUTting only the changed
+          parameters, skipping unchanged reprovisions with fingerprint and
+          recording the job for mr_provisioner_provision_status)
+        - Runs as an action plugin, within the controller, with a single
+          HTTP session and a single image and preseed listing. Requires
+          Ansible 2.11 or later.
+    Not implemented:
+        - check mode
+
+options:
+    machine_name:
+        description: Machine name
+        required: true
+    kernel_description:
+        description: kernel description
+        required: true
+    kernel_path:
+        description: Local file path to the kernel, uploaded unless already
+            there. Without it, the kernel must exist.
+        required: false
+    initrd_description:
+        description: initrd description
+        required: true
+    initrd_path:
+        description: Local file path to the initrd, uploaded unless already
+            there. Without it, the initrd must exist.
+        required: false
+    arch:
+        description: Image architecture. e.g. arm64, x86_64
+        required: true
+    subarch:
+        description: Machine subarchitecture. e.g. efi, bios
+        required: true
+    kernel_options:
+        description: kernel boot command line
+        required: false
+    public:
+        description: Make uploaded images public. Default false.
+        required: false
+    known_good:
+        description: Mark uploaded images known good. Default false.
+        required: false
+    preseed_name:
+        description: name of preseed to use.
+        required: true
+    preseed_path:
+        description: Local preseed file, uploaded when its content or
+            metadata differ from the stored preseed. Without it, the preseed
+            must exist.
+        required: false
+    preseed_description:
+        description: Description of the uploaded preseed.
+        required: false
+    preseed_type:
+        description: Type of the uploaded preseed, preseed or kickstart.
+            Default preseed.
+        required: false
+    preseed_public:
+        description: Make the uploaded preseed public. Default false.
+        required: false
+    preseed_known_good:
+        description: Mark the uploaded preseed known good. Default false.
+        required: false
+    workers:
+        description: Number of images uploaded concurrently. Default 2.
+        required: false
+    fingerprint:
+        description: As for mr_provisioner_machine_provision.
+        required: false
+    wave_size:
+        description: As for mr_provisioner_machine_provision.
+        required: false
+    wave_delay:
+        description: As for mr_provisioner_machine_provision.
+        required: false
+    boot_timeout:
+        description: As for mr_provisioner_machine_provision.
+        required: false
+    admission_timeout:
+        description: As for mr_provisioner_machine_provision.
+        required: false
+    interface_name:
+        description: As for mr_provisioner_machine_provision.
+        required: false
+    url:
+        description: url to provisioner instance in the form of http://192.168.0.3:5000/
+        required: true
+    token:
+        description: Mr. Provisioner auth token
+        required: true
+    dedupe:
+        description: As for mr_provisioner_image.
+        required: false
+    on_content_change:
+        description: As for mr_provisioner_image.
+        required: false
+    chunked:
+        description: As for mr_provisioner_image.
+        required: false
+    chunk_size:
+        description: As for mr_provisioner_image.
+        required: false
+    chunk_retries:
+        description: As for mr_provisioner_image.
+        required: false
+    buffer_size:
+        description: As for mr_provisioner_image.
+        required: false
+    compression:
+        description: As for mr_provisioner_image.
+        required: false
+    zero_copy:
+        description: As for mr_provisioner_image.
+        required: false
+    pool_size:
+        description: As for the mr_provisioner modules.
+        required: false
+    connect_timeout:
+        description: As for the mr_provisioner modules.
+        required: false
+    read_timeout:
+        description: As for the mr_provisioner modules.
+        required: false
+    trace_file:
+        description: As for the mr_provisioner modules.
+        required: false
+    retries:
+        description: As for the mr_provisioner modules.
+        required: false
+    retry_interval:
+        description: As for the mr_provisioner modules.
+        required: false
+    retry_deadline:
+        description: As for the mr_provisioner modules.
+        required: false
+    catalog_ttl:
+        description: As for the mr_provisioner modules.
+        required: false
+    cache_dir:
+        description: As for the mr_provisioner modules.
+        required: false
+
+author:
+    - Dan Rue <dan.rue@linaro.org>
+'''
+
+EXAMPLES = '''
+- mr_provisioner:
+    machine_name: "{{ inventory_hostname }}"
+    kernel_description: debian-installer staging build 471
+    kernel_path: ./builds/staging/427/linux
+    initrd_description: debian-installer staging build 471
+    initrd_path: ./builds/staging/427/initrd.gz
+    arch: arm64
+    subarch: efi
+    preseed_name: debian-staging
+    preseed_path: ./preseeds/debian-staging
+    url: http://192.168.0.3:5000/
+    token: "{{ provisioner_auth_token }}"
+'''
+
+RETURN = '''
+images: Results of the kernel and initrd uploads, as returned by
+  mr_provisioner_image with images
+preseed: json (the preseed record), changed, content_changed and sha256
+  of the preseed upload
+machine: the machine record
+machine_state: the machine after setting its parameters
+parameters_changed: names of the machine fields that were PUT
+machine_provision: the machine's state after provisioning
+fingerprint: as returned by mr_provisioner_machine_provision
+provision_skipped: as returned by mr_provisioner_machine_provision
+job: handle of the provisioning, for mr_provisioner_provision_status (not
+  set when provision_skipped)
+admission_wait: seconds waited for admission to PXE boot (wave_size only)
+timings: API calls made by the task, overall and per endpoint template
+  (requests, errors, retries, seconds, max_seconds, bytes_in, bytes_out),
+  and the task's elapsed wall time
+'''
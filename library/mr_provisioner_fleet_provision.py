@@ -0,0 +1,525 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: mr-provisioner-fleet-provision
+
+short_description: Provision many machines in Mr. Provisioner in one task.
+
+description:
+    Implemented:
+        - Resolve the kernel, initrd and preseed once for the whole fleet
+        - Set every machine's initrd, kernel, preseed and PXE boot it, on a
+          bounded pool of concurrent workers
+        - Per-machine results and timings
+        - Upload the kernel, initrd and preseed first when given their
+          paths, as mr_provisioner_image and mr_provisioner_preseed do
+        - Pipelined mode, the default, looking the machines up while the
+          uploads are in flight and configuring them as soon as the
+          kernel, initrd and preseed ids are known
+    Not implemented:
+        - Per-machine kernel/initrd/preseed
+
+options:
+    machines:
+        description: List of machine names
+        required: true
+    kernel_description:
+        description: kernel description
+        required: true
+    initrd_description:
+        description: initrd description
+        required: true
+    arch:
+        description: Image architecture. e.g. arm64, x86_64
+        required: true
+    subarch:
+        description: Machine subarchitecture. e.g. efi, bios
+        required: true
+    preseed_name:
+        description: name of preseed to use.
+        required: true
+    kernel_options:
+        description: kernel boot command line
+        required: false
+    kernel_path:
+        description: Local file path to the kernel, uploaded unless already
+            there. Without it, the kernel must exist.
+        required: false
+    initrd_path:
+        description: Local file path to the initrd, uploaded unless already
+            there. Without it, the initrd must exist.
+        required: false
+    public:
+        description: Make uploaded images public. Default false.
+        required: false
+    known_good:
+        description: Mark uploaded images known good. Default false.
+        required: false
+    preseed_path:
+        description: Local preseed file, uploaded when its content or
+            metadata differ from the stored preseed. Without it, the preseed
+            must exist.
+        required: false
+    preseed_description:
+        description: Description of the uploaded preseed.
+        required: false
+    preseed_type:
+        description: Type of the uploaded preseed. Default preseed.
+        required: false
+    preseed_public:
+        description: Make the uploaded preseed public. Default false.
+        required: false
+    preseed_known_good:
+        description: Mark the uploaded preseed known good. Default false.
+        required: false
+    pipelined:
+        description: Look the machines up while the kernel, initrd and
+            preseed are resolved or uploaded, rather than after. Default
+            true.
+        required: false
+    dedupe:
+        description: As for mr_provisioner_image.
+        required: false
+    on_content_change:
+        description: As for mr_provisioner_image.
+        required: false
+    chunked:
+        description: As for mr_provisioner_image.
+        required: false
+    chunk_size:
+        description: As for mr_provisioner_image.
+        required: false
+    chunk_retries:
+        description: As for mr_provisioner_image.
+        required: false
+    buffer_size:
+        description: As for mr_provisioner_image.
+        required: false
+    compression:
+        description: As for mr_provisioner_image.
+        required: false
+    zero_copy:
+        description: As for mr_provisioner_image.
+        required: false
+    workers:
+        description: Number of machines provisioned concurrently. Default 10.
+        required: false
+    wave_size:
+        description: Admission control of PXE boots across the forks of the
+            play (and the machines of one task). At most wave_size machines
+            are PXE booted and waiting for their lease at once, the others
+            wait for a slot. 0 disables admission control. Default 0.
+        required: false
+    wave_delay:
+        description: Minimum seconds between the start of two waves of
+            wave_size PXE boots. Default 0.
+        required: false
+    boot_timeout:
+        description: Seconds after which an admitted machine frees its slot
+            even if its lease did not appear or change, e.g. with static
+            leases. Default 600.
+        required: false
+    admission_timeout:
+        description: Seconds a machine may wait for admission before
+            failing. Default 3600.
+        required: false
+    interface_name:
+        description: Interface whose lease tells that an admitted machine
+            booted. Its lease before the PXE boot is recorded in the job
+            handle. Default eth1.
+        required: false
+    url:
+        description: url to provisioner instance in the form of http://192.168.0.3:5000/
+        required: true
+    token:
+        description: Mr. Provisioner auth token
+        required: true
+    pool_size:
+        description: Maximum number of keep-alive connections to Mr.
+            Provisioner. Raised to workers if lower.
+        required: false
+    connect_timeout:
+        description: Seconds to wait for a connection. Default 10.
+        required: false
+    read_timeout:
+        description: Seconds to wait for a response. Default 300.
+        required: false
+    trace_file:
+        description: Append a JSON line per API call (method, endpoint,
+            status, bytes, seconds) to this file. Default
+            $MR_PROVISIONER_TRACE_FILE.
+        required: false
+    retries:
+        description: Times a call failing with a connection error or HTTP
+            429/502/503/504 is retried. GETs and PUTs are retried as is;
+            POSTs only after checking they did not take effect. Default 3.
+        required: false
+    retry_interval:
+        description: First delay between retries in seconds, growing
+            exponentially with jitter. Default 1.
+        required: false
+    retry_deadline:
+        description: Seconds after which a failing call is no longer
+            retried. Default 120.
+        required: false
+    catalog_ttl:
+        description: Seconds a cached image/preseed listing is used without
+            revalidating it with the server. Default 60.
+        required: false
+    name_ttl:
+        description: Seconds a machine id resolved from its name is
+            remembered. The machines are looked up together, in one query
+            per 50 names, and a remembered id is checked against that
+            answer, never trusted as is. Default 300.
+        required: false
+    cache_dir:
+        description: Directory of the local catalog and machine id caches.
+            Default $MR_PROVISIONER_CACHE_DIR or ~/.cache/mr_provisioner.
+        required: false
+
+author:
+    - Dan Rue <dan.rue@linaro.org>
+'''
+
+EXAMPLES = '''
+# Reimage a rack
+- mr_provisioner_fleet_provision:
+    machines: "{{ groups['rack3'] }}"
+    kernel_description: debian-installer staging build 495
+    initrd_description: debian-installer staging build 495
+    arch: arm64
+    subarch: efi
+    preseed_name: erp-17.08-generic
+    workers: 20
+    url: http://192.168.0.3:5000/
+    token: "{{ provisioner_auth_token }}"
+  run_once: true
+
+# Upload a new build and reimage the rack with it, looking the machines up
+# during the uploads
+- mr_provisioner_fleet_provision:
+    machines: "{{ groups['rack3'] }}"
+    kernel_description: debian-installer staging build 496
+    kernel_path: ./builds/staging/496/linux
+    initrd_description: debian-installer staging build 496
+    initrd_path: ./builds/staging/496/initrd.gz
+    arch: arm64
+    subarch: efi
+    preseed_name: erp-17.08-generic
+    preseed_path: ./preseeds/erp-17.08-generic
+    url: http://192.168.0.3:5000/
+    token: "{{ provisioner_auth_token }}"
+  run_once: true
+'''
+
+RETURN = '''
+machines:
+  description: One entry per machine, in the order given
+  type: list
+  contains:
+    name: machine name
+    id: machine id
+    ok: true when the machine was set up and PXE booted
+    error: error message when ok is false
+    machine_state: machine as returned by the parameter PUT
+    machine_provision: state as returned by the provision POST
+    job: handle of the provisioning, for mr_provisioner_provision_status
+    timings: seconds spent in lookup, wait (for the kernel, initrd and
+      preseed), set_parameters, admission (wave_size only), provision and
+      total
+failed_machines: names of the machines that failed
+kernel: the kernel image used
+initrd: the initrd image used
+preseed: the preseed used (without its content)
+images: results of the kernel and initrd uploads, when given their paths
+preseed_upload: changed, content_changed and sha256 of the preseed upload,
+  when given its path
+boot_files_seconds: time spent resolving or uploading the kernel, initrd
+  and preseed
+timings: API calls made by the module, overall and per endpoint template
+  (requests, errors, retries, seconds, max_seconds, bytes_in, bytes_out),
+  and the module's elapsed wall time
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.mr_provisioner import (ProvisionerError,
+                                                 client_argument_spec,
+                                                 client_from_module)
+from ansible.module_utils.mr_provisioner_admission import (admission_argument_spec,
+                                                           admission_from_params)
+from ansible.module_utils.mr_provisioner_catalog import (catalog_argument_spec,
+                                                         preseed_catalog)
+from ansible.module_utils.mr_provisioner_machine import (DEFAULT_NAME_TTL,
+                                                         boot_lease,
+                                                         forget_machines,
+                                                         get_image_by_description,
+                                                         get_preseed_by_name,
+                                                         job_handle,
+                                                         machine_argument_spec,
+                                                         machine_provision,
+                                                         record_jobs,
+                                                         resolve_machines,
+                                                         set_machine_parameters)
+from ansible.module_utils.mr_provisioner_preseed import PreseedUploader
+from ansible.module_utils.mr_provisioner_upload import (upload_argument_spec,
+                                                        upload_images)
+
+DEFAULT_WORKERS = 10
+
+
+def lookup_machines(client, names, ttl=DEFAULT_NAME_TTL, cache_dir=None):
+    """ Look the machines up together, the first step of provision_one():
+        one result dict per name """
+    start = time.time()
+    ids, errors = resolve_machines(client, names, ttl, cache_dir)
+    seconds = round(time.time() - start, 3)
+    results = []
+    for name in names:
+        res = dict(name=name, ok=False, timings=dict(lookup=seconds))
+        if name in errors:
+            res['error'] = errors[name]
+        else:
+            res['id'] = ids[name]
+        results.append(res)
+    return results
+
+
+def provision_one(client, name, kernel, initrd, preseed, subarch,
+                  kernel_options, res=None, admission=None,
+                  interface_name='eth1'):
+    """ Look up, configure and PXE boot one machine, or only configure and
+        boot it when given its result of lookup_machines(). Never raises:
+        failures are reported in the returned dict. """
+    if res is None:
+        res = lookup_machines(client, [name])[0]
+    admitted = False
+    if 'error' not in res:
+        step = time.time()
+        try:
+            res['machine_state'] = set_machine_parameters(client,
+                                          machine_id=res['id'],
+                                          initrd_id=initrd['id'],
+                                          kernel_id=kernel['id'],
+                                          kernel_opts=kernel_options,
+                                          preseed_id=preseed['id'],
+                                          subarch=subarch)
+            now = time.time()
+            res['timings']['set_parameters'] = round(now - step, 3)
+            step = now
+
+            if admission:
+                res['timings']['admission'] = admission.acquire(res['id'])
+                admitted = True
+                step = time.time()
+            lease = boot_lease(client, res['id'], interface_name)
+            res['machine_provision'] = machine_provision(client,
+                                                         machine_id=res['id'])
+            res['timings']['provision'] = round(time.time() - step, 3)
+            res['job'] = job_handle(dict(id=res['id'], name=name), lease)
+            res['ok'] = True
+        except ProvisionerError as e:
+            res['error'] = str(e)
+            if admitted:
+                admission.release(res['id'])
+    res['timings']['total'] = round(sum(res['timings'].values()), 3)
+    return res
+
+
+def resolve_boot_files(client, params, warn):
+    """ The kernel, initrd and preseed to boot, uploading those given a
+        path, and what the uploads did """
+    uploaded = {}
+    images = [dict(description=params[prefix + '_description'],
+                   type=image_type, arch=params['arch'],
+                   path=params[prefix + '_path'],
+                   known_good=params['known_good'], public=params['public'])
+              for image_type, prefix in [('Kernel', 'kernel'),
+                                         ('Initrd', 'initrd')]]
+    to_upload = [image for image in images if image['path']]
+    if to_upload:
+        uploaded['images'] = upload_images(client, to_upload, params, warn)
+        failed = [u for u in uploaded['images'] if 'error' in u]
+        if failed:
+            raise ProvisionerError('Failed to upload {}'.format('; '.join(
+                                   '{}: {}'.format(u['description'], u['error'])
+                                   for u in failed)))
+    found = dict((u['type'], u['json']) for u in uploaded.get('images', []))
+    for image in images:
+        if image['type'] not in found:
+            found[image['type']] = get_image_by_description(
+                client, image['type'], image['description'], image['arch'],
+                params['catalog_ttl'], params['cache_dir'])
+
+    if params['preseed_path']:
+        # Revalidated: a stale listing would have an existing preseed
+        # created again
+        uploader = PreseedUploader(params['url'], params['token'],
+                                   params['preseed_path'],
+                                   params['preseed_name'],
+                                   params['preseed_type'],
+                                   params['preseed_description'],
+                                   params['preseed_known_good'],
+                                   params['preseed_public'], client=client,
+                                   cache_dir=params['cache_dir'],
+                                   catalog=preseed_catalog(
+                                       client, 0, params['cache_dir']))
+        preseed = uploader.upload_preseed()
+        if 'error' in preseed:
+            raise ProvisionerError(preseed['error'])
+        uploaded['preseed_upload'] = dict(
+            changed=uploader.changed, content_changed=uploader.content_changed,
+            sha256=uploader.sha256)
+        found['preseed'] = dict(preseed)
+        found['preseed'].pop('content', None)   # we don't need it
+    else:
+        found['preseed'] = get_preseed_by_name(client, params['preseed_name'],
+                                               params['catalog_ttl'],
+                                               params['cache_dir'])
+    return found['Kernel'], found['Initrd'], found['preseed'], uploaded
+
+
+def run_module():
+    module_args = dict(
+        machines=dict(type='list', required=True),
+        kernel_description=dict(type='str', required=True),
+        initrd_description=dict(type='str', required=True),
+        arch=dict(type='str', required=True),
+        subarch=dict(type='str', required=True),
+        preseed_name=dict(type='str', required=True),
+        kernel_options=dict(type='str', required=False),
+        kernel_path=dict(type='str', required=False),
+        initrd_path=dict(type='str', required=False),
+        public=dict(type='bool', required=False, default=False),
+        known_good=dict(type='bool', required=False, default=False),
+        preseed_path=dict(type='str', required=False),
+        preseed_description=dict(type='str', required=False, default=''),
+        preseed_type=dict(type='str', required=False, default='preseed'),
+        preseed_public=dict(type='bool', required=False, default=False),
+        preseed_known_good=dict(type='bool', required=False, default=False),
+        pipelined=dict(type='bool', required=False, default=True),
+        workers=dict(type='int', required=False, default=DEFAULT_WORKERS),
+        url=dict(type='str', required=True),
+        token=dict(type='str', required=True),
+    )
+    module_args.update(upload_argument_spec())
+    module_args.update(client_argument_spec())
+    module_args.update(catalog_argument_spec())
+    module_args.update(admission_argument_spec())
+    module_args.update(machine_argument_spec())
+
+    result = dict(
+        changed=False,
+        machines=[],
+        failed_machines=[],
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    client = client_from_module(module, min_pool_size=module.params['workers'])
+
+    params = module.params
+    admission = admission_from_params(client, params)
+    boot = {}
+    ready = threading.Event()
+
+    # Shared lookups and uploads, once for the whole fleet
+    def resolve():
+        start = time.time()
+        try:
+            (boot['kernel'], boot['initrd'], boot['preseed'],
+             boot['uploaded']) = resolve_boot_files(client, params, module.warn)
+        except Exception as e:
+            # Raised in a thread, it would be lost: reported instead, e.g.
+            # unreadable or non utf-8 files
+            boot['error'] = str(e)
+        finally:
+            # provision() threads wait on ready whatever happened
+            boot['seconds'] = round(time.time() - start, 3)
+            ready.set()
+
+    def provision(lookup, index):
+        res = lookup.get()[index]
+        start = time.time()
+        ready.wait()
+        res['timings']['wait'] = round(time.time() - start, 3)
+        if 'error' in boot:
+            res.setdefault('error', 'Not provisioned: {}'.format(boot['error']))
+        return provision_one(client, res['name'], boot.get('kernel'),
+                             boot.get('initrd'), boot.get('preseed'),
+                             params['subarch'], params['kernel_options'], res,
+                             admission, params['interface_name'])
+
+    if params['pipelined']:
+        thread = threading.Thread(target=resolve)
+        thread.start()
+    else:
+        resolve()
+
+    if not boot.get('error'):
+        # The machines are looked up together, queued ahead of the
+        # configure and boot steps, so that the lookup runs while the
+        # uploads are in flight, and no worker waits on a lookup that is not
+        # running yet
+        pool = ThreadPool(max(1, min(params['workers'],
+                                     len(params['machines']))))
+        try:
+            lookup = pool.apply_async(lookup_machines,
+                                      (client, params['machines'],
+                                       params['name_ttl'], params['cache_dir']))
+            provisions = [pool.apply_async(provision, (lookup, index))
+                          for index in range(len(params['machines']))]
+            result['machines'] = [p.get() for p in provisions]
+        finally:
+            pool.close()
+            pool.join()
+    if params['pipelined']:
+        thread.join()
+    record_jobs(client, [m['job'] for m in result['machines'] if m['ok']],
+                params['cache_dir'])
+    # Their id, possibly cached, may be what failed: resolved again next time
+    forget_machines(client, [m['name'] for m in result.get('machines', [])
+                             if 'id' in m and not m['ok']],
+                    params['cache_dir'])
+
+    if 'error' in boot:
+        module.fail_json(msg=boot['error'], **result)
+    result['kernel'] = boot['kernel']
+    result['initrd'] = boot['initrd']
+    result['preseed'] = boot['preseed']
+    result['boot_files_seconds'] = boot['seconds']
+    result.update(boot['uploaded'])
+    result['failed_machines'] = [m['name'] for m in result['machines'] if not m['ok']]
+    result['changed'] = (any(m['ok'] for m in result['machines']) or
+                         any(i['changed'] for i in result.get('images', [])) or
+                         result.get('preseed_upload', {}).get('changed', False))
+
+    if result['failed_machines']:
+        module.fail_json(msg='Failed to provision {} of {} machines: {}'.format(
+                         len(result['failed_machines']), len(result['machines']),
+                         ', '.join(result['failed_machines'])), **result)
+
+    module.exit_json(**result)
+
+def main():
+    run_module()
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,7 @@
 #!/usr/bin/env python2.7
 # -*- coding: utf-8 -*-
 
-import requests
-import json
-try:
-    from urllib.parse import urljoin
-except ImportError:
-    from urlparse import urljoin
-try:
-        from urllib import quote  # Python 2.X
-except ImportError:
-        from urllib.parse import quote  # Python 3+
+import time
 
 ANSIBLE_METADATA = {
     'metadata_version': '1.1',
@@ -35,6 +26,12 @@ description:
     for it. It should be noted that the current behaviour is of fetching the
     reserved address for an dynamic-reserved interface. If it's static or
     dynamic, the module will fetch the last address given by KEA"
+    - "With a timeout, the module keeps polling until the interface has a
+    lease, backing off between attempts, instead of failing on the first
+    try. Given machine_names, it resolves many machines concurrently over
+    one connection pool and returns a name to IP map. A machine of the list
+    that cannot be found or has no lease does not fail the task: it is
+    left out of the map and reported in errors."
 
 options:
     mrp_url:
@@ -47,12 +44,82 @@ options:
         required: true
     machine_name:
         description:
-            - This is the machine name as shown in MrP
-        required: true
+            - This is the machine name as shown in MrP. Either this or
+              machine_names is required.
+        required: false
+    machine_names:
+        description:
+            - List of machine names, to fetch the IPs of many machines at once.
+        required: false
     interface_name:
         description:
             - This is the name of the machine's interface you'd like the IP of.
-        required: true
+        required: false
+        default: eth1
+    timeout:
+        description:
+            - Seconds to keep polling for a lease before failing. 0 tries
+              once.
+        required: false
+        default: 0
+    interval:
+        description:
+            - First delay between polls, in seconds.
+        required: false
+        default: 5
+    max_interval:
+        description:
+            - Upper bound of the delay between polls, in seconds.
+        required: false
+        default: 60
+    workers:
+        description:
+            - Number of machines polled concurrently with machine_names.
+        required: false
+        default: 10
+    pool_size:
+        description: Maximum number of keep-alive connections to MrP.
+        required: false
+        default: 10
+    connect_timeout:
+        description: Seconds to wait for a connection to MrP.
+        required: false
+        default: 10
+    read_timeout:
+        description: Seconds to wait for MrP to answer a request.
+        required: false
+        default: 300
+    trace_file:
+        description: Append a JSON line per API call (method, endpoint,
+            status, bytes, seconds) to this file. Default
+            $MR_PROVISIONER_TRACE_FILE.
+        required: false
+    retries:
+        description: Times a call failing with a connection error or HTTP
+            429/502/503/504 is retried. GETs and PUTs are retried as is;
+            POSTs only after checking they did not take effect. Default 3.
+        required: false
+    retry_interval:
+        description: First delay between retries in seconds, growing
+            exponentially with jitter. Default 1.
+        required: false
+    retry_deadline:
+        description: Seconds after which a failing call is no longer
+            retried. Default 120.
+        required: false
+    name_ttl:
+        description:
+            - Seconds a machine id resolved from its name is remembered.
+              The names are resolved together, in one query per 50 names,
+              and a remembered id is checked against that answer, never
+              trusted as is.
+        required: false
+        default: 300
+    cache_dir:
+        description:
+            - Directory of the machine id cache. Default
+              $MR_PROVISIONER_CACHE_DIR or ~/.cache/mr_provisioner.
+        required: false
 
 author:
     - Baptiste Gerondeau (baptiste.gerondeau@linaro.org)
@@ -70,78 +137,117 @@ EXAMPLES = '''
 
 #Note that you get the ip fetched via get_ip['ip'] : you NEED to register get_ip
 #This seems overly complicated but I've found no other way to do it...
+
+- name: Get IPs of a whole rack, waiting up to 5 minutes for leases
+  mr_provisioner_get_ip:
+    mrp_url: "{{ mr_provisioner_url }}"
+    mrp_token: "{{ mr_provisioner_auth_token }}"
+    machine_names: "{{ groups['rack3'] }}"
+    timeout: 300
+  register: get_ip
+#get_ip['ips'] maps each machine name to its IP, get_ip['errors'] each machine
+#name without one to the reason
 '''
 
 RETURN = '''
 ip:
-    description: An.... IP !! (v4 because MrP doesn't do v6)
+    description: An.... IP !! (v4 because MrP doesn't do v6). Only with
+        machine_name.
     type: str
+ips:
+    description: Map of machine name to IP. Only with machine_names.
+    type: dict
+errors:
+    description: Map of machine name to the reason its IP could not be
+        fetched, for the machines missing from ips. Only with machine_names.
+    type: dict
+timings:
+    description: API calls made by the module, overall and per endpoint
+        template (requests, errors, retries, seconds, max_seconds,
+        bytes_in, bytes_out), and the module's elapsed wall time.
+    type: dict
 '''
 
 
 from ansible.module_utils.basic import AnsibleModule
-
-class ProvisionerError(Exception):
-    def __init__(self, message):
-        super(ProvisionerError, self).__init__(message)
+from ansible.module_utils.mr_provisioner import (ProvisionerError,
+                                                 client_argument_spec,
+                                                 client_from_module,
+                                                 get_client,
+                                                 run_parallel)
+from ansible.module_utils.mr_provisioner_machine import (forget_machines,
+                                                         get_lease_ip,
+                                                         get_machine_interfaces,
+                                                         machine_argument_spec,
+                                                         resolve_machines)
+from ansible.module_utils.mr_provisioner_poll import (DEFAULT_INTERVAL,
+                                                      DEFAULT_MAX_INTERVAL,
+                                                      Backoff,
+                                                      sleep_until)
 
 class IPGetter(object):
     def __init__(self, mrpurl, mrptoken, machine_id, interface_name =
-                 'eth1'):
+                 'eth1', client=None):
         self.mrp_url = mrpurl
         self.mrp_token = mrptoken
+        self.client = client or get_client(mrpurl, mrptoken)
         self.interface = interface_name
         self.machine_id = machine_id
         self.machine_ip = ''
+        self.error = None
 
     def get_interfaces(self):
-        headers = {'Authorization': self.mrp_token}
-        url = urljoin(self.mrp_url,
-                      "/api/v1/machine/{}/interface".format(self.machine_id))
-        r = requests.get(url, headers=headers)
-        if r.status_code != 200:
-            raise ProvisionerError('Error fetching {}, HTTP {} {}'.format(self.mrp_url, r.status_code,
-                                                         r.reason))
-        if len(r.json()) == 0:
-            raise ProvisionerError('Error no machine with id "{}"'.format(self.machine_id))
-
-        return r.json()
+        return get_machine_interfaces(self.client, self.machine_id)
 
     def get_ip(self):
         try:
             interfaces = self.get_interfaces()
         except ProvisionerError as e:
-            print('Could not fetch interface for machine : "{}"'.format(e))
+            self.error = 'Could not fetch interface for machine : "{}"'.format(e)
             return 'FAILURE'
 
-        for i in interfaces:
-            if str(i['identifier']) == self.interface:
-                    return i['lease_ipv4']
-
-def get_machine_by_name(mrp_token, mrp_url, machine_name):
-    """ Look up machine by name """
-    headers = {'Authorization': mrp_token}
-    q = '(= name "{}")'.format(quote(machine_name))
-    url = urljoin(mrp_url, "/api/v1/machine?q={}&show_all=false".format(q))
-    r = requests.get(url, headers=headers)
-    if r.status_code != 200:
-        raise ProvisionerError('Error fetching {}, HTTP {} {}'.format(mrp_url,
-                         r.status_code, r.reason))
-    if len(r.json()) == 0:
-       raise ProvisionerError('Error no assigned machine found with name "{}"'.
-                    format(machine_name))
-    if len(r.json()) > 1:
-       raise ProvisionerError('Error more than one machine found with name "{}", {}'.
-                    format(machine_name, r.json()))
-    return r.json()[0]
+        self.error = None
+        return get_lease_ip(interfaces, self.interface)
+
+    def poll(self):
+        """ One attempt at fetching the IP; machine_ip is set once the
+            interface has a lease """
+        ip = self.get_ip()
+        if ip and ip != 'FAILURE':
+            self.machine_ip = str(ip)
+        elif ip is None:
+            self.error = 'Interface "{}" has no lease yet'.format(self.interface)
+        return self.machine_ip
+
+def poll_ips(getters, timeout, interval=DEFAULT_INTERVAL,
+             max_interval=DEFAULT_MAX_INTERVAL, workers=1):
+    """ Poll every IPGetter until it has an IP or timeout seconds have
+        passed, backing off between rounds """
+    deadline = time.time() + timeout
+    backoff = Backoff(interval, max_interval)
+    pending = list(getters)
+    while True:
+        run_parallel(lambda g: g.poll(), pending, workers)
+        pending = [g for g in pending if not g.machine_ip]
+        if not pending or time.time() >= deadline:
+            return
+        sleep_until(min(time.time() + backoff.next_delay(), deadline))
 
 def run_module():
     module_args = dict(
         mrp_url = dict(type='str', required=True),
         mrp_token = dict(type='str', required=True),
-        machine_name = dict(type='str', required=True),
-        interface_name = dict(type='str', required=False),
+        machine_name = dict(type='str', required=False),
+        machine_names = dict(type='list', required=False),
+        interface_name = dict(type='str', required=False, default='eth1'),
+        timeout = dict(type='float', required=False, default=0),
+        interval = dict(type='float', required=False, default=DEFAULT_INTERVAL),
+        max_interval = dict(type='float', required=False,
+                            default=DEFAULT_MAX_INTERVAL),
+        workers = dict(type='int', required=False, default=10),
     )
+    module_args.update(client_argument_spec())
+    module_args.update(machine_argument_spec())
 
     result = dict(
         changed=False,
@@ -150,35 +256,62 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[['machine_name', 'machine_names']],
+        mutually_exclusive=[['machine_name', 'machine_names']],
         supports_check_mode=True,
     )
 
     if module.check_mode:
-        return result
-
-    machine_id = get_machine_by_name(module.params['mrp_token'],
-                                     module.params['mrp_url'],
-                                     module.params['machine_name'])['id']
+        module.exit_json(**result)
 
-    if module.params['interface_name']:
-        ipgetter = IPGetter(module.params['mrp_url'], module.params['mrp_token'],
-                            machine_id,
-                            module.params['interface_name'])
+    batch = module.params['machine_names'] is not None
+    if batch:
+        names = module.params['machine_names']
     else:
-        ipgetter = IPGetter(module.params['mrp_url'], module.params['mrp_token'],
-                            machine_id)
-    try:
-        machine_ip = str(ipgetter.get_ip())
-    except ProvisionerError as e:
-        module.fail_json(msg='Could not get IP error : "{}"'.format(e),
-                         **result)
-
-    if machine_ip:
-        result['ip'] = machine_ip
-        result['json'] = { 'status': 'ok' }
-        result['changed'] = True
+        names = [module.params['machine_name']]
+
+    client = client_from_module(module, 'mrp_url', 'mrp_token',
+                                min_pool_size=module.params['workers'])
+
+    ids, errors = resolve_machines(client, names, module.params['name_ttl'],
+                                   module.params['cache_dir'])
+    if errors and not batch:
+        module.fail_json(msg=errors[names[0]], **result)
+    # A machine that cannot be found is reported in errors, the others are
+    # still polled
+    names = [name for name in names if name not in errors]
+
+    getters = [IPGetter(module.params['mrp_url'], module.params['mrp_token'],
+                        ids[name], module.params['interface_name'],
+                        client=client)
+               for name in names]
+    poll_ips(getters, module.params['timeout'], module.params['interval'],
+             module.params['max_interval'], module.params['workers'])
+
+    missing = [name for name, getter in zip(names, getters)
+               if not getter.machine_ip]
+    if missing:
+        # A cached id may no longer be that machine's: resolved again next
+        # time
+        forget_machines(client, missing, module.params['cache_dir'])
+        errors.update((name, getter.error)
+                      for name, getter in zip(names, getters)
+                      if not getter.machine_ip)
+
+    if batch:
+        result['ips'] = dict((name, getter.machine_ip)
+                             for name, getter in zip(names, getters)
+                             if getter.machine_ip)
+        result['errors'] = errors
+    elif missing:
+        result['debug']['errors'] = errors
+        module.fail_json(msg='Failure to fetch IP from MrP for: {}'.format(
+                         ', '.join(missing)), **result)
     else:
-        module.fail_json(msg='Failure to fetch IP from MrP', **result)
+        result['ip'] = getters[0].machine_ip
+
+    result['json'] = { 'status': 'ok' }
+    result['changed'] = True
 
     module.exit_json(**result)
 
@@ -1,16 +1,8 @@
 #!/usr/bin/python
 
-import json
-import requests
-
 from future.standard_library import install_aliases
 install_aliases()
 
-try:
-    from urlparse import urljoin    #Python2
-except ImportError:
-    from urllib.parse import urljoin    #Python3
-
 ANSIBLE_METADATA = {
     'metadata_version': '1.1',
     'status': ['preview'],
@@ -27,25 +19,39 @@ description:
     Implemented:
         - Upload new image
         - Discover existing images matching a given description.
+        - Skip the upload when an image with identical content (SHA-256)
+          already exists. An image whose content changed is kept, with a
+          warning, unless on_content_change says otherwise.
+        - Upload a list of images (e.g. a kernel and its initrd) in one task,
+          resolving them against a single image listing and streaming the
+          uploads concurrently.
     Not implemented:
         - modifying existing image (such as known_good/public)
-        - deleting existing image
 
 options:
     description:
         description:
-            - Name of the image
-        required: true
+            - Name of the image. Required unless images is given.
+        required: false
     type:
         description:
             - Image type. May be 'Kernel' or 'Initrd'.
-        required: true
+        required: false
     arch:
         description: Image architecture. e.g. arm64, x86_64
-        required: true
+        required: false
     path:
         description: Local file path to image file.
-        required: true
+        required: false
+    images:
+        description: List of images to upload concurrently, each a dict of
+            description, type, arch, path, known_good and public. Keys left
+            out default to the module's options of the same name.
+        required: false
+    workers:
+        description: Number of images of the images list uploaded
+            concurrently. Default 4.
+        required: false
     url:
         description: url to provisioner instance in the form of http://192.168.0.3:5000/
         required: true
@@ -58,6 +64,88 @@ options:
     public:
         description: Mark public. Default false.
         required: false
+    dedupe:
+        description: Reuse an existing image of the same type and arch with
+            identical content, even under another description, instead of
+            uploading it again. The reused image is returned in json, and
+            no image is then created under this description, so only use it
+            when the image is passed on by id, not looked up again by
+            description (as the role's mr_provisioner_machine_provision
+            task does). mr_provisioner_fleet_provision and the
+            mr_provisioner action use the returned image. Default false.
+        required: false
+    on_content_change:
+        description: What to do when an image with this description exists
+            but its content differs from the local file. 'keep' leaves the
+            old image in place, with a warning, 'fail' fails the task,
+            'replace' uploads the file and deletes the old image, failing
+            instead when a machine (of any user) is set to boot the old
+            image. Default keep.
+        required: false
+    cache_dir:
+        description: Directory holding the local digest and catalog caches.
+            Default $MR_PROVISIONER_CACHE_DIR or ~/.cache/mr_provisioner.
+        required: false
+    catalog_ttl:
+        description: Seconds a cached image listing is used without
+            revalidating it with the server. Default 60.
+        required: false
+    chunked:
+        description: Upload in chunks that are acknowledged one at a time,
+            retrying and resuming from the last acknowledged offset when the
+            connection drops. Interrupted uploads are resumed by the next
+            run. Requires the server's /api/v1/image/upload endpoint.
+            Default false.
+        required: false
+    chunk_size:
+        description: Chunk size in bytes for chunked uploads. Default 8 MiB.
+        required: false
+    chunk_retries:
+        description: Attempts per chunk before a chunked upload gives up.
+            Default 5.
+        required: false
+    buffer_size:
+        description: Read buffer size in bytes used while streaming the
+            image to Mr. Provisioner. Default 65536.
+        required: false
+    compression:
+        description: Compress images on the fly, sent with a Content-Encoding,
+            if the server accepts it. One of none, auto (zstd when the
+            zstandard library is installed, else gzip), gzip or zstd.
+            Images already compressed are sent as they are. Default none.
+        required: false
+    zero_copy:
+        description: Send uncompressed uploads with os.sendfile(), or from a
+            memory map over https, rather than through Python read buffers.
+            Uploads through a proxy always use read buffers. Default true.
+        required: false
+    pool_size:
+        description: Maximum number of keep-alive connections to Mr. Provisioner.
+        required: false
+    connect_timeout:
+        description: Seconds to wait for a connection. Default 10.
+        required: false
+    read_timeout:
+        description: Seconds to wait for a response. Default 300.
+        required: false
+    trace_file:
+        description: Append a JSON line per API call (method, endpoint,
+            status, bytes, seconds) to this file. Default
+            $MR_PROVISIONER_TRACE_FILE.
+        required: false
+    retries:
+        description: Times a call failing with a connection error or HTTP
+            429/502/503/504 is retried. GETs and PUTs are retried as is;
+            POSTs only after checking they did not take effect. Default 3.
+        required: false
+    retry_interval:
+        description: First delay between retries in seconds, growing
+            exponentially with jitter. Default 1.
+        required: false
+    retry_deadline:
+        description: Seconds after which a failing call is no longer
+            retried. Default 120.
+        required: false
 
 author:
     - Dan Rue <dan.rue@linaro.org>
@@ -71,9 +159,22 @@ EXAMPLES = '''
   path: ./builds/staging/427/linux
   url: http://192.168.0.3:5000/
   token: "{{ provisioner_auth_token }}"
+
+# Upload a kernel and its initrd concurrently
+- images:
+    - description: debian-installer staging build 471
+      type: Kernel
+      path: ./builds/staging/427/linux
+    - description: debian-installer staging build 471
+      type: Initrd
+      path: ./builds/staging/427/initrd.gz
+  arch: arm64
+  url: http://192.168.0.3:5000/
+  token: "{{ provisioner_auth_token }}"
 '''
 
 RETURN = '''
+json:
   id: auto-assigned image id
   description: image description
   name: auto-assigned image name
@@ -83,23 +184,62 @@ RETURN = '''
   known_good: true/false
   public: true/false
   arch: arm64
+sha256: SHA-256 of the local image file
+deduplicated: true when an existing image with identical content was reused
+content_changed: true when the existing image's content differed from the file
+upload:
+  engine: how the image was sent, one of sendfile, mmap, stream, gzip,
+    zstd or chunked (only set when uploading)
+  content_encoding: identity, gzip or zstd
+  size: bytes of the image file
+  bytes_sent: bytes of request body sent
+  ratio: bytes_sent / size
+  seconds: wall time of the upload
+  throughput_bps: bytes_sent / seconds
+  effective_bps: size / seconds
+images:
+  description: With images only. One result per image, in the order given,
+    each with the keys above plus description, type, arch, changed and
+    error.
+  type: list
+failed_images: With images only. Descriptions of the images that failed.
+timings: API calls made by the module, overall and per endpoint template
+  (requests, errors, retries, seconds, max_seconds, bytes_in, bytes_out),
+  and the module's elapsed wall time
 '''
 
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.mr_provisioner import (ProvisionerError,
+                                                 client_argument_spec,
+                                                 client_from_module)
+from ansible.module_utils.mr_provisioner_catalog import catalog_argument_spec
+from ansible.module_utils.mr_provisioner_upload import (IMAGE_FIELDS,
+                                                        QueryLookup,
+                                                        upload_argument_spec,
+                                                        upload_image,
+                                                        upload_images)
+
+DEFAULT_WORKERS = 4
+
 
 def run_module():
     # define the available arguments/parameters that a user can pass to
     # the module
     module_args = dict(
-        description=dict(type='str', required=True),
-        type=dict(type='str', required=True),
-        arch=dict(type='str', required=True),
-        path=dict(type='str', required=True),
+        description=dict(type='str', required=False),
+        type=dict(type='str', required=False),
+        arch=dict(type='str', required=False),
+        path=dict(type='str', required=False),
+        images=dict(type='list', required=False),
+        workers=dict(type='int', required=False, default=DEFAULT_WORKERS),
         url=dict(type='str', required=True),
         token=dict(type='str', required=True),
         known_good=dict(type='bool', required=False, default=False),
         public=dict(type='bool', required=False, default=False),
     )
+    module_args.update(upload_argument_spec())
+    module_args.update(client_argument_spec())
+    module_args.update(catalog_argument_spec())
 
     result = dict(
         changed=False
@@ -107,63 +247,57 @@ def run_module():
 
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[['description', 'images']],
+        mutually_exclusive=[['description', 'images']],
         supports_check_mode=True
     )
 
     if module.check_mode:
-        return result
-
-    allowed_types = ["Kernel", "Initrd"]
-    if module.params['type'] not in allowed_types:
-        module.fail_json(msg="error: type is '{}'; must be one of {}".format(
-                         module.params['type'], allowed_types), **result)
-
-    # Determine if image is already uploaded
-    headers = {'Authorization': module.params['token']}
-    url = urljoin(module.params['url'], "/api/v1/image?show_all=true")
-    r = requests.get(url, headers=headers)
-    if r.status_code != 200:
-        module.fail_json(msg='Error fetching {}, HTTP {} {}'.format(url,
-                         r.status_code, r.reason), **result)
-    for image in r.json():
-        if (image['description'] == module.params['description'] and
-            image['type'] == module.params['type'] and
-            image['arch'] == module.params['arch']):
-                #XXX Not implemented: modify existing image
-                result['json'] = image
-                module.exit_json(**result)
-
-    # Image does not yet exist. Upload it.
-    # curl -X POST "http://192.168.0.3:5000/api/v1/image"
-    # -H "accept: application/json"
-    # -H "Authorization: DEADBEEF"
-    # -H "content-type: multipart/form-data"
-    # -F "file=@linux;type="
-    # -F "q={ "description": "Example image",
-    #         "type": "Kernel",
-    #         "public": false,
-    #         "known_good": true } "
-    headers = {'Authorization': module.params['token']}
-    url = urljoin(module.params['url'], "/api/v1/image")
-    files = {'file': open(module.params['path'], 'rb')}
-    data = {'q': json.dumps({
-                 'description': module.params['description'],
-                 'type': module.params['type'],
-                 'arch': module.params['arch'],
-                 'known_good': module.params['known_good'],
-                 'public': module.params['public'],
-             })
-           }
-    r = requests.post(url, files=files, data=data, headers=headers)
-    if r.status_code != 201:
-        msg = ("Error fetching {}, HTTP {} {}\nrequest data: {}\nresult json: {}".
-                format(url, r.status_code, r.reason, data, r.json()))
-        module.fail_json(msg=msg, **result)
-    result['json'] = r.json()
-    result['changed'] = True
-
-    # in the event of a successful module execution, you will want to
-    # simple AnsibleModule.exit_json(), passing the key/value results
+        module.exit_json(**result)
+
+    specs = module.params['images'] or [{}]
+    images = []
+    for spec in specs:
+        if not isinstance(spec, dict):
+            module.fail_json(msg='images must be a list of dicts, got {}'.
+                             format(spec), **result)
+        image = dict((field, spec.get(field, module.params[field]))
+                     for field in IMAGE_FIELDS)
+        missing = [field for field in ['description', 'type', 'arch', 'path']
+                   if image[field] is None]
+        if missing:
+            module.fail_json(msg='Missing {} for image {}'.format(
+                             ', '.join(missing), spec or image), **result)
+        images.append(image)
+
+    if module.params['images'] is None:
+        client = client_from_module(module)
+        lookup = QueryLookup(client, module.params['catalog_ttl'],
+                             module.params['cache_dir'])
+        try:
+            upload_image(client, images[0], lookup, module.params, result,
+                         module.warn)
+        except ProvisionerError as e:
+            module.fail_json(msg=str(e), **result)
+        # in the event of a successful module execution, you will want to
+        # simple AnsibleModule.exit_json(), passing the key/value results
+        module.exit_json(**result)
+
+    client = client_from_module(module, min_pool_size=module.params['workers'])
+    try:
+        result['images'] = upload_images(client, images, module.params,
+                                         module.warn)
+    except ProvisionerError as e:
+        module.fail_json(msg=str(e), **result)
+    result['changed'] = any(i['changed'] for i in result['images'])
+    result['failed_images'] = [i['description'] for i in result['images']
+                               if 'error' in i]
+    if result['failed_images']:
+        module.fail_json(msg='Failed to upload {} of {} images: {}'.format(
+                         len(result['failed_images']), len(images),
+                         '; '.join('{}: {}'.format(i['description'], i['error'])
+                                   for i in result['images'] if 'error' in i)),
+                         **result)
     module.exit_json(**result)
 
 def main():
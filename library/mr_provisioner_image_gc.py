@@ -0,0 +1,292 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: mr-provisioner-image-gc
+
+short_description: Delete old images from Mr. Provisioner
+
+description:
+    - Applies a retention policy to the images of Mr. Provisioner, so that
+      the image listing every lookup scans does not keep growing with each
+      build uploaded.
+    - Only the images whose description starts with one of the given
+      prefixes are managed; all others are left alone. They are grouped by
+      type, arch and prefix, and the keep most recent ones of each group
+      (by upload date) are kept. Older ones are deleted, unless they are
+      known good or a machine still boots them.
+    - The machines are listed again before each batch of deletions, so
+      that an image a machine was just set to boot is not deleted.
+    - Check mode returns the plan without deleting anything.
+
+options:
+    keep:
+        description: Number of most recent images kept per type, arch and
+            description prefix. Default 5.
+        required: false
+    prefixes:
+        description: Description prefixes images are grouped by, e.g.
+            "debian-installer staging build". Images whose description
+            starts with none of them are left alone.
+        required: true
+    keep_known_good:
+        description: Never delete images marked known good. Default true.
+        required: false
+    show_all:
+        description: Consider the images of all users, rather than those of
+            the token's user. Default false.
+        required: false
+    batch_size:
+        description: Number of images deleted per batch. Default 20.
+        required: false
+    workers:
+        description: Number of images of a batch deleted concurrently.
+            Default 10.
+        required: false
+    url:
+        description: url to provisioner instance in the form of http://192.168.0.3:5000/
+        required: true
+    token:
+        description: Mr. Provisioner auth token
+        required: true
+    pool_size:
+        description: Maximum number of keep-alive connections to Mr. Provisioner.
+        required: false
+    connect_timeout:
+        description: Seconds to wait for a connection. Default 10.
+        required: false
+    read_timeout:
+        description: Seconds to wait for a response. Default 300.
+        required: false
+    trace_file:
+        description: Append a JSON line per API call (method, endpoint,
+            status, bytes, seconds) to this file. Default
+            $MR_PROVISIONER_TRACE_FILE.
+        required: false
+    retries:
+        description: Times a call failing with a connection error or HTTP
+            429/502/503/504 is retried. GETs and PUTs are retried as is;
+            POSTs only after checking they did not take effect. Default 3.
+        required: false
+    retry_interval:
+        description: First delay between retries in seconds, growing
+            exponentially with jitter. Default 1.
+        required: false
+    retry_deadline:
+        description: Seconds after which a failing call is no longer
+            retried. Default 120.
+        required: false
+    cache_dir:
+        description: Directory of the local catalog and digest caches,
+            cleared of the deleted images. Default $MR_PROVISIONER_CACHE_DIR
+            or ~/.cache/mr_provisioner.
+        required: false
+
+author:
+    - Dan Rue <dan.rue@linaro.org>
+'''
+
+EXAMPLES = '''
+# Keep the last 10 staging builds of each arch, and the known good ones
+- mr_provisioner_image_gc:
+    keep: 10
+    prefixes:
+      - debian-installer staging build
+    url: http://192.168.0.3:5000/
+    token: "{{ provisioner_auth_token }}"
+  check_mode: true
+  register: gc_plan
+'''
+
+RETURN = '''
+plan:
+  description: What the policy does with the images considered
+  contains:
+    delete: images to delete, each with id, description, type, arch,
+      upload_date and size
+    kept: number of images kept, by reason (recent, known_good,
+      referenced, unmanaged)
+deleted: ids of the images deleted
+failed_deletes: images that could not be deleted, with their error
+freed_bytes: total size of the deleted images, when the server reports it
+timings: API calls made by the module, overall and per endpoint template
+  (requests, errors, retries, seconds, max_seconds, bytes_in, bytes_out),
+  and the module's elapsed wall time
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.mr_provisioner import (ProvisionerError,
+                                                 client_argument_spec,
+                                                 client_from_module,
+                                                 run_parallel)
+from ansible.module_utils.mr_provisioner_catalog import (IMAGE_LISTING,
+                                                         fetch_listing,
+                                                         image_query,
+                                                         invalidate)
+from ansible.module_utils.mr_provisioner_machine import image_references
+from ansible.module_utils.mr_provisioner_upload import forget_uploads
+
+DEFAULT_KEEP = 5
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_WORKERS = 10
+OWN_IMAGES = '/api/v1/image?show_all=false'
+PLAN_FIELDS = ['id', 'description', 'type', 'arch', 'upload_date', 'size']
+
+
+def group_of(description, prefixes):
+    """ Description prefix an image is grouped by, None if it is left
+        alone """
+    matching = [p for p in prefixes if description.startswith(p)]
+    return max(matching, key=len) if matching else None
+
+
+def referenced_images(client):
+    """ Ids of the kernels and initrds machines are set to boot """
+    return set(image_references(client))
+
+
+def plan_gc(images, referenced, keep, prefixes, keep_known_good):
+    """ Images to delete, most recent last, and the number kept by reason """
+    kept = dict(recent=0, known_good=0, referenced=0, unmanaged=0)
+    groups = {}
+    for image in images:
+        group = group_of(image.get('description') or '', prefixes)
+        if group is None:
+            kept['unmanaged'] += 1
+            continue
+        groups.setdefault((image['type'], image['arch'], group),
+                          []).append(image)
+
+    delete = []
+    for key in sorted(groups):
+        ordered = sorted(groups[key], reverse=True,
+                         key=lambda i: (i.get('upload_date') or '', i['id']))
+        kept['recent'] += len(ordered[:keep])
+        for image in ordered[keep:]:
+            if keep_known_good and image.get('known_good'):
+                kept['known_good'] += 1
+            elif image['id'] in referenced:
+                kept['referenced'] += 1
+            else:
+                delete.append(image)
+    return delete, kept
+
+
+def delete_image(client, image):
+    """ DELETE image, returning the error met, if any. An image already
+        gone counts as deleted. """
+    url = '/api/v1/image/{}'.format(image['id'])
+    try:
+        r = client.delete(url)
+    except ProvisionerError as e:
+        return str(e)
+    if r.status_code not in [200, 202, 204, 404]:
+        return 'Error DELETE {}, HTTP {} {}'.format(client.url_for(url),
+                                                   r.status_code, r.reason)
+    return None
+
+
+def run_module():
+    module_args = dict(
+        keep=dict(type='int', required=False, default=DEFAULT_KEEP),
+        prefixes=dict(type='list', required=True),
+        keep_known_good=dict(type='bool', required=False, default=True),
+        show_all=dict(type='bool', required=False, default=False),
+        batch_size=dict(type='int', required=False, default=DEFAULT_BATCH_SIZE),
+        workers=dict(type='int', required=False, default=DEFAULT_WORKERS),
+        url=dict(type='str', required=True),
+        token=dict(type='str', required=True),
+        cache_dir=dict(type='path', required=False),
+    )
+    module_args.update(client_argument_spec())
+
+    result = dict(
+        changed=False,
+        deleted=[],
+        failed_deletes=[],
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+    params = module.params
+    if params['keep'] < 0 or params['batch_size'] < 1:
+        module.fail_json(msg='keep must be 0 or more and batch_size 1 or '
+                             'more', **result)
+    # An empty prefix would manage every image
+    prefixes = [p for p in params['prefixes'] if p]
+    if not prefixes:
+        module.fail_json(msg='prefixes must list at least one description '
+                             'prefix', **result)
+
+    client = client_from_module(module, min_pool_size=params['workers'])
+    try:
+        images = fetch_listing(client,
+                               IMAGE_LISTING if params['show_all']
+                               else OWN_IMAGES, 0, params['cache_dir'])
+        referenced = referenced_images(client)
+    except ProvisionerError as e:
+        module.fail_json(msg=str(e), **result)
+
+    delete, kept = plan_gc(images, referenced, params['keep'],
+                           prefixes, params['keep_known_good'])
+    result['plan'] = dict(delete=[dict((f, i.get(f)) for f in PLAN_FIELDS)
+                                  for i in delete], kept=kept)
+    if module.check_mode or not delete:
+        result['changed'] = bool(delete)
+        module.exit_json(**result)
+
+    deleted = []
+    for start in range(0, len(delete), params['batch_size']):
+        batch = delete[start:start + params['batch_size']]
+        if start:
+            # A machine may have been set to boot one of them meanwhile
+            try:
+                referenced = referenced_images(client)
+            except ProvisionerError as e:
+                result['failed_deletes'].extend(
+                    dict(id=i['id'], description=i['description'],
+                         error=str(e)) for i in delete[start:])
+                break
+            batch = [i for i in batch if i['id'] not in referenced]
+        errors = run_parallel(lambda i: delete_image(client, i), batch,
+                              params['workers'])
+        for image, error in zip(batch, errors):
+            if error:
+                result['failed_deletes'].append(dict(
+                    id=image['id'], description=image['description'],
+                    error=error))
+            else:
+                deleted.append(image)
+
+    result['deleted'] = [i['id'] for i in deleted]
+    result['changed'] = bool(deleted)
+    if any(i.get('size') is not None for i in deleted):
+        result['freed_bytes'] = sum(i.get('size') or 0 for i in deleted)
+    if deleted:
+        forget_uploads(params['url'], result['deleted'], params['cache_dir'])
+        paths = set([IMAGE_LISTING, OWN_IMAGES])
+        for i in deleted:
+            paths.add(image_query(i['type'], i['arch']))
+            paths.add(image_query(i['type'], i['arch'], i['description']))
+        for path in sorted(paths):
+            invalidate(client, path, params['cache_dir'])
+
+    if result['failed_deletes']:
+        module.fail_json(msg='Failed to delete {} of {} images'.format(
+                         len(result['failed_deletes']), len(delete)), **result)
+    module.exit_json(**result)
+
+def main():
+    run_module()
+
+if __name__ == '__main__':
+    main()
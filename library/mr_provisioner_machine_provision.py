@@ -1,21 +1,8 @@
 #!/usr/bin/python
 
-import json
-import requests
-
 from future.standard_library import install_aliases
 install_aliases()
 
-try:
-    from urlparse import urljoin    #Python2
-except ImportError:
-    from urllib.parse import urljoin    #Python3
-
-try:
-    from urllib import quote
-except ImportError:
-    from urllib.parse import quote
-
 ANSIBLE_METADATA = {
     'metadata_version': '1.1',
     'status': ['preview'],
@@ -30,9 +17,14 @@ short_description: Provision a machine in Mr. Provisioner.
 
 description:
     Implemented:
-        - Set machine's initrd, kernel
+        - Set machine's initrd, kernel, only sending the parameters that
+          differ from the machine's current ones
         - Provision machine
-        - Wait for machine to come online
+        - With fingerprint, skip provisioning a machine last provisioned
+          (by this module, from this controller) with the very same kernel,
+          initrd, preseed, kernel options and subarch
+        - Return as soon as the PXE boot is accepted, with a job handle
+          that mr_provisioner_provision_status follows afterwards
     Not implemented:
         -
         -
@@ -59,126 +51,150 @@ options:
     kernel_options:
         description: kernel boot command line
         required: false
+    fingerprint:
+        description: Remember on the controller the kernel, initrd and
+            preseed records (and preseed content digest), kernel options and
+            subarch each machine is provisioned with, and do not provision a
+            machine again when they are all the same as last time and its
+            parameters are already set. Default false.
+        required: false
+    wave_size:
+        description: Admission control of PXE boots across the forks of the
+            play (and the machines of one task). At most wave_size machines
+            are PXE booted and waiting for their lease at once, the others
+            wait for a slot. 0 disables admission control. Default 0.
+        required: false
+    wave_delay:
+        description: Minimum seconds between the start of two waves of
+            wave_size PXE boots. Default 0.
+        required: false
+    boot_timeout:
+        description: Seconds after which an admitted machine frees its slot
+            even if its lease did not appear or change, e.g. with static
+            leases. Default 600.
+        required: false
+    admission_timeout:
+        description: Seconds a machine may wait for admission before
+            failing. Default 3600.
+        required: false
+    interface_name:
+        description: Interface whose lease tells that an admitted machine
+            booted. Its lease before the PXE boot is recorded in the job
+            handle. Default eth1.
+        required: false
     url:
         description: url to provisioner instance in the form of http://192.168.0.3:5000/
         required: true
     token:
         description: Mr. Provisioner auth token
         required: true
+    pool_size:
+        description: Maximum number of keep-alive connections to Mr. Provisioner.
+        required: false
+    connect_timeout:
+        description: Seconds to wait for a connection. Default 10.
+        required: false
+    read_timeout:
+        description: Seconds to wait for a response. Default 300.
+        required: false
+    trace_file:
+        description: Append a JSON line per API call (method, endpoint,
+            status, bytes, seconds) to this file. Default
+            $MR_PROVISIONER_TRACE_FILE.
+        required: false
+    retries:
+        description: Times a call failing with a connection error or HTTP
+            429/502/503/504 is retried. GETs and PUTs are retried as is;
+            POSTs only after checking they did not take effect. Default 3.
+        required: false
+    retry_interval:
+        description: First delay between retries in seconds, growing
+            exponentially with jitter. Default 1.
+        required: false
+    retry_deadline:
+        description: Seconds after which a failing call is no longer
+            retried. Default 120.
+        required: false
+    catalog_ttl:
+        description: Seconds a cached image/preseed listing is used without
+            revalidating it with the server. Default 60.
+        required: false
+    cache_dir:
+        description: Directory of the local catalog, fingerprint, job and
+            admission caches.
+            Default $MR_PROVISIONER_CACHE_DIR or ~/.cache/mr_provisioner.
+        required: false
 
 author:
     - Dan Rue <dan.rue@linaro.org>
 '''
 
 EXAMPLES = '''
-
+# Provision a machine unless it already runs this very build
+- mr_provisioner_machine_provision:
+    machine_name: "{{ inventory_hostname }}"
+    kernel_description: debian-installer staging build 471
+    initrd_description: debian-installer staging build 471
+    arch: arm64
+    subarch: efi
+    preseed_name: debian-staging
+    fingerprint: true
+    url: http://192.168.0.3:5000/
+    token: "{{ provisioner_auth_token }}"
+  register: provisioned
+
+# Do something else meanwhile, then follow the installation
+- mr_provisioner_provision_status:
+    jobs:
+      - "{{ provisioned.job }}"
+    timeout: 3600
+    url: http://192.168.0.3:5000/
+    token: "{{ provisioner_auth_token }}"
 '''
 
 RETURN = '''
-
+parameters_changed: Names of the machine fields that were PUT, empty when
+  they already had the requested values
+fingerprint: SHA-256 of the kernel, initrd, preseed, kernel options and
+  subarch provisioned
+job:
+  description: Handle of the provisioning, to pass to
+    mr_provisioner_provision_status (not set when provision_skipped)
+  contains:
+    machine_id: machine id
+    machine_name: machine name
+    started: epoch seconds the PXE boot was accepted
+    boot_lease: lease address of interface_name before the PXE boot, null
+      when it had none (not set when it could not be fetched)
+admission_wait: seconds waited for admission to PXE boot (wave_size
+  only)
+provision_skipped: true when the machine was not provisioned again, as it
+  was last provisioned with the same fingerprint (fingerprint only)
+timings: API calls made by the module, overall and per endpoint template
+  (requests, errors, retries, seconds, max_seconds, bytes_in, bytes_out),
+  and the module's elapsed wall time
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-
-class ProvisionerError(Exception):
-    def __init__(self, message):
-        super(ProvisionerError, self).__init__(message)
-
-
-def machine_provision(url, token, machine_id):
-    """ enables netboot on the machine and pxe boots it """
-    headers = {'Authorization': token}
-    url = urljoin(url, "/api/v1/machine/{}/state".format(machine_id))
-
-    data = json.dumps({'state': 'provision'})
-
-    r = requests.post(url, headers=headers, data=data)
-
-    if r.status_code not in [200, 202]:
-        raise ProvisionerError('Error PUTing {}, HTTP {} {}'.format(url,
-                         r.status_code, r.reason))
-    return r.json()
-
-
-def set_machine_parameters(url, token, machine_id, initrd_id=None,
-                           kernel_id=None, kernel_opts="", preseed_id=None, subarch=None):
-    """ Set parameters on machine specified by machine_id """
-    headers = {'Authorization': token}
-    url = urljoin(url, "/api/v1/machine/{}".format(machine_id))
-
-    parameters = {}
-    if initrd_id:
-        parameters['initrd_id'] = initrd_id
-    if kernel_id:
-        parameters['kernel_id'] = kernel_id
-    if preseed_id:
-        parameters['preseed_id'] = preseed_id
-    if subarch:
-        parameters['subarch'] = subarch
-    if kernel_opts:
-        parameters['kernel_opts'] = kernel_opts
-
-    parameters['netboot_enabled'] = True
-
-    data = json.dumps(parameters)
-
-    r = requests.put(url, headers=headers, data=data)
-
-    if r.status_code != 200:
-        raise ProvisionerError('Error PUT {}, HTTP {} {}'.format(url,
-                         r.status_code, r.reason))
-    return r.json()
-
-def get_machine_by_name(url, token, machine_name):
-    """ Look up machine by name """
-    headers = {'Authorization': token}
-    q = '(= name "{}")'.format(quote(machine_name))
-    url = urljoin(url, "/api/v1/machine?q={}&show_all=false".format(q))
-    r = requests.get(url, headers=headers)
-    if r.status_code != 200:
-        raise ProvisionerError('Error fetching {}, HTTP {} {}'.format(url,
-                         r.status_code, r.reason))
-    if len(r.json()) == 0:
-        raise ProvisionerError('Error no assigned machine found with name "{}"'.
-                format(machine_name))
-    if len(r.json()) > 1:
-        raise ProvisionerError('Error more than one machine found with name "{}", {}'.
-                format(machine_name, r.json()))
-    return r.json()[0]
-
-def get_preseed_by_name(url, token, preseed_name):
-    """ Look up preseed by name """
-    headers = {'Authorization': token}
-    url = urljoin(url, "/api/v1/preseed?show_all=true")
-    r = requests.get(url, headers=headers)
-    if r.status_code != 200:
-        raise ProvisionerError('Error fetching {}, HTTP {} {}'.format(url,
-                         r.status_code, r.reason))
-    for preseed in r.json():
-        if preseed['name'] == preseed_name:
-            del preseed['content'] # we don't need it, and it's really big
-            return preseed
-
-    raise ProvisionerError('Error no preseed found with name "{}"'.
-            format(preseed_name))
-
-def get_image_by_description(url, token, image_type, description, arch):
-    """ Look up image by description """
-    headers = {'Authorization': token}
-    url = urljoin(url, "/api/v1/image?show_all=true")
-    r = requests.get(url, headers=headers)
-    if r.status_code != 200:
-        raise ProvisionerError('Error fetching {}, HTTP {} {}'.format(url,
-                         r.status_code, r.reason))
-    found_image = True
-    for image in r.json():
-        if (image['description'] == description and
-            image['type'] == image_type and
-            image['arch'] == arch):
-            return image
-    msg = "Error finding image of type '{}' and description '{}'".format(
-        image_type, description)
-    raise ProvisionerError(msg)
+from ansible.module_utils.mr_provisioner import (ProvisionerError,
+                                                 client_argument_spec,
+                                                 client_from_module)
+from ansible.module_utils.mr_provisioner_admission import (admission_argument_spec,
+                                                           admission_from_params)
+from ansible.module_utils.mr_provisioner_catalog import catalog_argument_spec
+from ansible.module_utils.mr_provisioner_machine import (artifact_fingerprint,
+                                                         boot_lease,
+                                                         get_image_by_description,
+                                                         get_machine_by_name,
+                                                         get_preseed_by_name,
+                                                         job_handle,
+                                                         machine_parameter_changes,
+                                                         machine_provision,
+                                                         preseed_digest,
+                                                         provision_fingerprint,
+                                                         record_jobs,
+                                                         record_provision,
+                                                         update_machine_parameters)
 
 def run_module():
     # define the available arguments/parameters that a user can pass to
@@ -191,9 +207,13 @@ def run_module():
         subarch=dict(type='str', required=True),
         preseed_name=dict(type='str', required=True),
         kernel_options=dict(type='str', required=False),
+        fingerprint=dict(type='bool', required=False, default=False),
         url=dict(type='str', required=True),
         token=dict(type='str', required=True),
     )
+    module_args.update(client_argument_spec())
+    module_args.update(catalog_argument_spec())
+    module_args.update(admission_argument_spec())
 
     result = dict(
         changed=False,
@@ -206,13 +226,13 @@ def run_module():
     )
 
     if module.check_mode:
-        return result
+        module.exit_json(**result)
 
+    client = client_from_module(module)
 
     # Look up machine, verify assignment
     try:
-        machine = get_machine_by_name(module.params['url'],
-                                      module.params['token'],
+        machine = get_machine_by_name(client,
                                       module.params['machine_name'])
     except ProvisionerError as e:
         module.fail_json(msg=str(e), **result)
@@ -220,16 +240,18 @@ def run_module():
 
     # Look up kernel, initrd
     try:
-        kernel_id = get_image_by_description(module.params['url'],
-                                         module.params['token'],
+        kernel_id = get_image_by_description(client,
                                          "Kernel",
                                          module.params['kernel_description'],
-                                         module.params['arch'])
-        initrd_id = get_image_by_description(module.params['url'],
-                                         module.params['token'],
+                                         module.params['arch'],
+                                         module.params['catalog_ttl'],
+                                         module.params['cache_dir'])
+        initrd_id = get_image_by_description(client,
                                          "Initrd",
                                          module.params['initrd_description'],
-                                         module.params['arch'])
+                                         module.params['arch'],
+                                         module.params['catalog_ttl'],
+                                         module.params['cache_dir'])
     except ProvisionerError as e:
         module.fail_json(msg=str(e), **result)
     result['debug']['kernel_id'] = kernel_id
@@ -237,37 +259,73 @@ def run_module():
 
     # Look up kernel, initrd, and preseed IDs
     try:
-        preseed = get_preseed_by_name(module.params['url'],
-                                      module.params['token'],
-                                      module.params['preseed_name'])
+        preseed = get_preseed_by_name(client,
+                                      module.params['preseed_name'],
+                                      module.params['catalog_ttl'],
+                                      module.params['cache_dir'])
     except ProvisionerError as e:
         module.fail_json(msg=str(e), **result)
     result['debug']['preseed'] = preseed
 
-    # Set kernel, initrd, preseed on machine
+    if module.params['fingerprint']:
+        try:
+            preseed['sha256'] = preseed_digest(client, preseed)
+        except ProvisionerError as e:
+            module.fail_json(msg=str(e), **result)
+    fingerprint = artifact_fingerprint(kernel_id, initrd_id, preseed,
+                                       module.params['kernel_options'],
+                                       module.params['subarch'])
+    result['fingerprint'] = fingerprint
+
+    parameters = dict(initrd_id=initrd_id['id'],
+                      kernel_id=kernel_id['id'],
+                      kernel_opts=module.params['kernel_options'],
+                      preseed_id=preseed['id'],
+                      subarch=module.params['subarch'])
+
+    # A reprovision with the very same artifacts only costs a reboot and an
+    # install. netboot_enabled does not count: it is only needed to boot
+    # the installer again.
+    if module.params['fingerprint']:
+        changes = machine_parameter_changes(machine, **parameters)
+        changes.pop('netboot_enabled', None)
+        if not changes and provision_fingerprint(
+                client, machine['id'], module.params['cache_dir']) == fingerprint:
+            result['parameters_changed'] = []
+            result['provision_skipped'] = True
+            module.exit_json(**result)
+
+    # Set kernel, initrd, preseed on machine, those not already set
     try:
-        machine_state = set_machine_parameters(module.params['url'],
-                                      module.params['token'],
-                                      machine_id=machine['id'],
-                                      initrd_id=initrd_id['id'],
-                                      kernel_id=kernel_id['id'],
-                                      kernel_opts=module.params['kernel_options'],
-                                      preseed_id=preseed['id'],
-                                      subarch=module.params['subarch'])
-
+        machine_state, changed = update_machine_parameters(client, machine,
+                                                           **parameters)
     except ProvisionerError as e:
         module.fail_json(msg=str(e), **result)
     result['machine_state'] = machine_state
+    result['parameters_changed'] = changed
 
-    # Reboot/provision
+    # Reboot/provision, once admitted
+    admission = admission_from_params(client, module.params)
     try:
-        machine_state = machine_provision(module.params['url'],
-                                      module.params['token'],
+        if admission:
+            result['admission_wait'] = admission.acquire(machine['id'])
+        lease = boot_lease(client, machine['id'],
+                           module.params['interface_name'])
+        machine_state = machine_provision(client,
                                       machine_id=machine['id'])
 
     except ProvisionerError as e:
+        if admission and 'admission_wait' in result:
+            admission.release(machine['id'])
         module.fail_json(msg=str(e), **result)
     result['machine_provision'] = machine_state
+    result['job'] = job_handle(machine, lease)
+    record_jobs(client, [result['job']], module.params['cache_dir'])
+    result['provision_skipped'] = False
+    result['changed'] = True
+    if module.params['fingerprint']:
+        record_provision(client, machine['id'], fingerprint,
+                         module.params['cache_dir'])
 
     module.exit_json(**result)
 
@@ -1,12 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import json
-import requests
-try:
-    from urllib.parse import urljoin
-except ImportError:
-    from urlparse import urljoin
+import os
 
 ANSIBLE_METADATA = {
     'metadata_version': '1.1',
@@ -22,21 +17,42 @@ description:
     Implemented:
         - Upload new preseed
         - Discover existing preseeds by a given name.
+        - Update an existing preseed when the local file or its metadata
+          differ from what Mr. Provisioner has. Content is compared by the
+          SHA-256 of its normalized form (unix line endings, one trailing
+          newline), so an unchanged preseed is never rewritten.
+        - Sync a whole directory of preseeds. The listing is fetched once,
+          every file is compared with it, and the resulting plan of
+          creates/updates/unchanged/orphans is applied on a bounded pool of
+          concurrent workers. Check mode returns the plan only.
     Not implemented:
-        - modifying existing preseed
         - deleting existing preseed
 options:
     name:
         description:
-            - Name of the preseed
-        required: true
+            - Name of the preseed. Either name or directory is required.
+        required: false
     description:
         description:
             - Description of the preseed
         required: false
     path:
         description: Local file path to preseed file.
-        required: true
+        required: false
+    directory:
+        description: Local directory to sync. Every (non hidden) file below
+            it is a preseed, named after its path relative to directory.
+            description, type, known_good and public apply to all of them.
+        required: false
+    prefix:
+        description: In directory mode, prepended to every preseed name,
+            e.g. "danrue/". Only server preseeds whose name starts with
+            prefix (and of the same type) are reported as orphans.
+        required: false
+    workers:
+        description: In directory mode, number of preseeds created or
+            updated concurrently. Default 10.
+        required: false
     url:
         description: url to provisioner instance in the form of http://192.168.0.3:5000/
         required: true
@@ -49,6 +65,46 @@ options:
     public:
         description: Mark public. Default false.
         required: false
+    show_diff:
+        description: Return a unified diff of the stored and local content
+            in content_diff. The diff is also shown when running with --diff.
+            Default false.
+        required: false
+    pool_size:
+        description: Maximum number of keep-alive connections to Mr. Provisioner.
+        required: false
+    connect_timeout:
+        description: Seconds to wait for a connection. Default 10.
+        required: false
+    read_timeout:
+        description: Seconds to wait for a response. Default 300.
+        required: false
+    trace_file:
+        description: Append a JSON line per API call (method, endpoint,
+            status, bytes, seconds) to this file. Default
+            $MR_PROVISIONER_TRACE_FILE.
+        required: false
+    retries:
+        description: Times a call failing with a connection error or HTTP
+            429/502/503/504 is retried. GETs and PUTs are retried as is;
+            POSTs only after checking they did not take effect. Default 3.
+        required: false
+    retry_interval:
+        description: First delay between retries in seconds, growing
+            exponentially with jitter. Default 1.
+        required: false
+    retry_deadline:
+        description: Seconds after which a failing call is no longer
+            retried. Default 120.
+        required: false
+    catalog_ttl:
+        description: Seconds a cached preseed listing is used without
+            revalidating it with the server. Default 60.
+        required: false
+    cache_dir:
+        description: Directory of the local catalog cache. Default
+            $MR_PROVISIONER_CACHE_DIR or ~/.cache/mr_provisioner.
+        required: false
 author:
     - Jorge Niedbalski <jorge.niedbalski@linaro.org>
     - Baptiste Gerondeau <baptiste.gerondeau@linaro.org>
@@ -66,9 +122,16 @@ EXAMPLES = '''
   path: ''
   url: http://192.168.0.3:5000
   token: "{{ fancy_token }}"
+
+# Sync a preseed library kept in git
+- directory: ./preseeds
+  prefix: danrue/
+  url: http://192.168.0.3:5000
+  token: "{{ fancy_token }}"
 '''
 
 RETURN = '''
+json:
   id: auto-assigned preseed id
   description: preseed description
   name: preseed name
@@ -76,128 +139,137 @@ RETURN = '''
   user: User that owns the preseed
   known_good: true/false
   public: true/false
+sha256: SHA-256 of the normalized local preseed content
+content_changed: true when the local content differs from the stored one
+content_diff: unified diff of the stored and local content (show_diff only)
+plan:
+  description: Directory mode only. Preseed names by action.
+  contains:
+    create: preseeds that did not exist
+    update: preseeds whose content or metadata differed
+    unchanged: preseeds already up to date
+    orphan: server preseeds matching prefix with no local file
+preseeds:
+  description: Directory mode only. One entry per local file, with name,
+    path, action, id, sha256, content_changed, error and content_diff
+    (show_diff only).
+  type: list
+failed_preseeds: Directory mode only. Names of the preseeds that failed.
+timings: API calls made by the module, overall and per endpoint template
+  (requests, errors, retries, seconds, max_seconds, bytes_in, bytes_out),
+  and the module's elapsed wall time
 '''
 
 from ansible.module_utils.basic import AnsibleModule
-
-class ProvisionerError(Exception):
-    def __init__(self, message):
-        super(ProvisionerError, self).__init__(message)
-
-class PreseedUploader(object):
-    """ This class handles the job of uploading a preseed file to MrP.
-        It shall only be called if there is a file to be uploaded, else you can
-        fetch the thing via the regular call in the Ansible role"""
-    def __init__(self, mrp_url, mrp_token, preseed_file, preseed_name,
-                 preseed_type, preseed_desc='', preseed_knowngood=False,
-                 preseed_public=False):
-        self.url = mrp_url
-        self.authhead = {'Authorization': mrp_token}
-        self.file = preseed_file
-        self.name = preseed_name
-        self.type = preseed_type
-        self.id = None
-        self.desc = preseed_desc
-        self.knowngood = preseed_knowngood
-        self.public = preseed_public
-
-    def _check_for_existence(self):
-        url = urljoin(self.url, '/api/v1/preseed?show_all=true')
-        r = requests.get(url, headers=self.authhead)
-        if r.status_code != 200:
-            raise ProvisionerError('Error fetching {}, HTTP {} {}'.format(url,
-                                                r.status_code, r.reason))
-
-        for preseed in r.json():
-            if preseed['name'] == self.name:
-                self.id = preseed['id']
-                return True
-
-        return False
-
-    def _get_preseed_from_file(self):
-        json_preseed = {}
-        contents = ''
-
-        with open(self.file, 'r') as fd:
-            lines = fd.readlines()
-
-        for line in lines:
-            contents += line
-
-        json_preseed['content'] = contents
-        json_preseed['name'] = self.name
-        json_preseed['type'] = self.type
-        json_preseed['public'] = self.public
-        json_preseed['known_good'] = self.knowngood
-        if self.desc != '':
-            json_preseed['description'] = self.desc
-
-        return json_preseed
-
-    def upload_preseed(self):
-        """Uploads preseed. Should check first that preseed doesn't exist, else
-        it modifies preseed (separate function ?). Post to upload, Put to
-        modify (+ id). Maybe implement a jinja2 syntax check ? But that should
-        be done on mrp's side"""
-        res = {}
+from ansible.module_utils.mr_provisioner import (ProvisionerError,
+                                                 client_argument_spec,
+                                                 client_from_module,
+                                                 run_parallel)
+from ansible.module_utils.mr_provisioner_catalog import (catalog_argument_spec,
+                                                         preseed_catalog)
+from ansible.module_utils.mr_provisioner_preseed import PreseedUploader
+
+DEFAULT_WORKERS = 10
+
+
+def local_preseeds(directory, prefix=''):
+    """ (name, path) of every non hidden file below directory """
+    found = []
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        for f in sorted(files):
+            if f.startswith('.'):
+                continue
+            path = os.path.join(root, f)
+            name = os.path.relpath(path, directory).replace(os.sep, '/')
+            found.append((prefix + name, path))
+    return found
+
+
+def sync_directory(module, client):
+    """ Plan the sync of module.params['directory'] against a single
+        preseed listing, then apply the creates and updates concurrently """
+    params = module.params
+    want_diff = params['show_diff'] or module._diff
+
+    # Revalidated rather than trusted from the cache: a stale listing would
+    # plan creates of preseeds that already exist
+    catalog = preseed_catalog(client, 0, params['cache_dir'])
+
+    uploaders = [PreseedUploader(params['url'], params['token'], path, name,
+                                 params['type'], params['description'],
+                                 params['known_good'], params['public'],
+                                 client=client, cache_dir=params['cache_dir'],
+                                 check_mode=module.check_mode,
+                                 want_diff=want_diff, catalog=catalog)
+                 for name, path in local_preseeds(params['directory'],
+                                                  params['prefix'])]
+
+    def plan(uploader):
+        entry = dict(name=uploader.name, path=uploader.file)
         try:
-            exists = self._check_for_existence()
+            entry['action'] = uploader.plan()
         except ProvisionerError as e:
-            res['error'] = str(e)
-            return res
-
-        if not exists and self.file == '':
-            res['error'] = 'Preseed does not exist and file not given'
-            return res
-
-        if self.id != None and self.file != '':     #Exists and file given
-            try:
-                res = self._modify_preseed(method='PUT')
-            except ProvisionerError as e:
-                res['error'] = str(e)
-            return res
-        elif self.file != '':        #Doesn't exist and file given
+            entry['action'] = 'error'
+            entry['error'] = str(e)
+        except (IOError, OSError, UnicodeDecodeError) as e:
+            # An unreadable file only fails its own preseed
+            entry['action'] = 'error'
+            entry['error'] = 'Error reading {}: {}'.format(uploader.file, e)
+        return entry
+
+    def apply(pair):
+        uploader, entry = pair
+        entry['id'] = uploader.id
+        if entry['action'] in ['create', 'update']:
             try:
-                res = self._modify_preseed(method='POST')
+                entry['id'] = uploader.apply(entry['action']).get('id')
             except ProvisionerError as e:
-                res['error'] = str(e)
-            return res
-        else:       #Exists and file not given, is it useful fetching contents?
-            return res
-
-    def _modify_preseed(self, method):
-        preseed = self._get_preseed_from_file()
-        url = urljoin(self.url, '/api/v1/preseed')
-        if method == 'PUT':
-            if self.id == None:
-                raise ProvisionerError('preseed ID is undefined, please use upload_preseed')
-            url_id = '/api/v1/preseed/' + str(self.id)
-            url = urljoin(self.url, url_id)
-            r = requests.put(url, headers=self.authhead, data=json.dumps(preseed))
-            if r.status_code != 200:
-                raise ProvisionerError('Error putting preseed {} at ID {}, \
-                                   HTTP {} {}'.format(self.name, url, r.status_code, r.reason))
-        elif method == 'POST':
-            r = requests.post(url, headers=self.authhead, data=json.dumps(preseed))
-            if r.status_code != 201:
-                raise ProvisionerError('Error posting preseed {}, \
-                                       HTTP {} {}'.format(self.name, r.status_code, r.reason))
-        else:
-            raise ProvisionerError('Bad _modify_preseed call')
-        return r.json()
+                entry['error'] = str(e)
+            except (IOError, OSError, UnicodeDecodeError) as e:
+                entry['error'] = 'Error reading {}: {}'.format(uploader.file,
+                                                              e)
+        entry['sha256'] = uploader.sha256
+        entry['content_changed'] = uploader.content_changed
+        if uploader.diff is not None:
+            entry['content_diff'] = uploader.diff
+        return entry
+
+    entries = run_parallel(plan, uploaders, params['workers'])
+    entries = run_parallel(apply, list(zip(uploaders, entries)),
+                           params['workers'])
+
+    local_names = set(u.name for u in uploaders)
+    orphans = sorted(name for name, found in catalog.by_name.items()
+                     if name.startswith(params['prefix'])
+                     and name not in local_names
+                     and any(p.get('type', params['type']) == params['type']
+                             for p in found))
+
+    plan_result = dict(orphan=orphans)
+    for action in ['create', 'update', 'unchanged']:
+        plan_result[action] = [e['name'] for e in entries
+                               if e['action'] == action]
+    return plan_result, entries
+
 
 def run_module():
     module_args = dict(
         description=dict(type='str', required=False, default=''),
-        name=dict(type='str', required=True),
+        name=dict(type='str', required=False),
         type=dict(type='str', required=False, default='preseed'),
         path=dict(type='str', required=False, default=''),
         url=dict(type='str', required=True),
         token=dict(type='str', required=True),
         known_good=dict(type='bool', required=False, default=False),
         public=dict(type='bool', required=False, default=False),
+        show_diff=dict(type='bool', required=False, default=False),
+        directory=dict(type='path', required=False),
+        prefix=dict(type='str', required=False, default=''),
+        workers=dict(type='int', required=False, default=DEFAULT_WORKERS),
     )
+    module_args.update(client_argument_spec())
+    module_args.update(catalog_argument_spec())
 
     result = dict(
         changed=False,
@@ -207,16 +279,39 @@ def run_module():
     module = AnsibleModule(
         argument_spec=module_args,
         supports_check_mode=True,
+        required_one_of=[['name', 'directory']],
+        mutually_exclusive=[['name', 'directory']],
     )
 
-    if module.check_mode:
-        return result
+    if module.params['directory']:
+        client = client_from_module(module,
+                                    min_pool_size=module.params['workers'])
+        try:
+            plan, entries = sync_directory(module, client)
+        except ProvisionerError as e:
+            module.fail_json(msg=str(e), **result)
+        result['plan'] = plan
+        result['preseeds'] = entries
+        result['failed_preseeds'] = [e['name'] for e in entries if 'error' in e]
+        result['changed'] = bool(plan['create'] or plan['update'])
+        if module._diff:
+            result['diff'] = [dict(prepared=e['content_diff'])
+                              for e in entries if 'content_diff' in e]
+        if result['failed_preseeds']:
+            module.fail_json(msg='Failed to sync {} of {} preseeds: {}'.format(
+                             len(result['failed_preseeds']), len(entries),
+                             ', '.join(result['failed_preseeds'])), **result)
+        module.exit_json(**result)
 
     uploader = PreseedUploader(module.params['url'],
     module.params['token'], module.params['path'],
     module.params['name'], module.params['type'],
     module.params['description'], module.params['known_good'],
-    module.params['public'])
+    module.params['public'], client=client_from_module(module),
+    catalog_ttl=module.params['catalog_ttl'],
+    cache_dir=module.params['cache_dir'],
+    check_mode=module.check_mode,
+    want_diff=module.params['show_diff'] or module._diff)
 
     try:
         res = uploader.upload_preseed()
@@ -227,7 +322,15 @@ def run_module():
         module.fail_json(msg=res['error'], **result)
 
     result['json'] = res
-    result['changed'] = True
+    result['changed'] = uploader.changed
+    result['content_changed'] = uploader.content_changed
+    if uploader.sha256:
+        result['sha256'] = uploader.sha256
+    if uploader.diff is not None:
+        if module.params['show_diff']:
+            result['content_diff'] = uploader.diff
+        if module._diff:
+            result['diff'] = dict(prepared=uploader.diff)
 
     module.exit_json(**result)
 
@@ -0,0 +1,414 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: mr-provisioner-provision-status
+
+short_description: Follow provisioning jobs through their phases.
+
+description:
+    - Polls the state and interface lease of the machines of many
+      provisioning jobs (as returned by mr_provisioner_machine_provision
+      and mr_provisioner_fleet_provision) from the Mr. Provisioner API, and
+      optionally probes their SSH port, backing off exponentially (with
+      jitter) between checks of a machine.
+    - Each job goes through phases, timed from the moment the PXE boot was
+      accepted. A job starts in phase provision; every state the machine
+      reports afterwards (e.g. netboot, installer) is a phase, as are
+      lease_acquired, when the machine's lease address appears or changes
+      (or differs from the boot_lease of the job handle, the lease before
+      the PXE boot), and reachable, when its port answers after having
+      been seen down or on a lease acquired since the PXE boot. A job first
+      checked after its machine came back up is thus still seen reachable.
+    - Phase history is kept on the controller, so that the module can be
+      run any number of times for the same jobs, e.g. once without waiting
+      (timeout 0) to get a snapshot while doing other work, then later to
+      wait for the remaining jobs.
+
+options:
+    jobs:
+        description: List of jobs to follow, each a job handle (a dict with
+            machine_id, machine_name, started and optionally boot_lease) or
+            a machine name, whose most recent job is followed.
+        required: true
+    until:
+        description: Phases that end a job. Default [reachable].
+        required: false
+    failed_phases:
+        description: Phases (machine states) that fail a job. Default none.
+        required: false
+    timeout:
+        description: Seconds to wait for every job to reach one of until.
+            With 0, the jobs are checked once and their current phase is
+            returned without failing on the unfinished ones. Default 0.
+        required: false
+    interface_name:
+        description: Interface whose lease address is followed and probed.
+            Default eth1.
+        required: false
+    port:
+        description: TCP port probed to detect the reachable phase, 0 not
+            to probe. Default 22.
+        required: false
+    probe_timeout:
+        description: Seconds a TCP connect may take. Default 2.
+        required: false
+    interval:
+        description: First delay between checks of a machine, in seconds.
+            Default 5.
+        required: false
+    max_interval:
+        description: Upper bound of the delay between checks. Default 60.
+        required: false
+    url:
+        description: url to provisioner instance in the form of http://192.168.0.3:5000/
+        required: true
+    token:
+        description: Mr. Provisioner auth token
+        required: true
+    name_ttl:
+        description: Seconds a machine id resolved from its name is
+            remembered. The machines are looked up together, in one query
+            per 50 names, and a remembered id is checked against that
+            answer, never trusted as is. Default 300.
+        required: false
+    cache_dir:
+        description: Directory of the local job and machine id caches.
+            Default $MR_PROVISIONER_CACHE_DIR or ~/.cache/mr_provisioner.
+        required: false
+    pool_size:
+        description: Maximum number of keep-alive connections to Mr.
+            Provisioner.
+        required: false
+    connect_timeout:
+        description: Seconds to wait for a connection. Default 10.
+        required: false
+    read_timeout:
+        description: Seconds to wait for a response. Default 300.
+        required: false
+    trace_file:
+        description: Append a JSON line per API call (method, endpoint,
+            status, bytes, seconds) to this file. Default
+            $MR_PROVISIONER_TRACE_FILE.
+        required: false
+    retries:
+        description: Times a call failing with a connection error or HTTP
+            429/502/503/504 is retried. GETs and PUTs are retried as is;
+            POSTs only after checking they did not take effect. Default 3.
+        required: false
+    retry_interval:
+        description: First delay between retries in seconds, growing
+            exponentially with jitter. Default 1.
+        required: false
+    retry_deadline:
+        description: Seconds after which a failing call is no longer
+            retried. Default 120.
+        required: false
+
+author:
+    - Dan Rue <dan.rue@linaro.org>
+'''
+
+EXAMPLES = '''
+- name: Start provisioning the rack
+  mr_provisioner_fleet_provision:
+    machines: "{{ groups['rack3'] }}"
+    kernel_description: debian-installer staging build 471
+    initrd_description: debian-installer staging build 471
+    arch: arm64
+    subarch: efi
+    preseed_name: debian-staging
+    url: "{{ mr_provisioner_url }}"
+    token: "{{ mr_provisioner_auth_token }}"
+  register: fleet
+  delegate_to: localhost
+  run_once: true
+
+- name: Where are they at?
+  mr_provisioner_provision_status:
+    jobs: "{{ fleet.machines | map(attribute='job') | list }}"
+    url: "{{ mr_provisioner_url }}"
+    token: "{{ mr_provisioner_auth_token }}"
+  delegate_to: localhost
+  run_once: true
+
+- name: Wait for the whole rack
+  mr_provisioner_provision_status:
+    jobs: "{{ groups['rack3'] }}"
+    timeout: 3600
+    url: "{{ mr_provisioner_url }}"
+    token: "{{ mr_provisioner_auth_token }}"
+  delegate_to: localhost
+  run_once: true
+'''
+
+RETURN = '''
+jobs:
+  description: One entry per job, in the order given
+  type: list
+  contains:
+    machine_name: machine name
+    machine_id: machine id
+    started: epoch seconds the PXE boot was accepted
+    phase: current phase
+    done: true once the job reached a phase of until
+    failed: true once the job reached a phase of failed_phases
+    phases: list of phase (name), started (seconds after the job started)
+      and seconds spent in it, so far for the current one
+    state: last machine state reported by Mr. Provisioner
+    lease_ip: last lease address seen
+    elapsed: seconds since the job started
+    checks: number of checks made by this run
+    error: last API error, if any
+pending: names of the machines whose job is not done
+failed_jobs: names of the machines whose job failed
+timings: API calls made by the module, overall and per endpoint template
+  (requests, errors, retries, seconds, max_seconds, bytes_in, bytes_out),
+  and the module's elapsed wall time
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.mr_provisioner import (ProvisionerError,
+                                                 client_argument_spec,
+                                                 client_from_module,
+                                                 run_parallel)
+from ansible.module_utils.mr_provisioner_machine import (get_lease_ip,
+                                                         get_machine_by_name,
+                                                         get_machine_interfaces,
+                                                         get_machine_state,
+                                                         load_jobs,
+                                                         machine_argument_spec,
+                                                         resolve_machines,
+                                                         save_jobs)
+from ansible.module_utils.mr_provisioner_poll import (DEFAULT_INTERVAL,
+                                                      DEFAULT_MAX_INTERVAL,
+                                                      Backoff,
+                                                      probe_ports,
+                                                      sleep_until)
+
+
+class JobTracker(object):
+    """ Phase tracking of one provisioning job. job is the stored job, with
+        its phase history, updated in place. """
+    def __init__(self, name, job, interval, max_interval):
+        self.name = name
+        self.job = job
+        self.error = None
+        self.checks = 0
+        self.next_check = 0
+        self.backoff = Backoff(interval, max_interval)
+
+    @property
+    def phase(self):
+        return self.job['phases'][-1]['phase'] if self.job['phases'] else None
+
+    def enter(self, phase, now):
+        if phase != self.phase:
+            self.job['phases'].append(dict(phase=phase, since=now))
+            self.backoff.reset()
+
+    def refresh(self, client, interface_name):
+        """ Update state and lease address from the API """
+        try:
+            if self.job.get('machine_id') is None:
+                machine = get_machine_by_name(client, self.name)
+                self.job['machine_id'] = machine['id']
+            state = get_machine_state(client, self.job['machine_id'])
+            ip = get_lease_ip(get_machine_interfaces(client,
+                                                     self.job['machine_id']),
+                              interface_name)
+            self.error = None
+        except ProvisionerError as e:
+            self.error = str(e)
+            return
+        now = time.time()
+        # Only a change of the reported state is a new phase: the state
+        # still reported once the lease was acquired is not
+        if state.get('state') != self.job.get('state'):
+            self.job['state'] = state.get('state')
+            self.enter(self.job['state'], now)
+        # The first lease seen may be the one from before the reboot: only
+        # a lease appearing or changing afterwards counts, or one differing
+        # from the lease the job handle recorded before the PXE boot
+        last = self.job.get('lease_ip', self.job.get('boot_lease', ip))
+        if ip and ip != last:
+            self.enter('lease_acquired', now)
+        self.job['lease_ip'] = ip
+
+    def probed(self, reachable, now):
+        if reachable:
+            # Seen down since the PXE boot, or answering on a new lease: the
+            # machine came back, even if first checked once it already had
+            if self.job.get('seen_down') or self.reached('lease_acquired'):
+                self.enter('reachable', now)
+        else:
+            self.job['seen_down'] = True
+
+    def as_dict(self, until, failed_phases, now):
+        phases = []
+        for i, p in enumerate(self.job['phases']):
+            end = (self.job['phases'][i + 1]['since']
+                   if i + 1 < len(self.job['phases']) else now)
+            phases.append(dict(phase=p['phase'],
+                               started=round(p['since'] - self.job['started'], 1),
+                               seconds=round(end - p['since'], 1)))
+        return dict(machine_name=self.name,
+                    machine_id=self.job.get('machine_id'),
+                    started=self.job['started'], phase=self.phase,
+                    done=self.done(until), failed=self.failed(failed_phases),
+                    phases=phases, state=self.job.get('state'),
+                    lease_ip=self.job.get('lease_ip'),
+                    elapsed=round(now - self.job['started'], 1),
+                    checks=self.checks, error=self.error)
+
+    def reached(self, *phases):
+        return any(p['phase'] in phases for p in self.job['phases'])
+
+    def done(self, until):
+        return self.reached(*until)
+
+    def failed(self, failed_phases):
+        return self.reached(*failed_phases)
+
+
+def track_jobs(client, trackers, interface_name, port, until, failed_phases,
+               deadline, probe_timeout, workers):
+    """ Check every tracker at least once, then poll until each one is done
+        or failed, or deadline passes """
+    pending = list(trackers)
+    while pending:
+        now = time.time()
+        due = [t for t in pending if t.next_check <= now]
+
+        run_parallel(lambda t: t.refresh(client, interface_name), due, workers)
+        if port:
+            addresses = [(t.job['lease_ip'], port) for t in due
+                         if t.job.get('lease_ip')]
+            reachable = probe_ports(addresses, probe_timeout)
+
+        now = time.time()
+        for t in due:
+            t.checks += 1
+            if port and t.job.get('lease_ip'):
+                t.probed((t.job['lease_ip'], port) in reachable, now)
+            t.next_check = now + t.backoff.next_delay()
+
+        pending = [t for t in pending
+                   if not t.done(until) and not t.failed(failed_phases)]
+        if not pending or time.time() >= deadline:
+            break
+        sleep_until(min(min(t.next_check for t in pending), deadline))
+
+
+def run_module():
+    module_args = dict(
+        jobs=dict(type='list', required=True),
+        until=dict(type='list', required=False, default=['reachable']),
+        failed_phases=dict(type='list', required=False, default=[]),
+        timeout=dict(type='float', required=False, default=0),
+        interface_name=dict(type='str', required=False, default='eth1'),
+        port=dict(type='int', required=False, default=22),
+        probe_timeout=dict(type='float', required=False, default=2),
+        interval=dict(type='float', required=False, default=DEFAULT_INTERVAL),
+        max_interval=dict(type='float', required=False,
+                          default=DEFAULT_MAX_INTERVAL),
+        url=dict(type='str', required=True),
+        token=dict(type='str', required=True),
+    )
+    module_args.update(client_argument_spec())
+    module_args.update(machine_argument_spec())
+
+    result = dict(
+        changed=False,
+        jobs=[],
+        pending=[],
+        failed_jobs=[],
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    client = client_from_module(module)
+    start = time.time()
+    deadline = start + module.params['timeout']
+
+    stored = load_jobs(client, module.params['cache_dir'])
+    by_name = dict((job.get('machine_name'), job) for job in stored.values())
+    trackers = []
+    for handle in module.params['jobs']:
+        if isinstance(handle, dict):
+            if 'machine_id' not in handle or 'started' not in handle:
+                module.fail_json(msg='Not a job handle: {}'.format(handle),
+                                 **result)
+            job = stored.get(str(handle['machine_id']))
+            if job is None or job['started'] < handle['started']:
+                job = dict(handle, phases=[dict(phase='provision',
+                                                since=handle['started'])])
+            name = handle.get('machine_name', str(handle['machine_id']))
+        else:
+            name = str(handle)
+            # Not started from this controller: followed from now on
+            job = by_name.get(name) or dict(machine_name=name, started=start,
+                                            phases=[])
+        trackers.append(JobTracker(name, job, module.params['interval'],
+                                   module.params['max_interval']))
+
+    # Machines followed by name are looked up together; those not found are
+    # looked up again, one by one, as they are polled
+    unknown = [t.name for t in trackers if t.job.get('machine_id') is None]
+    if unknown:
+        ids, _ = resolve_machines(client, unknown, module.params['name_ttl'],
+                                  module.params['cache_dir'])
+        for t in trackers:
+            if t.job.get('machine_id') is None and t.name in ids:
+                t.job['machine_id'] = ids[t.name]
+
+    try:
+        track_jobs(client, trackers, module.params['interface_name'],
+                   module.params['port'], module.params['until'],
+                   module.params['failed_phases'], deadline,
+                   module.params['probe_timeout'], client.pool_size)
+    finally:
+        save_jobs(client, dict((str(t.job['machine_id']), t.job)
+                               for t in trackers
+                               if t.job.get('machine_id') is not None),
+                  module.params['cache_dir'])
+
+    now = time.time()
+    result['jobs'] = [t.as_dict(module.params['until'],
+                                module.params['failed_phases'], now)
+                      for t in trackers]
+    result['pending'] = [j['machine_name'] for j in result['jobs']
+                         if not j['done'] and not j['failed']]
+    result['failed_jobs'] = [j['machine_name'] for j in result['jobs']
+                             if j['failed']]
+
+    if result['failed_jobs']:
+        module.fail_json(msg='Provisioning failed for: {}'.format(
+                         ', '.join(result['failed_jobs'])), **result)
+    if module.params['timeout'] and result['pending']:
+        module.fail_json(msg='Timed out after {}s waiting for: {}'.format(
+                         module.params['timeout'],
+                         ', '.join(result['pending'])), **result)
+
+    module.exit_json(**result)
+
+def main():
+    run_module()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time
+
+ANSIBLE_METADATA = {
+    'metadata_version': '1.1',
+    'status': ['preview'],
+    'supported_by': 'community'
+}
+
+DOCUMENTATION = '''
+---
+module: mr-provisioner-wait
+
+short_description: Wait for provisioned machines to become reachable.
+
+description:
+    - Polls each machine's state and interface lease from the Mr.
+      Provisioner API and probes its SSH port with a non-blocking TCP
+      connect, backing off exponentially (with jitter) between checks. All
+      machines are waited for concurrently from one process, and each one
+      is reported ready as soon as its port answers.
+    - Right after a PXE reboot the old system may still be answering, so by
+      default a machine must first be seen unreachable before it counts as
+      ready (see require_down).
+
+options:
+    machines:
+        description: List of machine names to wait for.
+        required: true
+    interface_name:
+        description: Interface whose lease address is probed. Default eth1.
+        required: false
+    addresses:
+        description: Optional map of machine name to the address to probe,
+            for machines not reachable on their lease address.
+        required: false
+    port:
+        description: TCP port to probe. Default 22.
+        required: false
+    require_down:
+        description: Only count a machine as ready once it has been seen
+            unreachable, i.e. it has actually rebooted. Default true.
+        required: false
+    delay:
+        description: Seconds to wait before the first check. Default 0.
+        required: false
+    timeout:
+        description: Seconds to wait for all machines. Default 3600.
+        required: false
+    interval:
+        description: First delay between checks of a machine, in seconds.
+            Default 5.
+        required: false
+    max_interval:
+        description: Upper bound of the delay between checks. Default 60.
+        required: false
+    probe_timeout:
+        description: Seconds a TCP connect may take. Default 2.
+        required: false
+    url:
+        description: url to provisioner instance in the form of http://192.168.0.3:5000/
+        required: true
+    token:
+        description: Mr. Provisioner auth token
+        required: true
+    pool_size:
+        description: Maximum number of keep-alive connections to Mr.
+            Provisioner.
+        required: false
+    connect_timeout:
+        description: Seconds to wait for a connection. Default 10.
+        required: false
+    read_timeout:
+        description: Seconds to wait for a response. Default 300.
+        required: false
+    trace_file:
+        description: Append a JSON line per API call (method, endpoint,
+            status, bytes, seconds) to this file. Default
+            $MR_PROVISIONER_TRACE_FILE.
+        required: false
+    retries:
+        description: Times a call failing with a connection error or HTTP
+            429/502/503/504 is retried. GETs and PUTs are retried as is;
+            POSTs only after checking they did not take effect. Default 3.
+        required: false
+    retry_interval:
+        description: First delay between retries in seconds, growing
+            exponentially with jitter. Default 1.
+        required: false
+    retry_deadline:
+        description: Seconds after which a failing call is no longer
+            retried. Default 120.
+        required: false
+    name_ttl:
+        description: Seconds a machine id resolved from its name is
+            remembered. The machines are looked up together, in one query
+            per 50 names, and a remembered id is checked against that
+            answer, never trusted as is. Default 300.
+        required: false
+    cache_dir:
+        description: Directory of the machine id cache. Default
+            $MR_PROVISIONER_CACHE_DIR or ~/.cache/mr_provisioner.
+        required: false
+
+author:
+    - Dan Rue <dan.rue@linaro.org>
+'''
+
+EXAMPLES = '''
+- name: Wait for the rack to come back after provisioning
+  mr_provisioner_wait:
+    machines: "{{ groups['rack3'] }}"
+    url: "{{ mr_provisioner_url }}"
+    token: "{{ mr_provisioner_auth_token }}"
+  delegate_to: localhost
+  run_once: true
+'''
+
+RETURN = '''
+machines:
+  description: One entry per machine, in the order given
+  type: list
+  contains:
+    name: machine name
+    ready: true once the port answered
+    ip: address that was probed
+    time_to_ready: seconds from the start of the task until ready
+    checks: number of probes made
+    state: last machine state reported by Mr. Provisioner
+    error: last API error, if any
+not_ready: names of the machines that were not ready before timeout
+elapsed: seconds spent waiting
+timings: API calls made by the module, overall and per endpoint template
+  (requests, errors, retries, seconds, max_seconds, bytes_in, bytes_out),
+  and the module's elapsed wall time
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.mr_provisioner import (ProvisionerError,
+                                                 client_argument_spec,
+                                                 client_from_module,
+                                                 run_parallel)
+from ansible.module_utils.mr_provisioner_machine import (get_lease_ip,
+                                                         get_machine_by_name,
+                                                         get_machine_interfaces,
+                                                         get_machine_state,
+                                                         machine_argument_spec,
+                                                         resolve_machines)
+from ansible.module_utils.mr_provisioner_poll import (DEFAULT_INTERVAL,
+                                                      DEFAULT_MAX_INTERVAL,
+                                                      Backoff,
+                                                      probe_ports,
+                                                      sleep_until)
+
+
+class MachineWaiter(object):
+    """ Readiness tracking of one machine """
+    def __init__(self, name, address, interval, max_interval):
+        self.name = name
+        self.id = None
+        self.address = address
+        self.ip = address
+        self.state = None
+        self.error = None
+        self.seen_down = False
+        self.ready = False
+        self.time_to_ready = None
+        self.checks = 0
+        self.next_check = 0
+        self.backoff = Backoff(interval, max_interval)
+
+    def refresh(self, client, interface_name):
+        """ Update state and lease address from the API """
+        try:
+            if self.id is None:
+                self.id = get_machine_by_name(client, self.name)['id']
+            self.state = get_machine_state(client, self.id)
+            if self.address is None:
+                self.ip = get_lease_ip(get_machine_interfaces(client, self.id),
+                                       interface_name)
+            self.error = None
+        except ProvisionerError as e:
+            self.error = str(e)
+            # The id may be a stale cached one: looked up by name next time
+            self.id = None
+
+    def as_dict(self):
+        return dict(name=self.name, ready=self.ready, ip=self.ip,
+                    time_to_ready=self.time_to_ready, checks=self.checks,
+                    state=self.state, error=self.error)
+
+
+def wait_for_machines(client, waiters, interface_name, port, require_down,
+                      start, deadline, probe_timeout, workers):
+    """ Poll until every waiter is ready or deadline passes """
+    pending = list(waiters)
+    while pending and time.time() < deadline:
+        now = time.time()
+        due = [w for w in pending if w.next_check <= now]
+
+        run_parallel(lambda w: w.refresh(client, interface_name), due, workers)
+        addresses = [(w.ip, port) for w in due if w.ip]
+        reachable = probe_ports(addresses, probe_timeout)
+
+        now = time.time()
+        for w in due:
+            w.checks += 1
+            if w.ip and (w.ip, port) in reachable:
+                if w.seen_down or not require_down:
+                    w.ready = True
+                    w.time_to_ready = round(now - start, 1)
+                    continue
+            else:
+                w.seen_down = True
+            w.next_check = now + w.backoff.next_delay()
+
+        pending = [w for w in pending if not w.ready]
+        if pending:
+            sleep_until(min(min(w.next_check for w in pending), deadline))
+
+
+def run_module():
+    module_args = dict(
+        machines=dict(type='list', required=True),
+        interface_name=dict(type='str', required=False, default='eth1'),
+        addresses=dict(type='dict', required=False, default={}),
+        port=dict(type='int', required=False, default=22),
+        require_down=dict(type='bool', required=False, default=True),
+        delay=dict(type='float', required=False, default=0),
+        timeout=dict(type='float', required=False, default=3600),
+        interval=dict(type='float', required=False, default=DEFAULT_INTERVAL),
+        max_interval=dict(type='float', required=False,
+                          default=DEFAULT_MAX_INTERVAL),
+        probe_timeout=dict(type='float', required=False, default=2),
+        url=dict(type='str', required=True),
+        token=dict(type='str', required=True),
+    )
+    module_args.update(client_argument_spec())
+    module_args.update(machine_argument_spec())
+
+    result = dict(
+        changed=False,
+        machines=[],
+        not_ready=[],
+    )
+
+    module = AnsibleModule(
+        argument_spec=module_args,
+        supports_check_mode=True
+    )
+
+    if module.check_mode:
+        module.exit_json(**result)
+
+    client = client_from_module(module)
+    start = time.time()
+    deadline = start + module.params['timeout']
+
+    waiters = [MachineWaiter(name, module.params['addresses'].get(name),
+                             module.params['interval'],
+                             module.params['max_interval'])
+               for name in module.params['machines']]
+    # Those not found are looked up again, one by one, as they are polled
+    ids, _ = resolve_machines(client, module.params['machines'],
+                              module.params['name_ttl'],
+                              module.params['cache_dir'])
+    for w in waiters:
+        w.id = ids.get(w.name)
+        w.next_check = start + module.params['delay']
+
+    wait_for_machines(client, waiters, module.params['interface_name'],
+                      module.params['port'], module.params['require_down'],
+                      start, deadline, module.params['probe_timeout'],
+                      client.pool_size)
+
+    result['machines'] = [w.as_dict() for w in waiters]
+    result['not_ready'] = [w.name for w in waiters if not w.ready]
+    result['elapsed'] = round(time.time() - start, 1)
+
+    if result['not_ready']:
+        module.fail_json(msg='Timed out after {}s waiting for: {}'.format(
+                         module.params['timeout'],
+                         ', '.join(result['not_ready'])), **result)
+
+    module.exit_json(**result)
+
+def main():
+    run_module()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+#
+# Shared HTTP client for the mr_provisioner_* modules.
+#
+# Every module talks to the same Mr. Provisioner API with the same auth token,
+# so rather than issuing bare requests.get/put/post calls (one TCP/TLS
+# handshake each) they all go through a ProvisionerClient, which keeps a
+# keep-alive requests.Session per (url, token) for the lifetime of the module.
+#
+# The client also times every call it makes: method, endpoint template (ids
+# replaced by {id}, query values dropped), status, bytes in/out and wall time
+# are kept as spans, summarised per endpoint in the module result under
+# `timings`, and optionally appended to a JSON-lines trace file.
+#
+# Transient failures (connection errors, 429/502/503/504 while the server is
+# busy) are retried with jittered exponential backoff, up to a number of
+# retries and an overall deadline. GETs and PUTs are retried by the client
+# itself. Non-idempotent calls go through ProvisionerClient.retry() with a
+# check of the server's state, so that a POST that did take effect before
+# its response was lost is not repeated.
+
+import json
+import os
+import re
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ansible.module_utils.basic import env_fallback
+from ansible.module_utils.mr_provisioner_poll import Backoff
+
+try:
+    from urllib.parse import parse_qsl, urljoin, urlsplit    #Python3
+except ImportError:
+    from urlparse import parse_qsl, urljoin, urlsplit    #Python2
+
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 300
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_INTERVAL = 1
+DEFAULT_RETRY_DEADLINE = 120
+RETRY_MAX_INTERVAL = 30
+
+# Responses worth retrying, and the methods retried without a state check
+TRANSIENT_STATUSES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT')
+
+_CLIENTS = {}
+
+
+class ProvisionerError(Exception):
+    def __init__(self, message):
+        super(ProvisionerError, self).__init__(message)
+
+
+class TransientError(ProvisionerError):
+    """ A failure worth retrying: a connection error, or a transient
+        status, in which case response is set """
+    def __init__(self, message, response=None):
+        super(TransientError, self).__init__(message)
+        self.response = response
+
+
+def client_argument_spec():
+    """ Connection tuning options shared by every module """
+    return dict(
+        pool_size=dict(type='int', required=False, default=DEFAULT_POOL_SIZE),
+        connect_timeout=dict(type='float', required=False,
+                             default=DEFAULT_CONNECT_TIMEOUT),
+        read_timeout=dict(type='float', required=False,
+                          default=DEFAULT_READ_TIMEOUT),
+        trace_file=dict(type='path', required=False,
+                        fallback=(env_fallback, ['MR_PROVISIONER_TRACE_FILE'])),
+        retries=dict(type='int', required=False, default=DEFAULT_RETRIES),
+        retry_interval=dict(type='float', required=False,
+                            default=DEFAULT_RETRY_INTERVAL),
+        retry_deadline=dict(type='float', required=False,
+                            default=DEFAULT_RETRY_DEADLINE),
+    )
+
+
+def endpoint_template(url):
+    """ Endpoint of url with numeric ids replaced by {id} and only the
+        names of query parameters kept, e.g. /api/v1/machine/{id}/state or
+        /api/v1/image?q&show_all """
+    parts = urlsplit(url)
+    endpoint = re.sub(r'/\d+(?=/|$)', '/{id}', parts.path)
+    if parts.query:
+        endpoint += '?' + '&'.join(sorted(
+            name for name, _ in parse_qsl(parts.query, keep_blank_values=True)))
+    return endpoint
+
+
+def _body_size(data):
+    if data is None:
+        return 0
+    try:
+        return len(data)
+    except TypeError:
+        return None
+
+
+class ProvisionerClient(object):
+    """ Keep-alive session against one Mr. Provisioner instance.
+
+        The Authorization header is set once on the session, and a single
+        connection pool of pool_size connections is shared by every call,
+        including calls made concurrently from worker threads."""
+    def __init__(self, url, token, pool_size=DEFAULT_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, trace_file=None,
+                 retries=DEFAULT_RETRIES, retry_interval=DEFAULT_RETRY_INTERVAL,
+                 retry_deadline=DEFAULT_RETRY_DEADLINE):
+        self.url = url
+        self.token = token
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.trace_file = trace_file
+        self.trace_name = None
+        self.spans = []
+        self._trace_lock = threading.Lock()
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.retry_deadline = retry_deadline
+        self._attempt = threading.local()
+
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': token})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url_for(self, path):
+        return urljoin(self.url, path)
+
+    def request(self, method, path, **kwargs):
+        """ Issue a request relative to the provisioner URL. Connection level
+            failures are raised as ProvisionerError so callers only have one
+            exception type to handle.
+
+            GET and PUT requests are retried on transient failures; if those
+            persist, the last response is returned (or the connection error
+            raised) as without retries. """
+        if method not in IDEMPOTENT_METHODS:
+            return self._send(method, path, **kwargs)
+
+        def send():
+            r = self._send(method, path, **kwargs)
+            if r.status_code in TRANSIENT_STATUSES:
+                raise TransientError('HTTP {} {}'.format(r.status_code,
+                                                         r.reason), r)
+            return r
+
+        try:
+            return self.retry(send)
+        except TransientError as e:
+            if e.response is not None:
+                return e.response
+            raise
+
+    def retry(self, func, check=None):
+        """ Call func(), retrying it while it raises TransientError, with
+            jittered exponential backoff, up to self.retries times and
+            within self.retry_deadline seconds.
+
+            func should only be retried blindly if it is idempotent. For a
+            non-idempotent call, check is called before each retry: when the
+            failed call did take effect after all, check returns its result,
+            which is returned instead of calling func again; otherwise it
+            returns None. """
+        backoff = Backoff(self.retry_interval, RETRY_MAX_INTERVAL)
+        deadline = time.time() + self.retry_deadline
+        outer = getattr(self._attempt, 'number', None)
+        attempt = 1
+        try:
+            while True:
+                self._attempt.number = attempt
+                try:
+                    return func()
+                except TransientError:
+                    delay = backoff.next_delay()
+                    if attempt > self.retries or time.time() + delay > deadline:
+                        raise
+                time.sleep(delay)
+                attempt += 1
+                if check is not None:
+                    self._attempt.number = outer
+                    done = check()
+                    if done is not None:
+                        return done
+        finally:
+            self._attempt.number = outer
+
+    def span(self, method, url, bytes_out=None):
+        """ A new span for a call to url. Calls made without request() fill
+            in status, bytes_in, seconds (or error) and pass it to
+            record(). """
+        return dict(method=method, endpoint=endpoint_template(url),
+                    status=None, bytes_out=bytes_out, bytes_in=0,
+                    start=time.time(),
+                    attempt=getattr(self._attempt, 'number', None) or 1)
+
+    def _send(self, method, path, **kwargs):
+        """ A single request, recorded as a span """
+        kwargs.setdefault('timeout', self.timeout)
+        url = self.url_for(path)
+        span = self.span(method, url, _body_size(kwargs.get('data')))
+        try:
+            r = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            span['error'] = str(e)
+            raise TransientError('Error {} {}: {}'.format(method, url, e))
+        finally:
+            span['seconds'] = round(time.time() - span['start'], 6)
+            if 'error' in span:
+                self.record(span)
+        span['status'] = r.status_code
+        length = r.headers.get('Content-Length')
+        span['bytes_in'] = int(length) if length else len(r.content)
+        self.record(span)
+        return r
+
+    def record(self, span):
+        """ Keep a span, and append it to the trace file if there is one """
+        self.spans.append(span)
+        if self.trace_file:
+            line = dict(span, module=self.trace_name, pid=os.getpid(),
+                        thread=threading.current_thread().name)
+            with self._trace_lock:
+                with open(self.trace_file, 'a') as fd:
+                    fd.write(json.dumps(line, sort_keys=True) + '\n')
+
+    def timings(self):
+        """ Summary of the calls made so far, overall and per endpoint.
+            seconds add up the time of every call, so exceed the wall time
+            when calls were made concurrently. """
+        summary = dict(requests=0, errors=0, retries=0, seconds=0.0,
+                       bytes_in=0, bytes_out=0, endpoints={})
+        for span in list(self.spans):
+            key = '{} {}'.format(span['method'], span['endpoint'])
+            endpoint = summary['endpoints'].setdefault(key, dict(
+                requests=0, errors=0, retries=0, seconds=0.0,
+                max_seconds=0.0, bytes_in=0, bytes_out=0))
+            for totals in (summary, endpoint):
+                totals['requests'] += 1
+                if 'error' in span:
+                    totals['errors'] += 1
+                if span['attempt'] > 1:
+                    totals['retries'] += 1
+                totals['seconds'] += span['seconds']
+                totals['bytes_in'] += span['bytes_in']
+                totals['bytes_out'] += span['bytes_out'] or 0
+            endpoint['max_seconds'] = max(endpoint['max_seconds'],
+                                          span['seconds'])
+        for totals in [summary] + list(summary['endpoints'].values()):
+            totals['seconds'] = round(totals['seconds'], 3)
+        return summary
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+def get_client(url, token, pool_size=DEFAULT_POOL_SIZE,
+               connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+               read_timeout=DEFAULT_READ_TIMEOUT, trace_file=None,
+               retries=DEFAULT_RETRIES, retry_interval=DEFAULT_RETRY_INTERVAL,
+               retry_deadline=DEFAULT_RETRY_DEADLINE):
+    """ Return the shared client for (url, token), creating it on first use.
+        Tuning options only apply when the client is created. """
+    key = (url, token)
+    if key not in _CLIENTS:
+        _CLIENTS[key] = ProvisionerClient(url, token, pool_size=pool_size,
+                                          connect_timeout=connect_timeout,
+                                          read_timeout=read_timeout,
+                                          trace_file=trace_file,
+                                          retries=retries,
+                                          retry_interval=retry_interval,
+                                          retry_deadline=retry_deadline)
+    return _CLIENTS[key]
+
+
+def client_from_module(module, url_key='url', token_key='token',
+                       min_pool_size=0):
+    """ Build the shared client from a module's parameters, with at least
+        min_pool_size connections for modules running concurrent calls.
+        The module's results, including failures, get the client's timings
+        summary under `timings`. """
+    client = get_client(module.params[url_key], module.params[token_key],
+                        pool_size=max(module.params['pool_size'], min_pool_size),
+                        connect_timeout=module.params['connect_timeout'],
+                        read_timeout=module.params['read_timeout'],
+                        trace_file=module.params['trace_file'],
+                        retries=module.params['retries'],
+                        retry_interval=module.params['retry_interval'],
+                        retry_deadline=module.params['retry_deadline'])
+    client.trace_name = getattr(module, '_name', None)
+    report_timings(module, client)
+    return client
+
+
+def report_timings(module, client):
+    """ Add client.timings() and the module's wall time to whatever
+        exit_json/fail_json is called with """
+    if getattr(module, '_mr_provisioner_timings', False):
+        return
+    module._mr_provisioner_timings = True
+    start = time.time()
+
+    def wrap(exit):
+        def wrapped(**kwargs):
+            timings = client.timings()
+            timings['elapsed'] = round(time.time() - start, 3)
+            kwargs.setdefault('timings', timings)
+            exit(**kwargs)
+        return wrapped
+
+    module.exit_json = wrap(module.exit_json)
+    module.fail_json = wrap(module.fail_json)
+
+
+def run_parallel(func, items, workers):
+    """ map func over items on a bounded pool of worker threads, returning
+        the results in the order of items. func should catch its own
+        errors; any exception it raises is re-raised here. """
+    items = list(items)
+    if not items:
+        return []
+    if workers <= 1 or len(items) == 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
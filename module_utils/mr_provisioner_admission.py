@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# PXE boot admission control shared by every fork of a play.
+#
+# Provisioning a large inventory has every fork POST its machine's provision
+# state at about the same moment, and hundreds of machines then netboot at
+# once from the same TFTP/HTTP boot path and DHCP server. Admission spreads
+# them out: a machine may only be PXE booted once admitted, at most
+# wave_size machines are in flight (admitted, lease not acquired yet) and a
+# new wave is opened at most every wave_delay seconds.
+#
+# The in-flight machines live in a JSON store on the controller, updated
+# under its lock, so that all forks (and the threads of the fleet module)
+# share them. Waiting forks take turns checking the leases of the in-flight
+# machines: a machine whose lease appears or changes leaves its slot, as
+# does one still in flight after boot_timeout (e.g. a static lease, which
+# never changes).
+
+import time
+
+from ansible.module_utils.mr_provisioner import ProvisionerError, run_parallel
+from ansible.module_utils.mr_provisioner_cache import store
+from ansible.module_utils.mr_provisioner_machine import (get_lease_ip,
+                                                         get_machine_interfaces)
+from ansible.module_utils.mr_provisioner_poll import Backoff
+
+DEFAULT_WAVE_SIZE = 0       # no admission control
+DEFAULT_WAVE_DELAY = 0
+DEFAULT_BOOT_TIMEOUT = 600
+DEFAULT_ADMISSION_TIMEOUT = 3600
+DEFAULT_CHECK_INTERVAL = 5
+
+
+def admission_argument_spec():
+    """ Admission options of the modules that PXE boot machines """
+    return dict(
+        wave_size=dict(type='int', required=False, default=DEFAULT_WAVE_SIZE),
+        wave_delay=dict(type='float', required=False,
+                        default=DEFAULT_WAVE_DELAY),
+        boot_timeout=dict(type='float', required=False,
+                          default=DEFAULT_BOOT_TIMEOUT),
+        admission_timeout=dict(type='float', required=False,
+                               default=DEFAULT_ADMISSION_TIMEOUT),
+        interface_name=dict(type='str', required=False, default='eth1'),
+        cache_dir=dict(type='path', required=False),
+    )
+
+
+def admission_from_params(client, params):
+    """ The Admission configured by admission_argument_spec() options, None
+        when wave_size is 0 """
+    if not params['wave_size']:
+        return None
+    return Admission(client, params['wave_size'], params['wave_delay'],
+                     params['boot_timeout'], params['admission_timeout'],
+                     params['interface_name'], params['cache_dir'])
+
+
+class Admission(object):
+    """ Admission of PXE boots to client's instance, shared through the
+        admission store of cache_dir """
+    def __init__(self, client, wave_size, wave_delay=DEFAULT_WAVE_DELAY,
+                 boot_timeout=DEFAULT_BOOT_TIMEOUT,
+                 admission_timeout=DEFAULT_ADMISSION_TIMEOUT,
+                 interface_name='eth1', cache_dir=None,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        self.client = client
+        self.wave_size = wave_size
+        self.wave_delay = wave_delay
+        self.boot_timeout = boot_timeout
+        self.admission_timeout = admission_timeout
+        self.interface_name = interface_name
+        self.check_interval = check_interval
+        self.store = store('admission', cache_dir)
+
+    def _lease(self, machine_id):
+        return get_lease_ip(get_machine_interfaces(self.client, machine_id),
+                            self.interface_name)
+
+    def _state(self, data, now):
+        """ The instance's admission state in data, without the machines
+            in flight for longer than boot_timeout """
+        state = data.setdefault(self.client.url, {})
+        state.setdefault('inflight', {})
+        state.setdefault('wave', dict(started=0, admitted=0))
+        state['inflight'] = dict(
+            (machine_id, entry) for machine_id, entry in state['inflight'].items()
+            if now - entry['admitted'] < self.boot_timeout)
+        return state
+
+    def _admissible(self, state, now):
+        if len(state['inflight']) >= self.wave_size:
+            return False
+        wave = state['wave']
+        # Join the current wave while it has room, or open the next one
+        return (wave['admitted'] < self.wave_size or
+                now - wave['started'] >= self.wave_delay)
+
+    def acquire(self, machine_id):
+        """ Wait until machine_id may be PXE booted. Returns the seconds
+            waited; raises ProvisionerError after admission_timeout. """
+        start = time.time()
+        deadline = start + self.admission_timeout
+        lease = self._lease(machine_id)
+        backoff = Backoff(1, self.check_interval)
+        while True:
+            now = time.time()
+            check = None
+            with self.store.update() as data:
+                state = self._state(data, now)
+                if self._admissible(state, now):
+                    wave = state['wave']
+                    if not 0 < wave['admitted'] < self.wave_size:
+                        wave['started'] = now
+                        wave['admitted'] = 0
+                    wave['admitted'] += 1
+                    state['inflight'][str(machine_id)] = dict(admitted=now,
+                                                              lease=lease)
+                    return round(now - start, 3)
+                # One waiter at a time checks the leases for all of them
+                if now - state.get('checked', 0) >= self.check_interval:
+                    state['checked'] = now
+                    check = dict(state['inflight'])
+                # Known in advance: a slot timing out, the next wave opening
+                wake = [e['admitted'] + self.boot_timeout
+                        for e in state['inflight'].values()]
+                wake.append(state['wave']['started'] + self.wave_delay)
+                wake = [w for w in wake if w > now]
+            if now >= deadline:
+                raise ProvisionerError('Machine {} not admitted to PXE boot '
+                                       'within {}s ({} in flight)'.format(
+                                       machine_id, self.admission_timeout,
+                                       self.wave_size))
+            if check:
+                self._release_leased(check)
+                backoff.reset()
+            else:
+                time.sleep(max(0, min([backoff.next_delay(),
+                                       deadline - time.time()] +
+                                      [w - time.time() for w in wake])))
+
+    def _release_leased(self, inflight):
+        """ Release the machines of inflight whose lease appeared or changed
+            since they were admitted """
+        def leased(item):
+            machine_id, entry = item
+            try:
+                ip = self._lease(machine_id)
+            except ProvisionerError:
+                return None
+            return machine_id if ip and ip != entry['lease'] else None
+
+        done = [m for m in run_parallel(leased, inflight.items(),
+                                        self.client.pool_size) if m]
+        if done:
+            self.release(*done)
+
+    def release(self, *machine_ids):
+        """ Free the slots of machine_ids, e.g. when their PXE boot failed """
+        with self.store.update() as data:
+            inflight = data.get(self.client.url, {}).get('inflight', {})
+            for machine_id in machine_ids:
+                inflight.pop(str(machine_id), None)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+#
+# Small on-disk JSON stores shared by the mr_provisioner_* modules.
+#
+# Ansible runs one module process per host and task, so anything worth
+# remembering between invocations (file digests, what was uploaded where)
+# has to live on disk. Stores are read-modify-written under an exclusive
+# lock so that concurrent forks do not clobber each other.
+
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:     # not available on Windows controllers
+    fcntl = None
+
+
+def default_cache_dir():
+    """ $MR_PROVISIONER_CACHE_DIR, or ~/.cache/mr_provisioner """
+    return os.environ.get('MR_PROVISIONER_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache',
+                                       'mr_provisioner'))
+
+
+class JsonStore(object):
+    """ A JSON document on disk, replaced atomically on every write """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as fd:
+                data = json.load(fd)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return data
+
+    def _write(self, data):
+        directory = os.path.dirname(self.path)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, self.path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    @contextmanager
+    def lock(self):
+        """ Hold the store's exclusive lock without loading it """
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + '.lock', 'a') as lockfd:
+            if fcntl is not None:
+                fcntl.flock(lockfd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lockfd, fcntl.LOCK_UN)
+
+    @contextmanager
+    def update(self):
+        """ Yield the current document under an exclusive lock and write it
+            back when the block exits without error. """
+        with self.lock():
+            data = self.load()
+            yield data
+            self._write(data)
+
+
+def store(name, cache_dir=None):
+    """ Return the JsonStore called name in cache_dir """
+    return JsonStore(os.path.join(cache_dir or default_cache_dir(),
+                                  '{}.json'.format(name)))
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+#
+# Image and preseed catalog access for the mr_provisioner_* modules.
+#
+# Every module that resolves an image or preseed used to download the full
+# /api/v1/image or /api/v1/preseed listing, once per lookup, per host. Query
+# results are now read through an on-disk cache shared by all module
+# processes on the controller: a fresh entry (younger than catalog_ttl) is
+# used as is, an older one is revalidated with If-None-Match /
+# If-Modified-Since so an unchanged catalog costs a 304 rather than the whole
+# listing again.
+#
+# A listing is parsed once into an ImageCatalog or PreseedCatalog, which
+# index it on (type, arch, description) and name respectively; lookups are
+# dictionary hits rather than scans over thousands of historical images, and
+# an ambiguous key is an error rather than whichever entry came first.
+#
+# Single lookups do not need the whole listing at all: they are sent as
+# filtered queries in the API's q= language, e.g.
+# (and (= description "...") (= type "...") (= arch "...")), so the response
+# is the matching record(s) only. A server that rejects the filter is
+# remembered and the lookup falls back to the full listing.
+
+import hashlib
+import time
+
+try:
+    from urllib import quote    #Python2
+except ImportError:
+    from urllib.parse import quote    #Python3
+
+from ansible.module_utils.mr_provisioner import ProvisionerError
+from ansible.module_utils.mr_provisioner_cache import store
+
+DEFAULT_CATALOG_TTL = 60
+
+IMAGE_LISTING = '/api/v1/image?show_all=true'
+PRESEED_LISTING = '/api/v1/preseed?show_all=true'
+
+# How long a server that rejected a filtered query is sent full listings
+# instead before filters are tried again
+FILTER_RECHECK = 24 * 3600
+
+_MEMO = {}
+_INDEXES = {}
+
+
+class QueryRejected(ProvisionerError):
+    """ The server did not accept a filtered query """
+    pass
+
+
+def catalog_argument_spec():
+    """ Catalog cache options shared by the modules doing lookups """
+    return dict(
+        catalog_ttl=dict(type='int', required=False, default=DEFAULT_CATALOG_TTL),
+        cache_dir=dict(type='path', required=False),
+    )
+
+
+def _cache_key(client, path):
+    key = '{}\0{}\0{}'.format(client.url, client.token, path)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _cache(client, path, cache_dir):
+    return store('catalog-{}'.format(_cache_key(client, path)), cache_dir)
+
+
+def fetch_listing(client, path, ttl=DEFAULT_CATALOG_TTL, cache_dir=None):
+    """ GET path (a JSON listing) through the catalog cache. A ttl of 0
+        always revalidates with the server. """
+    return _fetch_listing(client, path, ttl, cache_dir)[0]
+
+
+def _fetch_listing(client, path, ttl, cache_dir):
+    """ fetch_listing, also telling whether the body was served from the
+        cache without asking the server """
+    key = _cache_key(client, path)
+    now = time.time()
+    entry = _MEMO.get(key)
+    if entry is None:
+        entry = _cache(client, path, cache_dir).load()
+    if entry and 'body' in entry and now - entry.get('fetched', 0) < ttl:
+        _MEMO[key] = entry
+        return entry['body'], True
+
+    headers = {}
+    if entry and 'body' in entry:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    r = client.get(path, headers=headers)
+    if r.status_code == 304 and headers:
+        entry['fetched'] = now
+    elif r.status_code == 200:
+        entry = dict(
+            fetched=now,
+            etag=r.headers.get('ETag'),
+            last_modified=r.headers.get('Last-Modified'),
+            body=r.json(),
+        )
+    elif r.status_code in [400, 422] and 'q=' in path:
+        raise QueryRejected('Error fetching {}, HTTP {} {}'.format(
+                            client.url_for(path), r.status_code, r.reason))
+    else:
+        raise ProvisionerError('Error fetching {}, HTTP {} {}'.format(
+                               client.url_for(path), r.status_code, r.reason))
+
+    _MEMO[key] = entry
+    with _cache(client, path, cache_dir).update() as data:
+        data.clear()
+        data.update(entry)
+    return entry['body'], False
+
+
+def invalidate(client, path, cache_dir=None):
+    """ Drop the cached listing for path, e.g. after creating an entry """
+    _MEMO.pop(_cache_key(client, path), None)
+    with _cache(client, path, cache_dir).update() as data:
+        data.clear()
+
+
+def _image_error(found, image_type, arch, description):
+    if len(found) == 0:
+        return ProvisionerError("Error finding image of type '{}' and "
+                                "description '{}'".format(image_type,
+                                                          description))
+    return ProvisionerError("Error more than one {} image of type '{}' found "
+                            "with description '{}', ids {}".format(
+                            arch, image_type, description,
+                            [image['id'] for image in found]))
+
+
+def _preseed_error(found, name):
+    if len(found) == 0:
+        return ProvisionerError('Error no preseed found with name "{}"'.
+                                format(name))
+    return ProvisionerError('Error more than one preseed found with name '
+                            '"{}", ids {}'.format(
+                            name, [preseed['id'] for preseed in found]))
+
+
+class ImageCatalog(object):
+    """ Image listing indexed on (type, arch, description) """
+    def __init__(self, images):
+        self.images = images
+        self.by_key = {}
+        self.by_kind = {}
+        for image in images:
+            key = (image['type'], image['arch'], image['description'])
+            self.by_key.setdefault(key, []).append(image)
+            self.by_kind.setdefault(key[:2], []).append(image)
+
+    def find(self, image_type, arch, description):
+        """ All images matching the key, possibly none """
+        return self.by_key.get((image_type, arch, description), [])
+
+    def of_kind(self, image_type, arch):
+        """ All images of a type and arch """
+        return self.by_kind.get((image_type, arch), [])
+
+    def get(self, image_type, arch, description):
+        """ The single image matching the key """
+        found = self.find(image_type, arch, description)
+        if len(found) != 1:
+            raise _image_error(found, image_type, arch, description)
+        return found[0]
+
+
+class PreseedCatalog(object):
+    """ Preseed listing indexed on name """
+    def __init__(self, preseeds):
+        self.preseeds = preseeds
+        self.by_name = {}
+        for preseed in preseeds:
+            self.by_name.setdefault(preseed['name'], []).append(preseed)
+
+    def find(self, name):
+        """ All preseeds called name, possibly none """
+        return self.by_name.get(name, [])
+
+    def get(self, name):
+        """ The single preseed called name """
+        found = self.find(name)
+        if len(found) != 1:
+            raise _preseed_error(found, name)
+        return found[0]
+
+
+def _load(client, path, cls, ttl, cache_dir):
+    """ Catalog object for the listing at path, indexing each listing body
+        only once. Also tells whether it came from the cache. """
+    listing, cached = _fetch_listing(client, path, ttl, cache_dir)
+    key = _cache_key(client, path)
+    index = _INDEXES.get(key)
+    if index is None or index[0] is not listing:
+        index = (listing, cls(listing))
+        _INDEXES[key] = index
+    return index[1], cached
+
+
+def _find(client, path, cls, ttl, cache_dir, find):
+    """ Run find(catalog). A cached catalog that has no match is
+        revalidated once, so entries created since it was cached are still
+        found. """
+    index, cached = _load(client, path, cls, ttl, cache_dir)
+    found = find(index)
+    if not found and cached:
+        index, cached = _load(client, path, cls, 0, cache_dir)
+        found = find(index)
+    return found
+
+
+def image_query(image_type, arch, description=None):
+    """ Path of the filtered image query for a key; without a description,
+        all images of a type and arch """
+    q = '(and (= type "{}") (= arch "{}"))'.format(quote(image_type),
+                                                   quote(arch))
+    if description is not None:
+        q = '(and (= description "{}") (= type "{}") (= arch "{}"))'.format(
+            quote(description), quote(image_type), quote(arch))
+    return '/api/v1/image?q={}&show_all=true'.format(q)
+
+
+def preseed_query(name):
+    """ Path of the filtered preseed query for a name """
+    return '/api/v1/preseed?q=(= name "{}")&show_all=true'.format(quote(name))
+
+
+def _filters_supported(client, cache_dir):
+    rejected = store('filters', cache_dir).load().get(client.url)
+    return rejected is None or time.time() - rejected > FILTER_RECHECK
+
+
+def _filter_rejected(client, cache_dir):
+    with store('filters', cache_dir).update() as data:
+        data[client.url] = time.time()
+
+
+def _query(client, path, listing, cls, ttl, cache_dir, find):
+    """ find(catalog) over the filtered query at path, or over the full
+        listing when the server does not support filters. The filtered
+        response is indexed too, in case the server ignored the filter. """
+    if _filters_supported(client, cache_dir):
+        try:
+            return _find(client, path, cls, ttl, cache_dir, find)
+        except QueryRejected:
+            _filter_rejected(client, cache_dir)
+    return _find(client, listing, cls, ttl, cache_dir, find)
+
+
+def image_catalog(client, ttl=DEFAULT_CATALOG_TTL, cache_dir=None):
+    return _load(client, IMAGE_LISTING, ImageCatalog, ttl, cache_dir)[0]
+
+
+def preseed_catalog(client, ttl=DEFAULT_CATALOG_TTL, cache_dir=None):
+    return _load(client, PRESEED_LISTING, PreseedCatalog, ttl, cache_dir)[0]
+
+
+def find_images(client, image_type, arch, description,
+                ttl=DEFAULT_CATALOG_TTL, cache_dir=None):
+    """ Images matching (type, arch, description), possibly none """
+    return _query(client, image_query(image_type, arch, description),
+                  IMAGE_LISTING, ImageCatalog, ttl, cache_dir,
+                  lambda index: index.find(image_type, arch, description))
+
+
+def images_of_kind(client, image_type, arch, ttl=DEFAULT_CATALOG_TTL,
+                   cache_dir=None):
+    """ All images of a type and arch """
+    return _query(client, image_query(image_type, arch), IMAGE_LISTING,
+                  ImageCatalog, ttl, cache_dir,
+                  lambda index: index.of_kind(image_type, arch))
+
+
+def get_image(client, image_type, arch, description,
+              ttl=DEFAULT_CATALOG_TTL, cache_dir=None):
+    """ The single image matching (type, arch, description) """
+    found = find_images(client, image_type, arch, description, ttl, cache_dir)
+    if len(found) != 1:
+        raise _image_error(found, image_type, arch, description)
+    return found[0]
+
+
+def find_preseeds(client, name, ttl=DEFAULT_CATALOG_TTL, cache_dir=None):
+    """ Preseeds called name, possibly none """
+    return _query(client, preseed_query(name), PRESEED_LISTING,
+                  PreseedCatalog, ttl, cache_dir,
+                  lambda index: index.find(name))
+
+
+def get_preseed(client, name, ttl=DEFAULT_CATALOG_TTL, cache_dir=None):
+    """ The single preseed called name """
+    found = find_preseeds(client, name, ttl, cache_dir)
+    if len(found) != 1:
+        raise _preseed_error(found, name)
+    return found[0]
@@ -0,0 +1,455 @@
+# -*- coding: utf-8 -*-
+#
+# Machine operations shared by the mr_provisioner_* modules: looking up a
+# machine and the image/preseed it should boot, setting its boot parameters
+# and PXE booting it.
+#
+# Lease IPs are cached on disk for a while (lease_ips()), so that listing the
+# machines of an instance, as the inventory plugin does on every run, costs
+# one interface request per machine only once per lease_ttl.
+#
+# Boot parameters already set on a machine are not PUT again
+# (update_machine_parameters()), and the artifacts a machine was last
+# provisioned with are fingerprinted on disk (provision_fingerprint()), so
+# that provisioning it again with the very same ones can be skipped.
+#
+# Every provisioning started is recorded as a job (record_jobs()), which
+# mr_provisioner_provision_status follows afterwards through the phases the
+# machine goes through.
+#
+# Machine names are resolved to ids many at a time (resolve_machines()), with
+# one filtered query per NAMES_PER_QUERY names rather than one per machine.
+# The ids are cached on disk for name_ttl seconds, and a cached id is always
+# checked against its name in those queries before it is used.
+
+import hashlib
+import json
+import time
+
+try:
+    from urllib import quote    #Python2
+except ImportError:
+    from urllib.parse import quote    #Python3
+
+from ansible.module_utils.mr_provisioner import (DEFAULT_POOL_SIZE,
+                                                 TRANSIENT_STATUSES,
+                                                 ProvisionerError,
+                                                 TransientError,
+                                                 run_parallel)
+from ansible.module_utils.mr_provisioner_cache import store
+from ansible.module_utils.mr_provisioner_catalog import (DEFAULT_CATALOG_TTL,
+                                                         QueryRejected,
+                                                         get_image,
+                                                         get_preseed)
+from ansible.module_utils.mr_provisioner_preseed import (content_digest,
+                                                         fetch_content)
+
+DEFAULT_LEASE_TTL = 300
+DEFAULT_NAME_TTL = 300
+NAMES_PER_QUERY = 50
+
+
+def machine_argument_spec():
+    """ Name resolution options of the modules looking machines up """
+    return dict(
+        name_ttl=dict(type='int', required=False, default=DEFAULT_NAME_TTL),
+        cache_dir=dict(type='path', required=False),
+    )
+
+
+def machine_provision(client, machine_id):
+    """ enables netboot on the machine and pxe boots it """
+    url = client.url_for("/api/v1/machine/{}/state".format(machine_id))
+
+    data = json.dumps({'state': 'provision'})
+
+    def provision():
+        r = client.post(url, data=data)
+        if r.status_code in TRANSIENT_STATUSES:
+            raise TransientError('Error PUTing {}, HTTP {} {}'.format(url,
+                                 r.status_code, r.reason), r)
+        if r.status_code not in [200, 202]:
+            raise ProvisionerError('Error PUTing {}, HTTP {} {}'.format(url,
+                             r.status_code, r.reason))
+        return r.json()
+
+    def provisioning():
+        # Not POSTed again if the lost request did start the provisioning
+        state = get_machine_state(client, machine_id)
+        return state if state.get('state') == 'provision' else None
+
+    return client.retry(provision, check=provisioning)
+
+
+def machine_parameters(initrd_id=None, kernel_id=None, kernel_opts="",
+                       preseed_id=None, subarch=None):
+    """ The fields set_machine_parameters() sets on a machine """
+    parameters = {}
+    if initrd_id:
+        parameters['initrd_id'] = initrd_id
+    if kernel_id:
+        parameters['kernel_id'] = kernel_id
+    if preseed_id:
+        parameters['preseed_id'] = preseed_id
+    if subarch:
+        parameters['subarch'] = subarch
+    if kernel_opts:
+        parameters['kernel_opts'] = kernel_opts
+
+    parameters['netboot_enabled'] = True
+    return parameters
+
+def put_machine_parameters(client, machine_id, parameters):
+    """ PUT parameters, a dict of machine fields, on machine_id """
+    url = client.url_for("/api/v1/machine/{}".format(machine_id))
+
+    data = json.dumps(parameters)
+
+    r = client.put(url, data=data)
+
+    if r.status_code != 200:
+        raise ProvisionerError('Error PUT {}, HTTP {} {}'.format(url,
+                         r.status_code, r.reason))
+    return r.json()
+
+def set_machine_parameters(client, machine_id, initrd_id=None,
+                           kernel_id=None, kernel_opts="", preseed_id=None, subarch=None):
+    """ Set parameters on machine specified by machine_id """
+    return put_machine_parameters(client, machine_id, machine_parameters(
+                                  initrd_id, kernel_id, kernel_opts,
+                                  preseed_id, subarch))
+
+def machine_parameter_changes(machine, initrd_id=None, kernel_id=None,
+                              kernel_opts="", preseed_id=None, subarch=None):
+    """ The fields of machine_parameters() whose value differs from those of
+        machine, a machine record """
+    parameters = machine_parameters(initrd_id, kernel_id, kernel_opts,
+                                    preseed_id, subarch)
+    return dict((name, value) for name, value in parameters.items()
+                if machine.get(name) != value)
+
+def update_machine_parameters(client, machine, initrd_id=None,
+                              kernel_id=None, kernel_opts="", preseed_id=None,
+                              subarch=None):
+    """ Set parameters on machine, a machine record as returned by
+        get_machine_by_name(), PUTting only the fields whose value differs
+        from the record's. Returns the machine's state and the names of the
+        fields sent; when every field already matches, nothing is sent and
+        the record itself is returned. """
+    changed = machine_parameter_changes(machine, initrd_id, kernel_id,
+                                        kernel_opts, preseed_id, subarch)
+    if not changed:
+        return machine, []
+    return (put_machine_parameters(client, machine['id'], changed),
+            sorted(changed))
+
+def machines_query(names):
+    """ Path of the filtered query for the assigned machines called names """
+    terms = ['(= name "{}")'.format(quote(name)) for name in names]
+    q = terms[0] if len(terms) == 1 else '(or {})'.format(' '.join(terms))
+    return '/api/v1/machine?q={}&show_all=false'.format(q)
+
+def _machine_named(machines, machine_name):
+    """ The single machine of machines called machine_name """
+    found = [m for m in machines if m.get('name') == machine_name]
+    if len(found) == 0:
+        raise ProvisionerError('Error no assigned machine found with name "{}"'.
+                format(machine_name))
+    if len(found) > 1:
+        raise ProvisionerError('Error more than one machine found with name "{}", {}'.
+                format(machine_name, found))
+    return found[0]
+
+def _fetch_machines(client, path):
+    r = client.get(path)
+    if r.status_code in [400, 422]:
+        raise QueryRejected('Error fetching {}, HTTP {} {}'.format(
+                            client.url_for(path), r.status_code, r.reason))
+    if r.status_code != 200:
+        raise ProvisionerError('Error fetching {}, HTTP {} {}'.format(
+                               client.url_for(path), r.status_code, r.reason))
+    return r.json()
+
+def get_machine_by_name(client, machine_name):
+    """ Look up machine by name """
+    return _machine_named(_fetch_machines(client,
+                                          machines_query([machine_name])),
+                          machine_name)
+
+def _names_key(client):
+    # Which machines are assigned depends on the token's user
+    return hashlib.sha1('{}\0{}'.format(client.url, client.token).
+                        encode('utf-8')).hexdigest()
+
+def remember_machines(client, machines, cache_dir=None):
+    """ Cache the ids of machines, records of machines assigned to the
+        token's user, by name """
+    if not machines:
+        return
+    now = time.time()
+    with store('machine_names', cache_dir).update() as data:
+        names = data.setdefault(_names_key(client), {})
+        for machine in machines:
+            names[machine['name']] = dict(id=machine['id'], time=now)
+
+def forget_machines(client, names, cache_dir=None):
+    """ Drop cached ids, e.g. of machines that could not be found by id """
+    with store('machine_names', cache_dir).update() as data:
+        cached = data.get(_names_key(client), {})
+        for name in names:
+            cached.pop(name, None)
+
+def resolve_machines(client, names, ttl=DEFAULT_NAME_TTL, cache_dir=None):
+    """ Ids of the machines assigned to the token's user called names, as a
+        dict by name, along with a dict of the errors met by name. The
+        names are resolved together: one filtered query per NAMES_PER_QUERY
+        names, or a single listing of the machines when the server does not
+        support filters. An id cached less than ttl seconds ago is checked
+        against the same answer rather than trusted, and forgotten when its
+        name now resolves to another machine, or none: a machine renamed,
+        reassigned or recreated is never mistaken for another one. """
+    cached = store('machine_names', cache_dir).load().get(_names_key(client),
+                                                          {})
+    now = time.time()
+    wanted = []
+    for name in names:
+        if name not in wanted:
+            wanted.append(name)
+    if not wanted:
+        return {}, {}
+
+    def fetch(chunk):
+        try:
+            return _fetch_machines(client, machines_query(chunk))
+        except ProvisionerError as e:
+            return e
+
+    chunks = [wanted[i:i + NAMES_PER_QUERY]
+              for i in range(0, len(wanted), NAMES_PER_QUERY)]
+    found = run_parallel(fetch, chunks, client.pool_size)
+    if any(isinstance(f, QueryRejected) for f in found):
+        try:
+            found = [list_machines(client)]
+        except ProvisionerError as e:
+            found = [e]
+        chunks = [wanted]
+
+    machines = []
+    errors = {}
+    for chunk, result in zip(chunks, found):
+        if isinstance(result, ProvisionerError):
+            errors.update((name, str(result)) for name in chunk)
+        else:
+            machines.extend(result)
+    ids = {}
+    resolved = []
+    changed = []
+    for name in wanted:
+        if name in errors:
+            continue
+        entry = cached.get(name)
+        try:
+            machine = _machine_named(machines, name)
+        except ProvisionerError as e:
+            errors[name] = str(e)
+            if entry:
+                changed.append(name)
+            continue
+        if entry and now - entry['time'] < ttl and entry['id'] != machine['id']:
+            changed.append(name)
+        ids[name] = machine['id']
+        resolved.append(machine)
+    if changed:
+        forget_machines(client, changed, cache_dir)
+    remember_machines(client, resolved, cache_dir)
+    return ids, errors
+
+def preseed_record(preseed):
+    """ Copy of preseed, a preseed record, with the sha256 of its content
+        instead of the content when it has it """
+    preseed = dict(preseed)
+    content = preseed.pop('content', None) # we don't need it, and it's really big
+    if content is not None:
+        preseed['sha256'] = content_digest(content)
+    return preseed
+
+def get_preseed_by_name(client, preseed_name, ttl=DEFAULT_CATALOG_TTL,
+                        cache_dir=None):
+    """ Look up preseed by name, with the sha256 of its content instead of
+        the content when the listing has it """
+    return preseed_record(get_preseed(client, preseed_name, ttl, cache_dir))
+
+def get_image_by_description(client, image_type, description, arch,
+                             ttl=DEFAULT_CATALOG_TTL, cache_dir=None):
+    """ Look up image by description """
+    return get_image(client, image_type, arch, description, ttl, cache_dir)
+
+def get_machine_interfaces(client, machine_id):
+    """ Network interfaces of a machine, with their leases """
+    url = client.url_for("/api/v1/machine/{}/interface".format(machine_id))
+    r = client.get(url)
+    if r.status_code != 200:
+        raise ProvisionerError('Error fetching {}, HTTP {} {}'.format(url,
+                         r.status_code, r.reason))
+    if len(r.json()) == 0:
+        raise ProvisionerError('Error no machine with id "{}"'.format(machine_id))
+    return r.json()
+
+def get_lease_ip(interfaces, interface_name):
+    """ lease_ipv4 of the interface called interface_name, None if it has no
+        lease (yet) or no such interface exists """
+    for i in interfaces:
+        if str(i['identifier']) == interface_name:
+            return i['lease_ipv4']
+    return None
+
+def list_machines(client, show_all=False):
+    """ Machines assigned to the token's user, or all of them """
+    url = client.url_for("/api/v1/machine?show_all={}".format(
+                         'true' if show_all else 'false'))
+    r = client.get(url)
+    if r.status_code != 200:
+        raise ProvisionerError('Error fetching {}, HTTP {} {}'.format(url,
+                         r.status_code, r.reason))
+    return r.json()
+
+def image_references(client):
+    """ Names of the machines, of all users, set to boot each kernel and
+        initrd, by image id """
+    references = {}
+    for machine in list_machines(client, show_all=True):
+        for field in ['kernel_id', 'initrd_id']:
+            if machine.get(field) is not None:
+                references.setdefault(machine[field], []).append(
+                    machine['name'])
+    return references
+
+def lease_ips(client, machine_ids, interface_name, ttl=DEFAULT_LEASE_TTL,
+              cache_dir=None, workers=DEFAULT_POOL_SIZE):
+    """ Lease IP of interface_name for each machine id, None when it has
+        none, as a dict, along with a dict of the errors met by id. Leases
+        are cached for ttl seconds; the others are fetched concurrently. """
+    key = '{} {}'.format(client.url, interface_name)
+    leases = store('leases', cache_dir)
+    cached = leases.load().get(key, {})
+    now = time.time()
+    ips = {}
+    errors = {}
+    stale = []
+    for machine_id in machine_ids:
+        entry = cached.get(str(machine_id))
+        if entry and now - entry['time'] < ttl:
+            ips[machine_id] = entry['ip']
+        else:
+            stale.append(machine_id)
+
+    def fetch(machine_id):
+        try:
+            return get_lease_ip(get_machine_interfaces(client, machine_id),
+                                interface_name)
+        except ProvisionerError as e:
+            return e
+
+    found = run_parallel(fetch, stale, workers)
+    if not stale:
+        return ips, errors
+    with leases.update() as data:
+        entries = data.setdefault(key, {})
+        for machine_id, ip in zip(stale, found):
+            if isinstance(ip, ProvisionerError):
+                errors[machine_id] = str(ip)
+                ip = None
+            ips[machine_id] = ip
+            if ip:
+                entries[str(machine_id)] = dict(ip=ip, time=now)
+            else:
+                entries.pop(str(machine_id), None)
+    return ips, errors
+
+def get_machine_state(client, machine_id):
+    """ Provisioning/power state of a machine """
+    url = client.url_for("/api/v1/machine/{}/state".format(machine_id))
+    r = client.get(url)
+    if r.status_code != 200:
+        raise ProvisionerError('Error fetching {}, HTTP {} {}'.format(url,
+                         r.status_code, r.reason))
+    return r.json()
+
+def preseed_digest(client, preseed):
+    """ sha256 of a preseed record's content, as get_preseed_by_name()
+        returns it, fetching the content when the listing left it out """
+    if preseed.get('sha256'):
+        return preseed['sha256']
+    return content_digest(fetch_content(client, preseed) or '')
+
+def artifact_fingerprint(kernel, initrd, preseed, kernel_opts, subarch):
+    """ SHA-256 of what a machine boots: its kernel and initrd records (a
+        replaced image gets a new id), its preseed record including the
+        sha256 of its content (a preseed is updated in place), kernel_opts
+        and subarch """
+    def artifact(record):
+        return dict((k, record.get(k)) for k in ['id', 'upload_date', 'sha256',
+                                                 'size'])
+    artifacts = dict(kernel=artifact(kernel), initrd=artifact(initrd),
+                     preseed=artifact(preseed), kernel_opts=kernel_opts or '',
+                     subarch=subarch)
+    return hashlib.sha256(json.dumps(artifacts, sort_keys=True).
+                          encode('utf-8')).hexdigest()
+
+def provision_fingerprint(client, machine_id, cache_dir=None):
+    """ The artifact_fingerprint() machine_id was last provisioned with by
+        record_provision(), None if unknown """
+    entry = store('provisioned', cache_dir).load().get(client.url, {}).get(
+        str(machine_id))
+    return entry['fingerprint'] if entry else None
+
+def record_provision(client, machine_id, fingerprint, cache_dir=None):
+    """ Remember the fingerprint machine_id was provisioned with """
+    with store('provisioned', cache_dir).update() as data:
+        data.setdefault(client.url, {})[str(machine_id)] = dict(
+            fingerprint=fingerprint, time=time.time())
+
+def boot_lease(client, machine_id, interface_name):
+    """ Lease address of machine_id about to be PXE booted, as the
+        boot_lease field of its job handle (None when it has no lease), or
+        no field when it could not be fetched """
+    try:
+        return dict(boot_lease=get_lease_ip(get_machine_interfaces(
+                                            client, machine_id),
+                                            interface_name))
+    except ProvisionerError:
+        return {}
+
+def job_handle(machine, lease=None):
+    """ Handle of the job of machine, a machine record, just PXE booted:
+        machine_id, machine_name, started (epoch seconds) and boot_lease
+        when lease, the boot_lease() fetched before the PXE boot, has it """
+    handle = dict(machine_id=machine['id'], machine_name=machine['name'],
+                  started=time.time())
+    handle.update(lease or {})
+    return handle
+
+def record_jobs(client, handles, cache_dir=None):
+    """ Record the jobs of handles, as returned by job_handle() """
+    if not handles:
+        return
+    with store('jobs', cache_dir).update() as data:
+        recorded = data.setdefault(client.url, {})
+        for job in handles:
+            recorded[str(job['machine_id'])] = dict(
+                job, phases=[dict(phase='provision', since=job['started'])])
+
+def load_jobs(client, cache_dir=None):
+    """ The jobs recorded by record_jobs() for client's instance, with their
+        phase history, by machine id (a string) """
+    return store('jobs', cache_dir).load().get(client.url, {})
+
+def save_jobs(client, jobs, cache_dir=None):
+    """ Write back jobs, as returned by load_jobs(), on top of those
+        recorded meanwhile """
+    with store('jobs', cache_dir).update() as data:
+        recorded = data.setdefault(client.url, {})
+        for machine_id, job in jobs.items():
+            # A job started again meanwhile is more recent than ours
+            if recorded.get(machine_id, {}).get('started', 0) <= job['started']:
+                recorded[machine_id] = job
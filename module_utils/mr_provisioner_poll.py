@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# Polling helpers for modules waiting on machines: exponential backoff with
+# jitter, and a TCP port probe that checks many hosts at once from a single
+# thread with non-blocking connects.
+
+import errno
+import random
+import select
+import socket
+import time
+
+DEFAULT_INTERVAL = 5
+DEFAULT_MAX_INTERVAL = 60
+DEFAULT_FACTOR = 1.5
+DEFAULT_JITTER = 0.2
+
+
+class Backoff(object):
+    """ Exponential backoff: interval, interval * factor, ... capped at
+        max_interval, each delay randomised by +/- jitter so that many
+        pollers started together drift apart. """
+    def __init__(self, interval=DEFAULT_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL,
+                 factor=DEFAULT_FACTOR, jitter=DEFAULT_JITTER):
+        self.interval = interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next_delay(self):
+        delay = min(self.interval * (self.factor ** self.attempts),
+                    self.max_interval)
+        self.attempts += 1
+        return max(0, delay * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def reset(self):
+        self.attempts = 0
+
+
+def sleep_until(deadline):
+    remaining = deadline - time.time()
+    if remaining > 0:
+        time.sleep(remaining)
+
+
+def probe_ports(addresses, timeout=2):
+    """ Try a TCP connect to every (host, port) in addresses concurrently.
+        Returns the set of addresses that accepted the connection within
+        timeout seconds. """
+    pending = {}
+    reachable = set()
+    for address in set(addresses):
+        try:
+            family, socktype, proto, _, sockaddr = socket.getaddrinfo(
+                address[0], address[1], 0, socket.SOCK_STREAM)[0]
+            sock = socket.socket(family, socktype, proto)
+        except (socket.error, socket.gaierror):
+            continue
+        sock.setblocking(0)
+        err = sock.connect_ex(sockaddr)
+        if err == 0:
+            reachable.add(address)
+            sock.close()
+        elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            pending[sock] = address
+        else:
+            sock.close()
+
+    deadline = time.time() + timeout
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        _, writable, _ = select.select([], list(pending), [], remaining)
+        for sock in writable:
+            address = pending.pop(sock)
+            if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                reachable.add(address)
+            sock.close()
+
+    for sock in pending:
+        sock.close()
+    return reachable
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+# Preseed content comparison for the mr_provisioner_* modules.
+#
+# Preseed records come back from the API with their full content, so whether
+# a local file needs uploading can be decided without writing anything: both
+# sides are normalized (line endings, trailing blank lines) and hashed, and a
+# PUT is only sent when the hashes or the preseed's metadata differ.
+#
+# PreseedUploader, which does that for one preseed, is shared by
+# mr_provisioner_preseed and the mr_provisioner action plugin.
+
+import difflib
+import hashlib
+import json
+
+from ansible.module_utils.mr_provisioner import (TRANSIENT_STATUSES,
+                                                 ProvisionerError,
+                                                 TransientError,
+                                                 get_client)
+from ansible.module_utils.mr_provisioner_catalog import (DEFAULT_CATALOG_TTL,
+                                                         PRESEED_LISTING,
+                                                         find_preseeds,
+                                                         get_preseed,
+                                                         invalidate,
+                                                         preseed_query)
+
+# Preseed fields sent on upload, other than content
+METADATA_FIELDS = ('name', 'type', 'description', 'public', 'known_good')
+
+
+def normalize_content(content):
+    """ Content as compared: unix line endings and exactly one trailing
+        newline, so that an editor or the server re-terminating the file is
+        not a change """
+    if content is None:
+        return ''
+    content = content.replace('\r\n', '\n').replace('\r', '\n')
+    content = content.rstrip('\n')
+    if content:
+        content += '\n'
+    return content
+
+
+def content_digest(content):
+    """ SHA-256 of the normalized content """
+    return hashlib.sha256(normalize_content(content).encode('utf-8')).hexdigest()
+
+
+def read_preseed_file(path):
+    with open(path, 'r') as fd:
+        return fd.read()
+
+
+def fetch_content(client, preseed):
+    """ Stored content of a preseed record, fetching the record by id when
+        the listing it came from left the content out """
+    if preseed.get('content') is not None:
+        return preseed['content']
+    url = client.url_for('/api/v1/preseed/{}'.format(preseed['id']))
+    r = client.get(url)
+    if r.status_code != 200:
+        raise ProvisionerError('Error fetching {}, HTTP {} {}'.format(url,
+                               r.status_code, r.reason))
+    return r.json().get('content')
+
+
+def metadata_changes(preseed, wanted):
+    """ Names of the metadata fields of wanted that differ from the stored
+        preseed. Fields the server did not return are not compared. """
+    return [field for field in METADATA_FIELDS
+            if field in wanted and field in preseed
+            and preseed[field] != wanted[field]]
+
+
+def content_diff(before, after, name):
+    """ Unified diff between the stored and the local content """
+    return ''.join(difflib.unified_diff(
+        normalize_content(before).splitlines(True),
+        normalize_content(after).splitlines(True),
+        fromfile='{} (Mr. Provisioner)'.format(name),
+        tofile='{} (local)'.format(name)))
+
+
+class PreseedUploader(object):
+    """ This class handles the job of uploading a preseed file to MrP.
+        It shall only be called if there is a file to be uploaded, else you can
+        fetch the thing via the regular call in the Ansible role"""
+    def __init__(self, mrp_url, mrp_token, preseed_file, preseed_name,
+                 preseed_type, preseed_desc='', preseed_knowngood=False,
+                 preseed_public=False, client=None,
+                 catalog_ttl=DEFAULT_CATALOG_TTL, cache_dir=None,
+                 check_mode=False, want_diff=False, catalog=None):
+        self.url = mrp_url
+        self.client = client or get_client(mrp_url, mrp_token)
+        self.catalog_ttl = catalog_ttl
+        self.cache_dir = cache_dir
+        self.catalog = catalog
+        self.file = preseed_file
+        self.name = preseed_name
+        self.type = preseed_type
+        self.id = None
+        self.desc = preseed_desc
+        self.knowngood = preseed_knowngood
+        self.public = preseed_public
+        self.check_mode = check_mode
+        self.want_diff = want_diff
+        self.existing = None
+        self.changed = False
+        self.content_changed = False
+        self.sha256 = None
+        self.diff = None
+
+    def _check_for_existence(self):
+        if self.catalog is not None:
+            if not self.catalog.find(self.name):
+                return False
+            self.existing = self.catalog.get(self.name)
+            self.id = self.existing['id']
+            return True
+
+        if not find_preseeds(self.client, self.name, self.catalog_ttl,
+                             self.cache_dir):
+            return False
+
+        # raises if the name is ambiguous
+        self.existing = get_preseed(self.client, self.name, self.catalog_ttl,
+                                    self.cache_dir)
+        self.id = self.existing['id']
+        return True
+
+    def _get_preseed_from_file(self):
+        json_preseed = {}
+
+        json_preseed['content'] = read_preseed_file(self.file)
+        json_preseed['name'] = self.name
+        json_preseed['type'] = self.type
+        json_preseed['public'] = self.public
+        json_preseed['known_good'] = self.knowngood
+        if self.desc != '':
+            json_preseed['description'] = self.desc
+
+        return json_preseed
+
+    def upload_preseed(self):
+        """Uploads preseed. Should check first that preseed doesn't exist, else
+        it modifies preseed (separate function ?). Post to upload, Put to
+        modify (+ id). Maybe implement a jinja2 syntax check ? But that should
+        be done on mrp's side"""
+        res = {}
+        try:
+            res = self.apply(self.plan())
+        except ProvisionerError as e:
+            res['error'] = str(e)
+        return res
+
+    def plan(self):
+        """ What upload_preseed would do, without writing anything: 'create',
+            'update' or 'unchanged' """
+        exists = self._check_for_existence()
+
+        if not exists and self.file == '':
+            raise ProvisionerError('Preseed does not exist and file not given')
+
+        if self.id != None and self.file != '':     #Exists and file given
+            return 'update' if self._needs_update() else 'unchanged'
+        elif self.file != '':        #Doesn't exist and file given
+            content = read_preseed_file(self.file)
+            self.sha256 = content_digest(content)
+            self.content_changed = True
+            if self.want_diff:
+                self.diff = content_diff('', content, self.name)
+            return 'create'
+        else:       #Exists and file not given, is it useful fetching contents?
+            return 'unchanged'
+
+    def apply(self, action):
+        """ Carry out a plan() action """
+        if action == 'create':
+            return self._modify_preseed(method='POST')
+        if action == 'update':
+            return self._modify_preseed(method='PUT')
+        return self._existing_record()
+
+    def _existing_record(self):
+        """ The stored preseed, without its (big) content """
+        res = dict(self.existing)
+        res.pop('content', None)
+        return res
+
+    def _needs_update(self):
+        """ Compare the local file and metadata with the stored preseed """
+        preseed = self._get_preseed_from_file()
+        stored = fetch_content(self.client, self.existing)
+        self.sha256 = content_digest(preseed['content'])
+        self.content_changed = content_digest(stored) != self.sha256
+        if self.content_changed and self.want_diff:
+            self.diff = content_diff(stored, preseed['content'], self.name)
+        return (self.content_changed or
+                bool(metadata_changes(self.existing, preseed)))
+
+    def _modify_preseed(self, method):
+        preseed = self._get_preseed_from_file()
+        self.sha256 = content_digest(preseed['content'])
+        self.changed = True
+        if self.check_mode:
+            res = dict(preseed)
+            res.pop('content')
+            if self.id != None:
+                res['id'] = self.id
+            return res
+        url = self.client.url_for('/api/v1/preseed')
+        if method == 'PUT':
+            if self.id == None:
+                raise ProvisionerError('preseed ID is undefined, please use upload_preseed')
+            url_id = '/api/v1/preseed/' + str(self.id)
+            url = self.client.url_for(url_id)
+            r = self.client.put(url, data=json.dumps(preseed))
+            if r.status_code != 200:
+                raise ProvisionerError('Error putting preseed {} at ID {}, \
+                                   HTTP {} {}'.format(self.name, url, r.status_code, r.reason))
+            res = r.json()
+        elif method == 'POST':
+            res = self.client.retry(lambda: self._post(url, preseed),
+                                    check=self._posted)
+        else:
+            raise ProvisionerError('Bad _modify_preseed call')
+        invalidate(self.client, PRESEED_LISTING, self.cache_dir)
+        invalidate(self.client, preseed_query(self.name), self.cache_dir)
+        return res
+
+    def _post(self, url, preseed):
+        r = self.client.post(url, data=json.dumps(preseed))
+        if r.status_code in TRANSIENT_STATUSES:
+            raise TransientError('Error posting preseed {}, HTTP {} {}'.format(
+                                 self.name, r.status_code, r.reason), r)
+        if r.status_code != 201:
+            raise ProvisionerError('Error posting preseed {}, \
+                                       HTTP {} {}'.format(self.name, r.status_code, r.reason))
+        return r.json()
+
+    def _posted(self):
+        """ The preseed, if a POST whose response was lost created it """
+        found = find_preseeds(self.client, self.name, 0, self.cache_dir)
+        if (len(found) == 1 and
+                content_digest(fetch_content(self.client, found[0])) == self.sha256):
+            return found[0]
+        return None
@@ -0,0 +1,820 @@
+# -*- coding: utf-8 -*-
+#
+# Upload helpers for mr_provisioner_image.
+#
+# requests.post(files=...) renders the whole multipart body in memory before
+# sending it, so uploading a large initrd costs its full size in RSS. The
+# encoder below produces the same multipart/form-data body as a file-like
+# object, reading the image through a fixed-size buffer as the connection
+# consumes it.
+#
+# Images are also identified by the SHA-256 of their content so that an
+# unchanged file is never sent twice and a changed one is noticed even when
+# its description stays the same.
+#
+# For slow or flaky links, chunked_upload() sends the image in fixed-size
+# chunks that are acknowledged by the server one at a time, so a dropped
+# connection only costs the chunk in flight:
+#
+#   POST  /api/v1/image/upload        {q fields, size, sha256} -> 201 {id, offset}
+#   GET   /api/v1/image/upload/<id>   -> 200 {offset, size}
+#   PATCH /api/v1/image/upload/<id>   Upload-Offset: <n>, chunk bytes
+#                                     -> 204 Upload-Offset: <n + len>
+#                                     -> 201 <image> once the last byte lands
+#
+# How the bytes get on the wire is the upload engine's business:
+#
+#   gzip, zstd  an uncompressed image is compressed on the fly and sent with
+#               Content-Encoding. A server that does not take encoded
+#               request bodies answers 415, listing what it does take in
+#               Accept-Encoding (RFC 7694); that is remembered per server and
+#               the image sent as is.
+#   sendfile    the file part of the body is handed to the kernel with
+#               os.sendfile(), without being copied through Python buffers.
+#   mmap        the same over TLS (or without os.sendfile): the file part is
+#               written from a memory map.
+#   stream      the MultipartEncoder read through requests, when zero copy
+#               is off or the server is reached through a proxy.
+#
+# sendfile and mmap write the request on a connection of their own rather
+# than one of the client's pooled requests connections.
+
+import hashlib
+import json
+import mmap
+import os
+import socket
+import ssl
+import time
+import uuid
+import zlib
+
+import requests
+
+from ansible.module_utils.mr_provisioner import (TRANSIENT_STATUSES,
+                                                 ProvisionerError,
+                                                 TransientError,
+                                                 run_parallel)
+from ansible.module_utils.mr_provisioner_cache import store
+from ansible.module_utils.mr_provisioner_catalog import (IMAGE_LISTING,
+                                                         find_images,
+                                                         image_catalog,
+                                                         image_query,
+                                                         images_of_kind,
+                                                         invalidate)
+from ansible.module_utils.mr_provisioner_machine import image_references
+
+try:
+    import http.client as http_client    #Python3
+    from urllib.parse import urlsplit
+except ImportError:
+    import httplib as http_client    #Python2
+    from urlparse import urlsplit
+
+try:
+    import zstandard
+    HAS_ZSTD = True
+except ImportError:
+    HAS_ZSTD = False
+
+DEFAULT_BUFFER_SIZE = 64 * 1024
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_CHUNK_RETRIES = 5
+
+COMPRESSIONS = ['none', 'auto', 'gzip', 'zstd']
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# Leading bytes of gzip, xz, zstd, bzip2, lz4, lzo and lzma files
+COMPRESSED_MAGIC = (b'\x1f\x8b', b'\xfd7zXZ\x00', b'\x28\xb5\x2f\xfd', b'BZh',
+                    b'\x04\x22\x4d\x18', b'\x89LZO', b'\x5d\x00\x00')
+# An image whose first SAMPLE_SIZE bytes do not shrink below MIN_RATIO of
+# their size (a self-extracting kernel, say) is not worth compressing
+SAMPLE_SIZE = 1024 * 1024
+MIN_RATIO = 0.9
+
+
+def upload_argument_spec():
+    """ Upload options of mr_provisioner_image, shared with the
+        mr_provisioner action plugin """
+    return dict(
+        dedupe=dict(type='bool', required=False, default=False),
+        on_content_change=dict(type='str', required=False, default='keep',
+                               choices=['replace', 'keep', 'fail']),
+        chunked=dict(type='bool', required=False, default=False),
+        chunk_size=dict(type='int', required=False, default=DEFAULT_CHUNK_SIZE),
+        chunk_retries=dict(type='int', required=False,
+                           default=DEFAULT_CHUNK_RETRIES),
+        buffer_size=dict(type='int', required=False,
+                         default=DEFAULT_BUFFER_SIZE),
+        compression=dict(type='str', required=False, default='none',
+                         choices=COMPRESSIONS),
+        zero_copy=dict(type='bool', required=False, default=True),
+    )
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+class MultipartEncoder(object):
+    """ Streaming multipart/form-data body made of plain form fields followed
+        by a single file field. Memory use is bounded by buffer_size whatever
+        the size of the file. """
+    def __init__(self, fields, file_field, path, buffer_size=DEFAULT_BUFFER_SIZE,
+                 content_type='application/octet-stream'):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={}'.format(self.boundary)
+        self.bytes_read = 0
+
+        head = b''
+        for name, value in fields:
+            head += _to_bytes('--{}\r\n'
+                              'Content-Disposition: form-data; name="{}"\r\n'
+                              '\r\n'.format(self.boundary, name))
+            head += _to_bytes(value) + b'\r\n'
+        head += _to_bytes('--{}\r\n'
+                          'Content-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                          'Content-Type: {}\r\n'
+                          '\r\n'.format(self.boundary, file_field,
+                                        os.path.basename(path), content_type))
+        tail = _to_bytes('\r\n--{}--\r\n'.format(self.boundary))
+
+        self._segments = [head, None, tail]    # None is the file contents
+        self._segment = 0
+        self._offset = 0
+        self._fd = None
+        self.len = len(head) + os.path.getsize(path) + len(tail)
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.buffer_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self, size=-1):
+        """ Return up to size bytes of the body. A negative size reads one
+            buffer rather than the whole remaining body. """
+        if size is None or size < 0:
+            size = self.buffer_size
+        chunk = b''
+        while len(chunk) < size and self._segment < len(self._segments):
+            segment = self._segments[self._segment]
+            if segment is None:
+                if self._fd is None:
+                    self._fd = open(self.path, 'rb')
+                data = self._fd.read(min(size - len(chunk), self.buffer_size))
+                if not data:
+                    self._fd.close()
+                    self._next_segment()
+                    continue
+            else:
+                data = segment[self._offset:self._offset + size - len(chunk)]
+                self._offset += len(data)
+                if self._offset >= len(segment):
+                    self._next_segment()
+            chunk += data
+        self.bytes_read += len(chunk)
+        return chunk
+
+    def _next_segment(self):
+        self._segment += 1
+        self._offset = 0
+
+    def send_to(self, sock, use_sendfile):
+        """ Write the whole body to sock, the file contents with
+            socket.sendfile() or else from a memory map """
+        head, _, tail = self._segments
+        size = self.len - len(head) - len(tail)
+        sock.sendall(head)
+        if size:
+            with open(self.path, 'rb') as fd:
+                if use_sendfile:
+                    sock.sendfile(fd, 0, size)
+                else:
+                    mapped = mmap.mmap(fd.fileno(), size, access=mmap.ACCESS_READ)
+                    view = memoryview(mapped)
+                    try:
+                        for offset in range(0, size, self.buffer_size):
+                            sock.sendall(view[offset:offset + self.buffer_size])
+                    finally:
+                        if hasattr(view, 'release'):
+                            view.release()
+                        mapped.close()
+        sock.sendall(tail)
+        self.bytes_read = self.len
+
+    def close(self):
+        if self._fd is not None and not self._fd.closed:
+            self._fd.close()
+
+
+def _compressor(encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    # wbits 31: a gzip header and trailer around the deflate stream
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+
+def compress_bytes(data, encoding):
+    compressor = _compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+
+class CompressedBody(object):
+    """ Streaming compression of another body (a MultipartEncoder). Its
+        length is not known up front, so requests sends it with chunked
+        transfer encoding. """
+    def __init__(self, source, encoding, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.source = source
+        self.buffer_size = buffer_size
+        self.bytes_read = 0
+        self._compressor = _compressor(encoding)
+        self._pending = b''
+        self._done = False
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.buffer_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.buffer_size
+        while len(self._pending) < size and not self._done:
+            data = self.source.read(self.buffer_size)
+            if data:
+                self._pending += self._compressor.compress(data)
+            else:
+                self._pending += self._compressor.flush()
+                self._done = True
+        chunk, self._pending = self._pending[:size], self._pending[size:]
+        self.bytes_read += len(chunk)
+        return chunk
+
+
+class TransferStats(object):
+    """ Measures bytes sent and throughput of an upload. bytes_sent counts
+        what went on the wire, size the image's own bytes, so that
+        effective_bps is the rate at which the image got across, compressed
+        or not. """
+    def __init__(self, engine=None, size=None, encoding=None):
+        self.start = time.time()
+        self.end = None
+        self.bytes_sent = 0
+        self.engine = engine
+        self.size = size
+        self.encoding = encoding
+
+    def finish(self, bytes_sent):
+        self.end = time.time()
+        self.bytes_sent = bytes_sent
+
+    def as_dict(self):
+        elapsed = (self.end or time.time()) - self.start
+        result = dict(
+            bytes_sent=self.bytes_sent,
+            seconds=round(elapsed, 3),
+            throughput_bps=int(self.bytes_sent / elapsed) if elapsed > 0 else 0,
+        )
+        if self.engine is not None:
+            result['engine'] = self.engine
+            result['content_encoding'] = self.encoding or 'identity'
+        if self.size is not None:
+            result['size'] = self.size
+            result['effective_bps'] = int(self.size / elapsed) if elapsed > 0 else 0
+            if self.size:
+                result['ratio'] = round(self.bytes_sent / float(self.size), 3)
+        return result
+
+
+def is_compressible(path):
+    """ Whether compressing path would save anything: it is not in a
+        compressed format already, and a sample of it shrinks """
+    with open(path, 'rb') as fd:
+        sample = fd.read(SAMPLE_SIZE)
+    if not sample or sample.startswith(COMPRESSED_MAGIC):
+        return False
+    return len(zlib.compress(sample, 1)) < MIN_RATIO * len(sample)
+
+
+def server_encodings(url, cache_dir=None):
+    """ Content encodings url is known to accept for request bodies, None
+        until a 415 has said otherwise """
+    return store('encodings', cache_dir).load().get(url)
+
+
+def remember_encodings(url, accept_encoding, cache_dir=None):
+    """ Record the codings of a 415 response's Accept-Encoding header """
+    codings = [coding.split(';')[0].strip().lower()
+               for coding in (accept_encoding or '').split(',')]
+    with store('encodings', cache_dir).update() as data:
+        data[url] = [coding for coding in codings
+                     if coding and coding != 'identity']
+
+
+def choose_encoding(compression, path, accepted=None):
+    """ Content encoding to upload path with, or None to send it as is:
+        compression is one of COMPRESSIONS, accepted the server's known
+        encodings if any """
+    if compression == 'none':
+        return None
+    if compression == 'auto':
+        compression = 'zstd' if HAS_ZSTD else 'gzip'
+        if accepted is not None and compression not in accepted:
+            compression = 'gzip'
+    if compression == 'zstd' and not HAS_ZSTD:
+        raise ProvisionerError('compression zstd requires the zstandard '
+                               'Python library')
+    if accepted is not None and compression not in accepted:
+        return None
+    if not is_compressible(path):
+        return None
+    return compression
+
+
+def upload_engine(client, encoding, zero_copy):
+    """ Engine an upload with the given content encoding goes through """
+    if encoding is not None:
+        return encoding
+    url = client.url_for('/api/v1/image')
+    if not zero_copy or requests.utils.get_environ_proxies(url):
+        return 'stream'
+    if urlsplit(url).scheme == 'https' or not hasattr(socket.socket, 'sendfile'):
+        return 'mmap'
+    return 'sendfile'
+
+
+def _ca_bundle():
+    return (os.environ.get('REQUESTS_CA_BUNDLE') or
+            os.environ.get('CURL_CA_BUNDLE') or
+            requests.utils.DEFAULT_CA_BUNDLE_PATH)
+
+
+def _direct_post(client, path, encoder, use_sendfile):
+    """ POST encoder's body to path on a connection of its own, writing the
+        file part with MultipartEncoder.send_to(). Returns a
+        requests.Response like the client's own calls. """
+    url = client.url_for(path)
+    parts = urlsplit(url)
+    connect_timeout, read_timeout = client.timeout
+    if parts.scheme == 'https':
+        conn = http_client.HTTPSConnection(
+            parts.hostname, parts.port, timeout=connect_timeout,
+            context=ssl.create_default_context(cafile=_ca_bundle()))
+    else:
+        conn = http_client.HTTPConnection(parts.hostname, parts.port,
+                                          timeout=connect_timeout)
+    span = client.span('POST', url, len(encoder))
+    try:
+        conn.putrequest('POST', parts.path + ('?' + parts.query if parts.query else ''),
+                        skip_accept_encoding=True)
+        conn.putheader('Authorization', client.token)
+        conn.putheader('Content-Type', encoder.content_type)
+        conn.putheader('Content-Length', str(len(encoder)))
+        conn.endheaders()
+        conn.sock.settimeout(read_timeout)
+        encoder.send_to(conn.sock, use_sendfile)
+        response = conn.getresponse()
+        r = requests.Response()
+        r.status_code = response.status
+        r.reason = response.reason
+        r.headers = requests.structures.CaseInsensitiveDict(response.getheaders())
+        r._content = response.read()
+        r.url = url
+    except (socket.error, http_client.HTTPException) as e:
+        span['error'] = str(e)
+        raise TransientError('Error POST {}: {}'.format(url, e))
+    finally:
+        conn.close()
+        span['seconds'] = round(time.time() - span['start'], 6)
+        if 'error' in span:
+            client.record(span)
+    span['status'] = r.status_code
+    span['bytes_in'] = len(r.content)
+    client.record(span)
+    return r
+
+
+def _post_file(client, path, fields, file_field, buffer_size, encoding,
+               zero_copy):
+    encoder = MultipartEncoder(fields, file_field, path, buffer_size=buffer_size)
+    engine = upload_engine(client, encoding, zero_copy)
+    stats = TransferStats(engine, os.path.getsize(path), encoding)
+    body = encoder
+    try:
+        if engine in ['sendfile', 'mmap']:
+            r = _direct_post(client, '/api/v1/image', encoder,
+                             engine == 'sendfile')
+        else:
+            headers = {'Content-Type': encoder.content_type}
+            if encoding is not None:
+                body = CompressedBody(encoder, encoding, buffer_size)
+                headers['Content-Encoding'] = encoding
+            r = client.post('/api/v1/image', data=body, headers=headers)
+    finally:
+        encoder.close()
+        stats.finish(body.bytes_read)
+    return r, stats
+
+
+def upload_file(client, path, fields, file_field='file',
+                buffer_size=DEFAULT_BUFFER_SIZE, compression='none',
+                zero_copy=True, cache_dir=None):
+    """ POST path to /api/v1/image as a streamed multipart body, compressed
+        or not (see choose_encoding()), through the engine that fits.
+        Returns the response and the transfer statistics. """
+    encoding = choose_encoding(compression, path,
+                               server_encodings(client.url, cache_dir))
+    r, stats = _post_file(client, path, fields, file_field, buffer_size,
+                          encoding, zero_copy)
+    if encoding is not None and r.status_code == 415:
+        remember_encodings(client.url, r.headers.get('Accept-Encoding'),
+                           cache_dir)
+        r, stats = _post_file(client, path, fields, file_field, buffer_size,
+                              None, zero_copy)
+    return r, stats
+
+
+def _upload_offset(client, upload_id):
+    """ Offset the server has acknowledged for upload_id """
+    r = client.get('/api/v1/image/upload/{}'.format(upload_id))
+    if r.status_code != 200:
+        raise ProvisionerError('Error fetching upload {}, HTTP {} {}'.format(
+                               upload_id, r.status_code, r.reason))
+    return int(r.json()['offset'])
+
+
+def chunked_upload(client, path, metadata, digest,
+                   chunk_size=DEFAULT_CHUNK_SIZE, retries=DEFAULT_CHUNK_RETRIES,
+                   cache_dir=None, compression='none'):
+    """ Upload path in chunks of chunk_size, retrying each chunk up to
+        retries times and resuming from the server's acknowledged offset.
+        An interrupted upload of the same content is resumed by later runs.
+        With compression, each chunk is compressed on its own; offsets stay
+        those of the uncompressed image.
+        Returns the created image and the transfer statistics. """
+    size = os.path.getsize(path)
+    encoding = choose_encoding(compression, path,
+                               server_encodings(client.url, cache_dir))
+    stats = TransferStats('chunked', size, encoding)
+    sessions = store('chunked_uploads', cache_dir)
+    key = '{} {}'.format(client.url, digest)
+
+    upload_id = sessions.load().get(key)
+    offset = None
+    if upload_id is not None:
+        try:
+            offset = _upload_offset(client, upload_id)
+        except ProvisionerError:
+            upload_id = None
+    if upload_id is None:
+        body = dict(metadata, size=size, sha256=digest)
+        r = client.post('/api/v1/image/upload', data=json.dumps(body))
+        if r.status_code != 201:
+            raise ProvisionerError('Error creating upload, HTTP {} {}'.format(
+                                   r.status_code, r.reason))
+        upload_id = r.json()['id']
+        offset = int(r.json().get('offset', 0))
+        with sessions.update() as data:
+            data[key] = upload_id
+
+    url = '/api/v1/image/upload/{}'.format(upload_id)
+    sent = 0
+    failures = 0
+    image = None
+    with open(path, 'rb') as fd:
+        while image is None:
+            if offset is None:
+                # Connection dropped: ask where the server got to
+                try:
+                    offset = _upload_offset(client, upload_id)
+                except ProvisionerError:
+                    failures += 1
+                    if failures > retries:
+                        raise
+                    time.sleep(min(2 ** failures, 30))
+                    continue
+            fd.seek(offset)
+            chunk = fd.read(chunk_size)
+            payload = chunk
+            headers = {'Upload-Offset': str(offset),
+                       'Content-Type': 'application/offset+octet-stream'}
+            if encoding is not None and chunk:
+                payload = compress_bytes(chunk, encoding)
+                headers['Content-Encoding'] = encoding
+            try:
+                r = client.request('PATCH', url, data=payload, headers=headers)
+                if 'Content-Encoding' in headers and r.status_code == 415:
+                    remember_encodings(client.url,
+                                       r.headers.get('Accept-Encoding'),
+                                       cache_dir)
+                    encoding = stats.encoding = None
+                    continue
+                if r.status_code >= 500 or r.status_code == 409:
+                    raise ProvisionerError('Error sending chunk at {}, HTTP {} {}'.
+                                           format(offset, r.status_code, r.reason))
+            except ProvisionerError as e:
+                failures += 1
+                if failures > retries:
+                    raise ProvisionerError('Giving up on upload {} at offset {} '
+                                           'after {} retries: {}'.format(
+                                           upload_id, offset, retries, e))
+                time.sleep(min(2 ** failures, 30))
+                offset = None
+                continue
+
+            if r.status_code == 201:
+                image = r.json()
+            elif r.status_code in [200, 204]:
+                if not chunk:
+                    raise ProvisionerError('Upload {} not completed at offset {}'.
+                                           format(upload_id, offset))
+                offset = int(r.headers.get('Upload-Offset', offset + len(chunk)))
+            else:
+                raise ProvisionerError('Error sending chunk at {}, HTTP {} {}'.
+                                       format(offset, r.status_code, r.reason))
+            sent += len(payload)
+            failures = 0
+
+    with sessions.update() as data:
+        data.pop(key, None)
+    stats.finish(sent)
+    return image, stats
+
+
+def sha256_file(path, buffer_size=DEFAULT_BUFFER_SIZE):
+    """ Streaming SHA-256 of path """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fd:
+        while True:
+            data = fd.read(buffer_size)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def file_digest(path, cache_dir=None, buffer_size=DEFAULT_BUFFER_SIZE):
+    """ SHA-256 of path, cached by (path, mtime, size) so that an unchanged
+        file is only hashed once. """
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    digests = store('digests', cache_dir)
+    entry = digests.load().get(path)
+    if (entry and entry.get('mtime') == st.st_mtime and
+            entry.get('size') == st.st_size):
+        return entry['sha256']
+
+    digest = sha256_file(path, buffer_size)
+    with digests.update() as data:
+        data[path] = dict(mtime=st.st_mtime, size=st.st_size, sha256=digest)
+    return digest
+
+
+def image_digest(url, image, cache_dir=None):
+    """ Content digest of a server-side image: the record's own sha256 when
+        the server provides one, else what this controller uploaded under
+        that id. None when unknown. """
+    if image.get('sha256'):
+        return image['sha256']
+    return store('uploads', cache_dir).load().get(url, {}).get(str(image['id']))
+
+
+def record_upload(url, image_id, digest, cache_dir=None):
+    """ Remember that image_id on url holds content digest """
+    with store('uploads', cache_dir).update() as data:
+        data.setdefault(url, {})[str(image_id)] = digest
+
+
+def forget_upload(url, image_id, cache_dir=None):
+    forget_uploads(url, [image_id], cache_dir)
+
+
+def forget_uploads(url, image_ids, cache_dir=None):
+    """ Forget the digests of image_ids on url, e.g. once deleted """
+    with store('uploads', cache_dir).update() as data:
+        for image_id in image_ids:
+            data.get(url, {}).pop(str(image_id), None)
+
+
+IMAGE_FIELDS = ['description', 'type', 'arch', 'path', 'known_good', 'public']
+ALLOWED_TYPES = ["Kernel", "Initrd"]
+
+
+class QueryLookup(object):
+    """ Image lookups through filtered queries, for a single image. A list
+        of images is looked up in one ImageCatalog instead. """
+    def __init__(self, client, ttl, cache_dir):
+        self.client = client
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+
+    def find(self, image_type, arch, description):
+        return find_images(self.client, image_type, arch, description,
+                           self.ttl, self.cache_dir)
+
+    def of_kind(self, image_type, arch):
+        return images_of_kind(self.client, image_type, arch, self.ttl,
+                              self.cache_dir)
+
+
+def replaced_unused(client, image, new_id=None):
+    """ Raise ProvisionerError unless no machine is set to boot image, about
+        to be replaced (by image new_id once uploaded) """
+    machines = image_references(client).get(image['id'])
+    if machines:
+        raise ProvisionerError("Not replacing image '{}' (id {}): it is the "
+                               "kernel or initrd of machines {}{}. Set them "
+                               "to another image, or use on_content_change "
+                               "keep or fail".format(
+                               image['description'], image['id'],
+                               ', '.join(sorted(machines)),
+                               '' if new_id is None else
+                               ' (its new content was uploaded as image {}, '
+                               'with the same description)'.format(new_id)))
+
+
+def upload_image(client, image, lookup, options, result, warn=None):
+    """ Make sure image (a dict of IMAGE_FIELDS) exists in Mr. Provisioner,
+        uploading it unless it or identical content is already there.
+        options holds url and the options of upload_argument_spec() and
+        catalog_argument_spec(); warn is called with warnings.
+        Fills result in; raises ProvisionerError on failure. """
+    params = options
+    warn = warn or (lambda message: None)
+    if image['type'] not in ALLOWED_TYPES:
+        raise ProvisionerError("error: type is '{}'; must be one of {}".format(
+                               image['type'], ALLOWED_TYPES))
+
+    try:
+        digest = file_digest(image['path'], params['cache_dir'],
+                             params['buffer_size'])
+    except (IOError, OSError) as e:
+        raise ProvisionerError('Error hashing {}: {}'.format(image['path'], e))
+    result['sha256'] = digest
+
+    def digest_of(found):
+        return image_digest(params['url'], found, params['cache_dir'])
+
+    # Determine if image is already uploaded
+    existing = lookup.find(image['type'], image['arch'], image['description'])
+    if len(existing) > 1:
+        raise ProvisionerError("More than one {} image of type '{}' found with "
+                               "description '{}', ids {}".format(
+                               image['arch'], image['type'],
+                               image['description'],
+                               [found['id'] for found in existing]))
+
+    replaced = None
+    for found in existing:
+        known = digest_of(found)
+        # Unknown content (uploaded elsewhere, server keeps no digest) is
+        # trusted as before.
+        if known is None or known == digest:
+            result['json'] = found
+            return result
+        result['content_changed'] = True
+        if params['on_content_change'] == 'keep':
+            warn("Image '{}' (id {}) exists with different content than {}, "
+                 "kept as is".format(found['description'], found['id'],
+                                     image['path']))
+            result['json'] = found
+            return result
+        if params['on_content_change'] == 'fail':
+            raise ProvisionerError("Image '{}' (id {}) exists with different "
+                                   "content".format(found['description'],
+                                                    found['id']))
+        # Deleting an image machines boot would break their boot
+        # configuration
+        replaced_unused(client, found)
+        replaced = found
+        break
+
+    if replaced is None and params['dedupe']:
+        for found in lookup.of_kind(image['type'], image['arch']):
+            if digest_of(found) == digest:
+                result['json'] = found
+                result['deduplicated'] = True
+                return result
+
+    # Image does not yet exist, or its content changed. Upload it.
+    # curl -X POST "http://192.168.0.3:5000/api/v1/image"
+    # -H "accept: application/json"
+    # -H "Authorization: DEADBEEF"
+    # -H "content-type: multipart/form-data"
+    # -F "file=@linux;type="
+    # -F "q={ "description": "Example image",
+    #         "type": "Kernel",
+    #         "public": false,
+    #         "known_good": true } "
+    url = client.url_for("/api/v1/image")
+    metadata = {
+        'description': image['description'],
+        'type': image['type'],
+        'arch': image['arch'],
+        'known_good': image['known_good'],
+        'public': image['public'],
+    }
+    data = {'q': json.dumps(metadata)}
+    if params['chunked']:
+        try:
+            uploaded, stats = chunked_upload(client, image['path'], metadata,
+                                             digest, params['chunk_size'],
+                                             params['chunk_retries'],
+                                             params['cache_dir'],
+                                             params['compression'])
+        except (IOError, OSError) as e:
+            raise ProvisionerError(str(e))
+        result['upload'] = stats.as_dict()
+        result['json'] = uploaded
+    else:
+        def upload():
+            r, stats = upload_file(client, image['path'], data.items(),
+                                   buffer_size=params['buffer_size'],
+                                   compression=params['compression'],
+                                   zero_copy=params['zero_copy'],
+                                   cache_dir=params['cache_dir'])
+            result['upload'] = stats.as_dict()
+            if r.status_code in TRANSIENT_STATUSES:
+                raise TransientError('Error posting {}, HTTP {} {}'.format(
+                                     url, r.status_code, r.reason), r)
+            if r.status_code != 201:
+                raise ProvisionerError("Error fetching {}, HTTP {} {}\nrequest "
+                                       "data: {}\nresult json: {}".format(
+                                       url, r.status_code, r.reason, data,
+                                       r.json()))
+            return r.json()
+
+        def uploaded():
+            # The upload may have completed with its response lost: look for
+            # the new image before sending it again
+            found = [candidate for candidate in
+                     find_images(client, image['type'], image['arch'],
+                                 image['description'], 0, params['cache_dir'])
+                     if replaced is None or candidate['id'] != replaced['id']]
+            if len(found) == 1 and digest_of(found[0]) in [None, digest]:
+                return found[0]
+            return None
+
+        try:
+            result['json'] = client.retry(upload, check=uploaded)
+        except (IOError, OSError) as e:
+            raise ProvisionerError(str(e))
+    result['changed'] = True
+    record_upload(params['url'], result['json']['id'], digest,
+                  params['cache_dir'])
+    for path in [IMAGE_LISTING,
+                 image_query(image['type'], image['arch']),
+                 image_query(image['type'], image['arch'],
+                             image['description'])]:
+        invalidate(client, path, params['cache_dir'])
+
+    if replaced is not None:
+        # A machine may have been set to boot it during the upload
+        replaced_unused(client, replaced, result['json']['id'])
+        try:
+            r = client.delete("/api/v1/image/{}".format(replaced['id']))
+        except ProvisionerError as e:
+            warn('Could not delete replaced image {}: {}'.format(
+                        replaced['id'], e))
+        else:
+            if r.status_code not in [200, 202, 204]:
+                warn('Could not delete replaced image {}, HTTP {} {}'.
+                            format(replaced['id'], r.status_code, r.reason))
+            else:
+                forget_upload(params['url'], replaced['id'],
+                              params['cache_dir'])
+    return result
+
+
+def upload_images(client, images, options, warn=None):
+    """ upload_image for every image of the list, looked up in a single
+        image listing and uploaded concurrently by options['workers']
+        threads """
+    params = options
+    catalog = image_catalog(client, params['catalog_ttl'], params['cache_dir'])
+    if not all(catalog.find(i['type'], i['arch'], i['description'])
+               for i in images):
+        # A cached listing may predate images created since
+        catalog = image_catalog(client, 0, params['cache_dir'])
+
+    def upload(image):
+        res = dict(changed=False, description=image['description'],
+                   type=image['type'], arch=image['arch'])
+        try:
+            upload_image(client, image, catalog, options, res, warn)
+        except ProvisionerError as e:
+            res['error'] = str(e)
+        return res
+
+    return run_parallel(upload, images, params['workers'])
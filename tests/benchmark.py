@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Benchmark the role's modules against tests/fake_mr_provisioner.py.
+#
+# Every scenario runs the modules' main() in-process, the way Ansible would
+# for a given number of hosts: a per-host module (image, preseed, ...) is run
+# once per host, with its in-memory state (HTTP clients, catalog memo) reset
+# between runs as a fresh module process would have it, while the on-disk
+# cache is shared as it is on one controller. Batch modules (fleet_provision,
+# wait, get_ip with machine_names) are run once for all hosts.
+#
+# Each scenario runs in its own process so that its peak RSS can be
+# measured, and reports the API requests the fake server saw, requests per
+# host, wall time and peak RSS:
+#
+#   python tests/benchmark.py                       # 1, 50 and 500 hosts
+#   python tests/benchmark.py --hosts 50 --latency 0.005 --images 5000 \
+#       --scenario machine_provision --scenario fleet_provision --json out.json
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from urllib.request import Request, urlopen    #Python3
+except ImportError:
+    from urllib2 import Request, urlopen    #Python2
+
+ROLE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_SERVER = os.path.join(ROLE, 'tests', 'fake_mr_provisioner.py')
+
+DEFAULT_HOSTS = [1, 50, 500]
+TOKEN = 'bench-token'
+IMAGE_SIZE = 8 * 1024 * 1024
+
+
+# Scenarios: each yields (module, args) for the module runs of one
+# benchmark over hosts named host-1 ... host-N
+
+def image(ctx, hosts):
+    for _ in hosts:
+        yield 'mr_provisioner_image', dict(
+            url=ctx['url'], token=TOKEN, description='bench upload',
+            type='Kernel', arch='arm64', path=ctx['image'])
+
+
+def preseed(ctx, hosts):
+    for _ in hosts:
+        yield 'mr_provisioner_preseed', dict(
+            url=ctx['url'], token=TOKEN, name='bench-upload',
+            path=ctx['preseed'])
+
+
+def machine_provision(ctx, hosts):
+    for host in hosts:
+        yield 'mr_provisioner_machine_provision', dict(
+            url=ctx['url'], token=TOKEN, machine_name=host,
+            kernel_description='bench kernel',
+            initrd_description='bench initrd', arch='arm64', subarch='efi',
+            preseed_name='bench-preseed')
+
+
+def get_ip(ctx, hosts):
+    for host in hosts:
+        yield 'mr_provisioner_get_ip', dict(
+            mrp_url=ctx['url'], mrp_token=TOKEN, machine_name=host)
+
+
+def get_ip_batch(ctx, hosts):
+    yield 'mr_provisioner_get_ip', dict(
+        mrp_url=ctx['url'], mrp_token=TOKEN, machine_names=hosts)
+
+
+def fleet_provision(ctx, hosts):
+    yield 'mr_provisioner_fleet_provision', dict(
+        url=ctx['url'], token=TOKEN, machines=hosts,
+        kernel_description='bench kernel', initrd_description='bench initrd',
+        arch='arm64', subarch='efi', preseed_name='bench-preseed')
+
+
+def fleet_upload(ctx, hosts, pipelined=False):
+    yield 'mr_provisioner_fleet_provision', dict(
+        url=ctx['url'], token=TOKEN, machines=hosts,
+        kernel_description='bench upload', kernel_path=ctx['image'],
+        initrd_description='bench upload', initrd_path=ctx['image'],
+        arch='arm64', subarch='efi', preseed_name='bench-upload',
+        preseed_path=ctx['preseed'], pipelined=pipelined)
+
+
+def fleet_pipelined(ctx, hosts):
+    return fleet_upload(ctx, hosts, pipelined=True)
+
+
+def wait(ctx, hosts):
+    # Every machine "answers" on the fake server's own port
+    host, port = re.match(r'http://([^:/]+):(\d+)', ctx['url']).groups()
+    yield 'mr_provisioner_wait', dict(
+        url=ctx['url'], token=TOKEN, machines=hosts,
+        addresses=dict((h, host) for h in hosts), port=int(port),
+        require_down=False, timeout=60)
+
+
+SCENARIOS = [image, preseed, machine_provision, get_ip, get_ip_batch,
+             fleet_provision, fleet_upload, fleet_pipelined, wait]
+
+
+# Child side: run one scenario in this process
+
+def load_modules():
+    sys.path.insert(0, os.path.join(ROLE, 'library'))
+    import ansible.module_utils
+    ansible.module_utils.__path__.append(os.path.join(ROLE, 'module_utils'))
+
+
+def reset_module_state():
+    """ Drop the module_utils' in-process caches (_CLIENTS, _MEMO, ...) as
+        if the next module run was a new process """
+    for name, mod in list(sys.modules.items()):
+        if not name.startswith('ansible.module_utils.mr_provisioner'):
+            continue
+        for attr, value in vars(mod).items():
+            if re.match(r'_[A-Z_]+$', attr) and isinstance(value, dict):
+                for item in value.values():
+                    if hasattr(item, 'close'):
+                        item.close()
+                value.clear()
+
+
+@contextlib.contextmanager
+def module_args(args):
+    from ansible.module_utils import basic
+    try:
+        from ansible.module_utils.testing import patch_module_args
+    except ImportError:
+        patch_module_args = None
+    if patch_module_args is not None:
+        with patch_module_args(args):
+            yield
+        return
+    saved = basic._ANSIBLE_ARGS
+    basic._ANSIBLE_ARGS = json.dumps(dict(ANSIBLE_MODULE_ARGS=args)).encode('utf-8')
+    try:
+        yield
+    finally:
+        basic._ANSIBLE_ARGS = saved
+
+
+def run_module(name, args):
+    """ Run a module's main() and return its parsed result """
+    module = __import__(name)
+    reset_module_state()
+    out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    saved, sys.stdout = sys.stdout, out
+    try:
+        with module_args(args):
+            module.main()
+    except SystemExit:
+        pass
+    finally:
+        sys.stdout = saved
+    output = out.getvalue()
+    try:
+        return json.loads(output[output.index('{'):])
+    except ValueError:
+        return dict(failed=True, msg=output)
+
+
+def peak_rss_mib():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return round(rss / 1024.0, 1)
+
+
+def run_scenario(name, count, ctx):
+    load_modules()
+    hosts = ['host-{}'.format(i) for i in range(1, count + 1)]
+    runs = list(globals()[name](ctx, hosts))
+    failures = []
+    start = time.time()
+    for module, args in runs:
+        result = run_module(module, args)
+        if result.get('failed'):
+            failures.append(result.get('msg'))
+    return dict(runs=len(runs), failed=len(failures), errors=failures[:3],
+                seconds=round(time.time() - start, 3), peak_rss_mib=peak_rss_mib())
+
+
+# Parent side: start the server and a process per scenario
+
+def api(url, path, method='GET'):
+    request = Request(url.rstrip('/') + path, data=b'' if method == 'POST' else None)
+    return json.loads(urlopen(request).read().decode('utf-8'))
+
+
+def start_server(args):
+    command = [sys.executable, FAKE_SERVER, '--port', '0',
+               '--images', str(args.images), '--preseeds', str(args.preseeds),
+               '--machines', str(max(args.hosts)),
+               '--latency', str(args.latency)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE)
+    return server, server.stdout.readline().decode('utf-8').strip()
+
+
+def write_files(directory):
+    image_path = os.path.join(directory, 'bench-kernel')
+    with open(image_path, 'wb') as fd:
+        block = os.urandom(1024 * 1024)
+        for _ in range(IMAGE_SIZE // len(block)):
+            fd.write(block)
+    preseed_path = os.path.join(directory, 'bench-preseed')
+    with open(preseed_path, 'w') as fd:
+        fd.write('d-i debian-installer/locale string en_US\n' * 100)
+    return image_path, preseed_path
+
+
+def benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='mr-provisioner-bench-')
+    server, url = start_server(args)
+    results = []
+    try:
+        image_path, preseed_path = write_files(workdir)
+        for scenario in args.scenario:
+            for count in args.hosts:
+                api(url, '/_reset', 'POST')
+                ctx = dict(url=url, image=image_path, preseed=preseed_path)
+                env = dict(os.environ, MR_PROVISIONER_CACHE_DIR=os.path.join(
+                           workdir, 'cache-{}-{}'.format(scenario, count)))
+                child = subprocess.Popen(
+                    [sys.executable, __file__, '--child', scenario, str(count),
+                     json.dumps(ctx)], stdout=subprocess.PIPE, env=env)
+                result = json.loads(child.communicate()[0].decode('utf-8'))
+                requests = api(url, '/_stats')
+                result.update(scenario=scenario, hosts=count,
+                              requests=requests['requests'],
+                              requests_per_host=round(
+                                  requests['requests'] / float(count), 2),
+                              endpoints=requests['endpoints'])
+                results.append(result)
+                report(result)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir)
+    return results
+
+
+HEADER = '{:<18} {:>6} {:>6} {:>9} {:>9} {:>9} {:>9} {:>7}'
+
+
+def report(result):
+    print(HEADER.format(result['scenario'], result['hosts'], result['runs'],
+                        result['requests'], result['requests_per_host'],
+                        result['seconds'], result['peak_rss_mib'],
+                        result['failed']))
+    for error in result['errors']:
+        print('    error: {}'.format(error))
+    sys.stdout.flush()
+
+
+def main():
+    names = [s.__name__ for s in SCENARIOS]
+    parser = argparse.ArgumentParser(description='Benchmark the mr_provisioner '
+                                     'modules against a fake Mr. Provisioner')
+    parser.add_argument('--hosts', type=int, nargs='+', default=DEFAULT_HOSTS)
+    parser.add_argument('--scenario', action='append', choices=names,
+                        help='scenario to run, repeatable. Default all')
+    parser.add_argument('--images', type=int, default=1000,
+                        help='filler images in the fake catalog')
+    parser.add_argument('--preseeds', type=int, default=150,
+                        help='filler preseeds in the fake catalog')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds of latency added to every API request')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        name, count, ctx = args.child
+        result = run_scenario(name, int(count), json.loads(ctx))
+        sys.stdout.write(json.dumps(result))
+        return
+
+    args.scenario = args.scenario or names
+    print(HEADER.format('scenario', 'hosts', 'runs', 'requests', 'req/host',
+                        'wall s', 'rss MiB', 'failed'))
+    results = benchmark(args)
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump(results, fd, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
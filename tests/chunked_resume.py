@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Check that chunked uploads (mr_provisioner_image with chunked) resume
+# through dropped connections.
+#
+# tests/fake_mr_provisioner.py is started with a fraction of its PATCH
+# requests dropped without an answer (--drop-rate, --fail-match PATCH), and
+# a random image is uploaded in small chunks, without and with compression.
+# The image the fake server assembled must have the size and SHA-256 of the
+# local file. Reports the PATCHes and offset GETs it took and the wall time;
+# exits non zero on a failed or corrupt upload:
+#
+#   python tests/chunked_resume.py
+#   python tests/chunked_resume.py --size 8 --chunk-size 524288 --drop-rate 0.5
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark import FAKE_SERVER, TOKEN, api, load_modules, run_module
+
+COMPRESSIONS = ['none', 'gzip']
+
+
+def start_server(args):
+    command = [sys.executable, FAKE_SERVER, '--port', '0', '--machines', '1',
+               '--drop-rate', str(args.drop_rate), '--fail-match', 'PATCH',
+               '--seed', str(args.seed)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE)
+    return server, server.stdout.readline().decode('utf-8').strip()
+
+
+def write_image(directory, size):
+    path = os.path.join(directory, 'chunked-image')
+    with open(path, 'wb') as fd:
+        fd.write(os.urandom(size))
+    with open(path, 'rb') as fd:
+        return path, hashlib.sha256(fd.read()).hexdigest()
+
+
+def upload(url, path, compression, args):
+    """ Upload path in chunks, returning the module result and the
+        server's request counts """
+    api(url, '/_reset', 'POST')
+    result = run_module('mr_provisioner_image', dict(
+        url=url, token=TOKEN, description='chunked {}'.format(compression),
+        type='Kernel', arch='arm64', path=path, chunked=True,
+        chunk_size=args.chunk_size, chunk_retries=args.chunk_retries,
+        compression=compression))
+    return result, api(url, '/_stats')['endpoints']
+
+
+def check(result, url, size, digest):
+    """ Errors of an upload: failed, or not assembled as the local file """
+    if result.get('failed'):
+        return [result.get('msg')]
+    image = [i for i in api(url, '/api/v1/image?show_all=true')
+             if i['id'] == result['json']['id']]
+    if not image:
+        return ['image {} not found'.format(result['json']['id'])]
+    errors = []
+    if image[0]['size'] != size:
+        errors.append('size {} instead of {}'.format(image[0]['size'], size))
+    if image[0]['sha256'] != digest:
+        errors.append('sha256 {} instead of {}'.format(image[0]['sha256'],
+                                                      digest))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that chunked uploads '
+                                     'resume through dropped connections')
+    parser.add_argument('--size', type=int, default=3,
+                        help='MiB of the uploaded image')
+    parser.add_argument('--chunk-size', type=int, default=256 * 1024)
+    parser.add_argument('--chunk-retries', type=int, default=8)
+    parser.add_argument('--drop-rate', type=float, default=0.3,
+                        help='fraction of PATCH requests dropped')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    load_modules()
+    workdir = tempfile.mkdtemp(prefix='mr-provisioner-chunked-')
+    os.environ['MR_PROVISIONER_CACHE_DIR'] = os.path.join(workdir, 'cache')
+    server, url = start_server(args)
+    failed = False
+    try:
+        path, digest = write_image(workdir, args.size * 1024 * 1024)
+        print('{:<12} {:>8} {:>12} {:>8}  {}'.format('compression', 'PATCH',
+                                                    'GET offset', 'wall s',
+                                                    'result'))
+        for compression in COMPRESSIONS:
+            start = time.time()
+            result, stats = upload(url, path, compression, args)
+            errors = check(result, url, os.path.getsize(path), digest)
+            failed = failed or bool(errors)
+            print('{:<12} {:>8} {:>12} {:>8}  {}'.format(
+                  compression, stats.get('PATCH /api/v1/image/upload/{id}', 0),
+                  stats.get('GET /api/v1/image/upload/{id}', 0),
+                  round(time.time() - start, 1), '; '.join(errors) or 'ok'))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Stand-in for the Mr. Provisioner API, implementing the endpoints the role's
+# modules use, so they can be exercised and benchmarked without a real
+# provisioner:
+#
+#   /api/v1/image                 GET (q= filters, ETag), POST (multipart)
+#   /api/v1/image/{id}            DELETE
+#   /api/v1/image/upload[/{id}]   POST, GET, PATCH (chunked uploads)
+#   /api/v1/preseed[/{id}]        GET (q= filters, ETag), POST, PUT
+#   /api/v1/machine[/{id}]        GET (q= filters), PUT
+#   /api/v1/machine/{id}/interface  GET
+#   /api/v1/machine/{id}/state      GET, POST
+#
+# plus two control endpoints: GET /_stats returns the number of requests
+# served per endpoint, POST /_reset clears the counters and the state.
+#
+# The catalogs are seeded with --images and --preseeds filler entries, and
+# --machines machines called host-1 ... host-N. Images "bench kernel" and
+# "bench initrd" (arm64) and preseed "bench-preseed" always exist.
+#
+# Request bodies may be sent with chunked transfer encoding and, for the
+# --encodings given, a Content-Encoding; other encodings get a 415 listing
+# the accepted ones in Accept-Encoding.
+#
+#   python tests/fake_mr_provisioner.py --port 5055 --images 2000 --latency 0.01
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer    #Python3
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer    #Python2
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+
+class BadQuery(Exception):
+    pass
+
+
+def parse_query(q):
+    """ Parse the q= filter language, e.g.
+        (and (= type "Kernel") (or (= name "a") (= name "b"))), into nested
+        lists """
+    tokens = re.findall(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()]+', q)
+    pos = [0]
+
+    def parse():
+        if pos[0] >= len(tokens):
+            raise BadQuery('unexpected end of query')
+        token = tokens[pos[0]]
+        pos[0] += 1
+        if token == '(':
+            expr = []
+            while pos[0] < len(tokens) and tokens[pos[0]] != ')':
+                expr.append(parse())
+            if pos[0] >= len(tokens):
+                raise BadQuery('unbalanced parentheses')
+            pos[0] += 1
+            return expr
+        if token == ')':
+            raise BadQuery('unexpected )')
+        if token.startswith('"'):
+            return ('str', token[1:-1].replace('\\"', '"'))
+        return token
+
+    expr = parse()
+    if pos[0] != len(tokens):
+        raise BadQuery('trailing tokens')
+    return expr
+
+
+def matches(expr, record):
+    if not isinstance(expr, list) or not expr:
+        raise BadQuery('expected an expression')
+    op, args = expr[0], expr[1:]
+    if op == 'and':
+        return all(matches(a, record) for a in args)
+    if op == 'or':
+        return any(matches(a, record) for a in args)
+    if op == 'not' and len(args) == 1:
+        return not matches(args[0], record)
+    if op in ('=', '!=') and len(args) == 2 and isinstance(args[1], tuple):
+        equal = str(record.get(args[0])) == args[1][1]
+        return equal if op == '=' else not equal
+    raise BadQuery('unsupported expression {}'.format(expr))
+
+
+class FakeProvisioner(object):
+    """ In-memory state of the fake provisioner """
+    def __init__(self, images=0, preseeds=0, machines=500, preseed_size=4096):
+        self.lock = threading.Lock()
+        self.seed = dict(images=images, preseeds=preseeds, machines=machines,
+                         preseed_size=preseed_size)
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+            self.images = {}
+            self.preseeds = {}
+            self.machines = {}
+            self.uploads = {}
+            self.generation = {'image': 0, 'preseed': 0}
+            self.next_id = 1
+            for i in range(self.seed['images']):
+                self._add_image(dict(description='filler build {}'.format(i),
+                                     type=('Kernel', 'Initrd')[i % 2],
+                                     arch=('arm64', 'x86_64')[i // 2 % 2]),
+                                b'filler %d' % i)
+            for image_type in ('Kernel', 'Initrd'):
+                self._add_image(dict(description='bench ' + image_type.lower(),
+                                     type=image_type, arch='arm64'),
+                                image_type.encode('ascii'))
+            filler = 'd-i preseed/late_command string true\n'
+            filler *= max(1, self.seed['preseed_size'] // len(filler))
+            for i in range(self.seed['preseeds']):
+                self._add_preseed(dict(name='filler-{}'.format(i),
+                                       content=filler))
+            self._add_preseed(dict(name='bench-preseed', content=filler))
+            for i in range(1, self.seed['machines'] + 1):
+                self.machines[i] = dict(id=i, name='host-{}'.format(i),
+                                        netboot_enabled=False, state='ready')
+
+    def _id(self):
+        self.next_id += 1
+        return self.next_id - 1
+
+    def _add_image(self, metadata, content):
+        image = dict(name='image-{}'.format(self.next_id), known_good=False,
+                     public=False, user='bench',
+                     upload_date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        image.update(metadata)
+        image.update(id=self._id(), size=len(content),
+                     sha256=hashlib.sha256(content).hexdigest())
+        self.images[image['id']] = image
+        self.generation['image'] += 1
+        return image
+
+    def _add_preseed(self, preseed):
+        record = dict(type='preseed', description='', known_good=False,
+                      public=False, user='bench')
+        record.update(preseed)
+        record['id'] = self._id()
+        self.preseeds[record['id']] = record
+        self.generation['preseed'] += 1
+        return record
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return dict(requests=sum(self.counts.values()),
+                        endpoints=dict(self.counts))
+
+
+def endpoint_key(method, path):
+    return '{} {}'.format(method, re.sub(r'/\d+(?=/|$)', '/{id}', path))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without this, keep-alive
+    # clients wait out delayed ACKs on every response
+    disable_nagle_algorithm = True
+    server_version = 'FakeMrProvisioner/1.0'
+
+    def log_message(self, *args):
+        if self.server.options.verbose:
+            BaseHTTPRequestHandler.log_message(self, *args)
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def send(self, status, body=None, headers=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def raw_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            data = b''
+            while True:
+                length = int(self.rfile.readline().split(b';')[0], 16)
+                if not length:
+                    while self.rfile.readline().strip():
+                        pass
+                    return data
+                data += self.rfile.read(length)
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def body(self):
+        data = self.raw_body()
+        encoding = self.headers.get('Content-Encoding', 'identity').lower()
+        if encoding == 'gzip':
+            return zlib.decompress(data, 31)
+        if encoding == 'zstd':
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        return data
+
+    def encoding_accepted(self):
+        encoding = self.headers.get('Content-Encoding', 'identity').lower()
+        return encoding == 'identity' or encoding in self.server.encodings
+
+    def handle_one(self, method):
+        url = urlsplit(self.path)
+        self.query = parse_qs(url.query)
+        path = url.path.rstrip('/')
+        options = self.server.options
+
+        if path == '/_stats':
+            return self.send(200, self.state.stats())
+        if path == '/_reset':
+            self.raw_body()
+            self.state.reset()
+            return self.send(200, {})
+
+        self.state.count(endpoint_key(method, path))
+        if options.latency:
+            time.sleep(options.latency)
+        failure = (options.fail_match is None or
+                   re.search(options.fail_match, '{} {}'.format(method, path)))
+        if failure and random.random() < options.drop_rate:
+            self.raw_body()
+            self.close_connection = True
+            return
+        if failure and random.random() < options.fail_rate:
+            self.raw_body()
+            return self.send(503, {'error': 'injected failure'})
+
+        if not self.encoding_accepted():
+            self.raw_body()
+            return self.send(415, {'error': 'unsupported content encoding'},
+                             {'Accept-Encoding': ', '.join(
+                                 self.server.encodings) or 'identity'})
+
+        for pattern, handler in ROUTES:
+            m = re.match(pattern + '$', path)
+            if m and hasattr(self, '{}_{}'.format(method, handler)):
+                return getattr(self, '{}_{}'.format(method, handler))(*m.groups())
+        self.raw_body()
+        self.send(404, {'error': 'no route for {} {}'.format(method, path)})
+
+    def do_GET(self):
+        self.handle_one('GET')
+
+    def do_POST(self):
+        self.handle_one('POST')
+
+    def do_PUT(self):
+        self.handle_one('PUT')
+
+    def do_PATCH(self):
+        self.handle_one('PATCH')
+
+    def do_DELETE(self):
+        self.handle_one('DELETE')
+
+    # Listings
+
+    def listing(self, records, collection=None):
+        q = self.query.get('q', [None])[0]
+        if q is not None:
+            if self.server.options.no_filters:
+                return self.send(400, {'error': 'filters not supported'})
+            try:
+                expr = parse_query(q)
+                with self.state.lock:
+                    records = [r for r in records.values() if matches(expr, r)]
+            except BadQuery as e:
+                return self.send(400, {'error': str(e)})
+        else:
+            with self.state.lock:
+                records = list(records.values())
+
+        headers = {}
+        if collection is not None:
+            etag = '"{}-{:x}"'.format(self.state.generation[collection],
+                                      zlib.crc32(self.path.encode('utf-8')) & 0xffffffff)
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        self.send(200, records, headers)
+
+    # Images
+
+    def GET_images(self):
+        self.listing(self.state.images, 'image')
+
+    def POST_images(self):
+        content_type = self.headers.get('Content-Type', '')
+        m = re.search(r'boundary="?([^";]+)"?', content_type)
+        body = self.body()
+        if not m:
+            return self.send(400, {'error': 'expected multipart/form-data'})
+        fields = {}
+        for part in body.split(b'--' + m.group(1).encode('ascii')):
+            head, sep, content = part.partition(b'\r\n\r\n')
+            name = re.search(br'name="([^"]*)"', head)
+            if sep and name:
+                fields[name.group(1).decode('ascii')] = content[:-2]
+        if 'q' not in fields or 'file' not in fields:
+            return self.send(400, {'error': 'expected q and file fields'})
+        with self.state.lock:
+            image = self.state._add_image(json.loads(fields['q'].decode('utf-8')),
+                                          fields['file'])
+        self.send(201, image)
+
+    def DELETE_image(self, image_id):
+        with self.state.lock:
+            if self.state.images.pop(int(image_id), None) is None:
+                return self.send(404, {})
+            self.state.generation['image'] += 1
+        self.send(204)
+
+    def POST_uploads(self):
+        metadata = json.loads(self.body().decode('utf-8'))
+        with self.state.lock:
+            upload_id = self.state._id()
+            self.state.uploads[upload_id] = dict(metadata=metadata, data=b'')
+        self.send(201, {'id': upload_id, 'offset': 0})
+
+    def GET_upload(self, upload_id):
+        upload = self.state.uploads.get(int(upload_id))
+        if upload is None:
+            return self.send(404, {})
+        self.send(200, {'offset': len(upload['data'])})
+
+    def PATCH_upload(self, upload_id):
+        chunk = self.body()
+        upload = self.state.uploads.get(int(upload_id))
+        if upload is None:
+            return self.send(404, {})
+        offset = int(self.headers.get('Upload-Offset', -1))
+        with self.state.lock:
+            if offset != len(upload['data']):
+                return self.send(409, {'offset': len(upload['data'])})
+            upload['data'] += chunk
+            metadata = dict(upload['metadata'])
+            if len(upload['data']) < metadata.pop('size'):
+                return self.send(204, None,
+                                 {'Upload-Offset': str(len(upload['data']))})
+            metadata.pop('sha256', None)
+            image = self.state._add_image(metadata, upload['data'])
+            del self.state.uploads[int(upload_id)]
+        self.send(201, image)
+
+    # Preseeds
+
+    def GET_preseeds(self):
+        self.listing(self.state.preseeds, 'preseed')
+
+    def GET_preseed(self, preseed_id):
+        preseed = self.state.preseeds.get(int(preseed_id))
+        self.send(200, preseed) if preseed else self.send(404, {})
+
+    def POST_preseeds(self):
+        preseed = json.loads(self.body().decode('utf-8'))
+        with self.state.lock:
+            record = self.state._add_preseed(preseed)
+        self.send(201, record)
+
+    def PUT_preseed(self, preseed_id):
+        update = json.loads(self.body().decode('utf-8'))
+        with self.state.lock:
+            preseed = self.state.preseeds.get(int(preseed_id))
+            if preseed is None:
+                return self.send(404, {})
+            preseed.update(update)
+            self.state.generation['preseed'] += 1
+        self.send(200, preseed)
+
+    # Machines
+
+    def GET_machines(self):
+        self.listing(self.state.machines)
+
+    def PUT_machine(self, machine_id):
+        update = json.loads(self.body().decode('utf-8'))
+        with self.state.lock:
+            machine = self.state.machines.get(int(machine_id))
+            if machine is None:
+                return self.send(404, {})
+            machine.update(update)
+        self.send(200, machine)
+
+    def GET_interfaces(self, machine_id):
+        i = int(machine_id)
+        if i not in self.state.machines:
+            return self.send(200, [])
+        self.send(200, [{'id': i, 'identifier': 'eth1',
+                         'mac': '52:54:00:00:{:02x}:{:02x}'.format(i // 256, i % 256),
+                         'lease_ipv4': '10.0.{}.{}'.format(i // 256, i % 256)}])
+
+    def GET_state(self, machine_id):
+        machine = self.state.machines.get(int(machine_id))
+        if machine is None:
+            return self.send(404, {})
+        self.send(200, {'state': machine['state']})
+
+    def POST_state(self, machine_id):
+        state = json.loads(self.body().decode('utf-8'))
+        with self.state.lock:
+            machine = self.state.machines.get(int(machine_id))
+            if machine is None:
+                return self.send(404, {})
+            machine['state'] = state.get('state', machine['state'])
+        self.send(202, {'state': machine['state']})
+
+
+ROUTES = [
+    (r'/api/v1/image', 'images'),
+    (r'/api/v1/image/upload', 'uploads'),
+    (r'/api/v1/image/upload/(\d+)', 'upload'),
+    (r'/api/v1/image/(\d+)', 'image'),
+    (r'/api/v1/preseed', 'preseeds'),
+    (r'/api/v1/preseed/(\d+)', 'preseed'),
+    (r'/api/v1/machine', 'machines'),
+    (r'/api/v1/machine/(\d+)', 'machine'),
+    (r'/api/v1/machine/(\d+)/interface', 'interfaces'),
+    (r'/api/v1/machine/(\d+)/state', 'state'),
+]
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, options):
+        HTTPServer.__init__(self, address, Handler)
+        self.options = options
+        self.encodings = [encoding for encoding in options.encodings.split(',')
+                          if encoding == 'gzip' or
+                          (encoding == 'zstd' and zstandard is not None)]
+        self.state = FakeProvisioner(options.images, options.preseeds,
+                                     options.machines, options.preseed_size)
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description='Fake Mr. Provisioner API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5055,
+                        help='0 picks a free port, printed on startup')
+    parser.add_argument('--images', type=int, default=0,
+                        help='filler images in the catalog')
+    parser.add_argument('--preseeds', type=int, default=0,
+                        help='filler preseeds in the catalog')
+    parser.add_argument('--preseed-size', type=int, default=4096,
+                        help='bytes of content of each filler preseed')
+    parser.add_argument('--machines', type=int, default=500,
+                        help='machines host-1 ... host-N')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every API request')
+    parser.add_argument('--fail-rate', type=float, default=0,
+                        help='fraction of API requests answered with a 503')
+    parser.add_argument('--drop-rate', type=float, default=0,
+                        help='fraction of API requests whose connection is '
+                             'closed without an answer')
+    parser.add_argument('--fail-match', default=None,
+                        help='only inject failures into requests whose '
+                             '"METHOD path" matches this regular expression')
+    parser.add_argument('--no-filters', action='store_true',
+                        help='reject q= filters like older servers')
+    parser.add_argument('--encodings', default='gzip,zstd',
+                        help='comma separated request Content-Encodings '
+                             'accepted; zstd needs the zstandard library')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for failure injection')
+    parser.add_argument('--verbose', action='store_true')
+    return parser
+
+
+def main():
+    options = argument_parser().parse_args()
+    random.seed(options.seed)
+    server = FakeServer((options.host, options.port), options)
+    print('http://{}:{}/'.format(*server.server_address[:2]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Check that a machine id remembered by name (name_ttl) is never used once
+# the name belongs to another machine.
+#
+# The machine id cache is seeded with fresh but wrong entries, as left by a
+# machine renamed or recreated within name_ttl, then mr_provisioner_get_ip
+# and mr_provisioner_fleet_provision are run against
+# tests/fake_mr_provisioner.py. They must report and provision the machines
+# now called by those names, never the ones the cache points to, and leave
+# the corrected ids in the cache. Exits non zero on any mismatch:
+#
+#   python tests/stale_machine_ids.py
+
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from benchmark import FAKE_SERVER, TOKEN, api, load_modules, run_module
+
+# name: the wrong id the cache holds for it
+STALE = {'host-1': 2, 'host-3': 4}
+
+
+def start_server():
+    command = [sys.executable, FAKE_SERVER, '--port', '0', '--machines', '5']
+    server = subprocess.Popen(command, stdout=subprocess.PIPE)
+    return server, server.stdout.readline().decode('utf-8').strip()
+
+
+def seed_cache(url):
+    from ansible.module_utils.mr_provisioner import get_client
+    from ansible.module_utils.mr_provisioner_machine import remember_machines
+    remember_machines(get_client(url, TOKEN),
+                      [dict(name=name, id=machine_id)
+                       for name, machine_id in STALE.items()])
+
+
+def cached_ids(url):
+    from ansible.module_utils.mr_provisioner import get_client
+    from ansible.module_utils.mr_provisioner_cache import store
+    from ansible.module_utils.mr_provisioner_machine import _names_key
+    cached = store('machine_names').load().get(
+        _names_key(get_client(url, TOKEN)), {})
+    return dict((name, entry['id']) for name, entry in cached.items())
+
+
+def check_get_ip(url):
+    seed_cache(url)
+    result = run_module('mr_provisioner_get_ip', dict(
+        mrp_url=url, mrp_token=TOKEN, machine_names=sorted(STALE)))
+    if result.get('failed'):
+        return [result.get('msg')]
+    expected = dict((name, '10.0.0.{}'.format(name.split('-')[1]))
+                    for name in STALE)
+    return ['get_ip: {} is {}, not {}'.format(name, result['ips'].get(name),
+                                             ip)
+            for name, ip in sorted(expected.items())
+            if result['ips'].get(name) != ip]
+
+
+def check_fleet(url):
+    seed_cache(url)
+    result = run_module('mr_provisioner_fleet_provision', dict(
+        url=url, token=TOKEN, machines=sorted(STALE),
+        kernel_description='bench kernel', initrd_description='bench initrd',
+        arch='arm64', subarch='efi', preseed_name='bench-preseed'))
+    if result.get('failed'):
+        return [result.get('msg')]
+    errors = []
+    for machine in result['machines']:
+        expected = int(machine['name'].split('-')[1])
+        if machine['id'] != expected:
+            errors.append('fleet_provision: {} provisioned as machine {}, not '
+                          '{}'.format(machine['name'], machine['id'], expected))
+    booted = [m['id'] for m in api(url, '/api/v1/machine?show_all=true')
+              if m.get('kernel_id') is not None]
+    for machine_id in set(STALE.values()) - set(
+            int(name.split('-')[1]) for name in STALE):
+        if machine_id in booted:
+            errors.append('fleet_provision: machine {} was set up although '
+                          'no machine of the task is called so'.format(
+                          machine_id))
+    return errors
+
+
+def main():
+    load_modules()
+    workdir = tempfile.mkdtemp(prefix='mr-provisioner-names-')
+    os.environ['MR_PROVISIONER_CACHE_DIR'] = os.path.join(workdir, 'cache')
+    server, url = start_server()
+    errors = []
+    try:
+        for check in [check_get_ip, check_fleet]:
+            errors.extend(check(url))
+            cached = cached_ids(url)
+            errors.extend('{}: cache still holds {} for {}'.format(
+                          check.__name__, cached.get(name), name)
+                          for name in sorted(STALE)
+                          if cached.get(name) != int(name.split('-')[1]))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir)
+    for error in errors:
+        print('error: {}'.format(error))
+    print('ok' if not errors else 'FAILED')
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()